@@ -0,0 +1,511 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Cold storage for old message log rows.
+
+Rows older than the retention age are moved out of MESSAGE_LOG into
+append-only gzipped JSON lines files, one per day, alongside a small
+SQLite index of which authors have messages on which days. Run this
+file directly to search the archive or restore rows from it.
+"""
+
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import shutil
+import sqlite3
+import traceback
+from datetime import datetime, timezone
+from time import time
+
+# Load env if we're just running this file.
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
+
+import database as db
+import utils as ut
+
+# Directory the archive files and their index are kept in
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+# Messages older than this many days are archived, 0 (the default) disables
+# archiving, since archiving deletes rows from the message log
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", 0))
+# Rows moved per batch, each batch only locks its own rows
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", 1000))
+# Seconds between archive runs
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL", 3600))
+# Seconds to wait between batches, so live logging isn't starved
+ARCHIVE_PAUSE = 0.5
+# Months of empty partitions kept ahead of the current one
+PARTITION_MONTHS_AHEAD = 2
+
+# Columns written back to MESSAGE_LOG on restore
+COLUMNS = ("ID", "authorID", "messageID", "content", "dateSent",
+           "channelID", "guildID")
+
+
+def _day(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%d")
+
+
+def _parse_day(day):
+    return int(datetime.strptime(day, "%Y-%m-%d")
+               .replace(tzinfo=timezone.utc).timestamp())
+
+
+class MessageArchive:
+    """
+    The archive files on disk.
+
+    Each day's messages are kept in `<day>.jsonl.gz`, and every batch is
+    added to it as a new gzip member. The batch is written on the end of
+    a copy of the file, which then replaces it, so a crash mid-write
+    never leaves a day's file truncated. A row can be archived twice if the bot stops between writing
+    a batch and deleting it from the live table, so readers skip repeated
+    IDs. All methods block, and are run on a worker thread by the archiver.
+    """
+
+    def __init__(self, directory=ARCHIVE_DIR):
+        self.directory = directory
+        self.index_path = os.path.join(directory, "index.sqlite3")
+
+    def _connect(self):
+        os.makedirs(self.directory, exist_ok=True)
+        index = sqlite3.connect(self.index_path)
+        index.execute("""
+            CREATE TABLE IF NOT EXISTS
+            ARCHIVE_INDEX (
+                day TEXT NOT NULL,
+                discordID INTEGER NOT NULL,
+                messages INTEGER NOT NULL,
+                PRIMARY KEY (day, discordID)
+            )
+        """)
+        return index
+
+    def path(self, day):
+        return os.path.join(self.directory, f"{day}.jsonl.gz")
+
+    def write(self, rows):
+        """Appends rows to their day's file, then records them in the index."""
+        days = {}
+        for row in rows:
+            days.setdefault(_day(row['dateSent']), []).append(row)
+
+        os.makedirs(self.directory, exist_ok=True)
+        counts = {}
+        for day, day_rows in days.items():
+            path = self.path(day)
+            temp_path = f"{path}.tmp"
+            with open(temp_path, "wb") as file:
+                if os.path.exists(path):
+                    with open(path, "rb") as existing:
+                        shutil.copyfileobj(existing, file)
+                with gzip.GzipFile(fileobj=file, mode="ab") as archive:
+                    for row in day_rows:
+                        archive.write(json.dumps(
+                            row, ensure_ascii=False, default=str,
+                            separators=(",", ":")).encode("utf-8") + b"\n")
+                        key = (day, int(row['discordID'] or 0))
+                        counts[key] = counts.get(key, 0) + 1
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_path, path)
+
+        # Makes the replacements durable before the rows are deleted
+        directory = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+        index = self._connect()
+        try:
+            with index:
+                index.executemany("""
+                    INSERT INTO ARCHIVE_INDEX (day, discordID, messages)
+                    VALUES (?, ?, ?)
+                    ON CONFLICT (day, discordID)
+                    DO UPDATE SET messages = messages + excluded.messages
+                """, [(day, discord_id, count)
+                      for (day, discord_id), count in counts.items()])
+        finally:
+            index.close()
+
+    def days(self, author=None, since=None, until=None):
+        """Returns the archived days, optionally only those with `author`."""
+        if author is None:
+            if not os.path.isdir(self.directory):
+                return []
+            days = sorted(name[:-len(".jsonl.gz")]
+                          for name in os.listdir(self.directory)
+                          if name.endswith(".jsonl.gz"))
+        else:
+            index = self._connect()
+            try:
+                days = [row[0] for row in index.execute("""
+                    SELECT day FROM ARCHIVE_INDEX
+                    WHERE discordID = ?
+                    ORDER BY day
+                """, (int(author), ))]
+            finally:
+                index.close()
+
+        return [day for day in days
+                if (since is None or day >= _day(since))
+                and (until is None or day <= _day(until))]
+
+    def read(self, day):
+        seen = set()
+        with gzip.open(self.path(day), "rt", encoding="utf-8") as archive:
+            for line in archive:
+                row = json.loads(line)
+                if row['ID'] not in seen:
+                    seen.add(row['ID'])
+                    yield row
+
+    def search(self, author=None, since=None, until=None, text=None,
+               message_id=None, limit=None):
+        """
+        Yields archived rows matching every given filter, oldest day first.
+
+        `author` is a Discord user ID, `since` and `until` are timestamps
+        and `text` is matched case-insensitively against the content.
+        """
+        if text is not None:
+            text = text.lower()
+
+        found = 0
+        for day in self.days(author, since, until):
+            for row in self.read(day):
+                if author is not None and int(row['discordID'] or 0) != int(author):
+                    continue
+                if since is not None and row['dateSent'] < since:
+                    continue
+                if until is not None and row['dateSent'] > until:
+                    continue
+                if message_id is not None and str(row['messageID']) != str(message_id):
+                    continue
+                if text is not None and text not in (row['content'] or "").lower():
+                    continue
+
+                yield row
+                found += 1
+                if limit is not None and found >= limit:
+                    return
+
+
+def _partition_name(year, month):
+    return f"p{year}{month:02d}"
+
+
+def _month_after(year, month):
+    return (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+def month_partitions(start, end):
+    """
+    Returns (name, upper bound) for monthly partitions covering the
+    timestamps from `start` to `end`.
+    """
+    date = datetime.fromtimestamp(start, timezone.utc)
+    year, month = date.year, date.month
+    partitions = []
+    while True:
+        next_year, next_month = _month_after(year, month)
+        bound = int(datetime(next_year, next_month, 1,
+                             tzinfo=timezone.utc).timestamp())
+        partitions.append((_partition_name(year, month), bound))
+        if bound > end:
+            return partitions
+        year, month = next_year, next_month
+
+
+def months_ahead(timestamp, months=PARTITION_MONTHS_AHEAD):
+    date = datetime.fromtimestamp(timestamp, timezone.utc)
+    year, month = date.year, date.month
+    for _ in range(months):
+        year, month = _month_after(year, month)
+    return int(datetime(year, month, 1, tzinfo=timezone.utc).timestamp())
+
+
+async def get_partitions(conn):
+    """Returns (name, upper bound) for each MESSAGE_LOG partition, in order."""
+    await conn.execute("""
+        SELECT PARTITION_NAME AS name, PARTITION_DESCRIPTION AS bound
+        FROM information_schema.PARTITIONS
+        WHERE TABLE_SCHEMA = DATABASE()
+            AND TABLE_NAME = 'MESSAGE_LOG'
+            AND PARTITION_NAME IS NOT NULL
+        ORDER BY PARTITION_ORDINAL_POSITION
+    """)
+    return [(row['name'], None if row['bound'] == "MAXVALUE" else int(row['bound']))
+            for row in conn.fetchall()]
+
+
+async def maintain_partitions(cutoff):
+    """
+    Drops MESSAGE_LOG partitions that only held archived rows, and splits
+    new monthly partitions off the catch-all one ahead of time so it stays
+    empty and cheap to reorganise. Only applies to MySQL.
+    """
+    if db.backend.name != "mysql":
+        return
+
+    async with db.Database() as conn:
+        partitions = await get_partitions(conn)
+        if not partitions:
+            return
+
+        for name, bound in partitions:
+            if bound is None or bound > cutoff:
+                continue
+            # Never drop a partition that still has rows waiting to be archived
+            await conn.execute(
+                f"SELECT 1 FROM MESSAGE_LOG PARTITION ({name}) LIMIT 1")
+            if conn.fetchone() is None:
+                await conn.execute(
+                    f"ALTER TABLE MESSAGE_LOG DROP PARTITION {name}")
+                ut.log_info(f"Dropped archived message log partition {name}")
+
+        last_bound = max(bound for _, bound in partitions if bound is not None)
+        target = months_ahead(time())
+        if last_bound <= target:
+            new = month_partitions(last_bound, target)
+            definitions = ", ".join(f"PARTITION {name} VALUES LESS THAN ({bound})"
+                                    for name, bound in new)
+            await conn.execute(f"""
+                ALTER TABLE MESSAGE_LOG REORGANIZE PARTITION pmax INTO (
+                    {definitions},
+                    PARTITION pmax VALUES LESS THAN MAXVALUE
+                )
+            """)
+
+
+async def archive_batch(archive, cutoff, batch_size):
+    """Moves one batch of rows older than `cutoff`, returns how many moved."""
+    async with db.Database() as conn:
+        # A plain read, so the live table isn't locked
+        await conn.execute("""
+            SELECT ML.*, U.discordID
+            FROM MESSAGE_LOG ML
+            LEFT JOIN USERS U ON U.ID = ML.authorID
+            WHERE ML.dateSent < %s
+            ORDER BY ML.ID
+            LIMIT %s
+        """, (cutoff, batch_size))
+        rows = conn.fetchall()
+    if not rows:
+        return 0
+
+    for row in rows:
+        row['content'] = db.message_content(row)
+        row.pop('escaped', None)
+
+    # The connection is handed back while the files are written
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(None, archive.write, rows)
+
+    # Only deleted once they are safely on disk
+    ids = [row['ID'] for row in rows]
+    async with db.Database() as conn:
+        await conn.execute(f"""
+            DELETE FROM MESSAGE_LOG
+            WHERE dateSent < %s
+                AND ID IN ({', '.join(['%s'] * len(ids))})
+        """, (cutoff, *ids))
+        await conn.commit()
+
+    return len(rows)
+
+
+async def archive_messages(archive, older_than_days,
+                           batch_size=ARCHIVE_BATCH_SIZE, pause=ARCHIVE_PAUSE,
+                           stopping=None):
+    """
+    Archives every message older than `older_than_days`, a batch at a time.
+
+    Stops early between batches once the `stopping` event is set.
+    Returns the number of rows archived.
+    """
+    archive = archive or MessageArchive()
+    cutoff = int(time() - older_than_days * 86400)
+    archived = 0
+    while stopping is None or not stopping.is_set():
+        moved = await archive_batch(archive, cutoff, batch_size)
+        archived += moved
+        if moved < batch_size:
+            break
+        await asyncio.sleep(pause)
+
+    if archived:
+        ut.log_info(f"Archived {archived} message log rows")
+    await maintain_partitions(cutoff)
+    return archived
+
+
+async def restore_messages(rows):
+    """
+    Writes archived rows back into MESSAGE_LOG under their original IDs,
+    skipping any that are already there. Rows still older than the
+    retention age are moved out again by the next archive run, but stay
+    in the archive either way.
+    """
+    rows = [tuple(row.get(column) for column in COLUMNS) for row in rows]
+    if not rows:
+        return 0
+
+    async with db.Database() as conn:
+        await conn.executemany(f"""
+            INSERT IGNORE INTO MESSAGE_LOG
+            ({', '.join(COLUMNS)})
+            VALUES
+            ({', '.join(['%s'] * len(COLUMNS))})
+        """, rows)
+        await conn.commit()
+        return conn.rowcount
+
+
+class MessageArchiver:
+    """
+    Runs `archive_messages` every `interval` seconds in the background.
+
+    If a `leader` election is given, runs are skipped unless this process
+    is its leader, so only one of the bot's processes archives.
+    """
+
+    def __init__(self, archive, older_than_days, batch_size, interval,
+                 leader=None):
+        self.archive = archive
+        self.older_than_days = older_than_days
+        self.batch_size = batch_size
+        self.interval = interval
+        self.leader = leader
+
+        self._task = None
+        self._stopping = None
+
+        self.runs = 0
+        self.skipped = 0
+        self.archived = 0
+        self.failures = 0
+
+    def start(self, loop, wait_until_ready=None):
+        self._stopping = asyncio.Event()
+        self._task = loop.create_task(self._run(wait_until_ready))
+
+    async def _run(self, wait_until_ready):
+        if wait_until_ready is not None:
+            waiting = asyncio.ensure_future(wait_until_ready())
+            stopping = asyncio.ensure_future(self._stopping.wait())
+            await asyncio.wait((waiting, stopping),
+                               return_when=asyncio.FIRST_COMPLETED)
+            waiting.cancel()
+            stopping.cancel()
+
+        while not self._stopping.is_set():
+            interval = self.interval
+            if self.leader is not None and not self.leader.is_leader:
+                self.skipped += 1
+                # Checks again soon in case the leader goes away
+                interval = min(interval, self.leader.ttl / 3)
+            else:
+                await self._archive()
+
+            try:
+                await asyncio.wait_for(self._stopping.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _archive(self):
+        try:
+            self.archived += await archive_messages(
+                self.archive, self.older_than_days, self.batch_size,
+                stopping=self._stopping)
+            self.runs += 1
+        except Exception:
+            self.failures += 1
+            traceback.print_exc()
+
+    async def close(self):
+        """Lets the batch in progress finish, then stops."""
+        if self._task is None:
+            return
+
+        self._stopping.set()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            # Already cancelled, as discord.py cancels every task
+            # when the bot is stopped by a signal
+            pass
+        self._task = None
+
+    def stats(self):
+        return {
+            'runs': self.runs,
+            'skipped': self.skipped,
+            'archived': self.archived,
+            'failures': self.failures,
+        }
+
+
+def _timestamp(day):
+    return _parse_day(day) if day else None
+
+
+async def main(args):
+    archive = MessageArchive(args.directory)
+    if args.command == "run":
+        if not args.older_than or args.older_than <= 0:
+            ut.log_info("Give --older-than, or set ARCHIVE_AFTER_DAYS, "
+                        "to choose which messages are archived")
+            return
+        await archive_messages(archive, args.older_than, args.batch_size)
+        return
+
+    since = _timestamp(args.since)
+    # Includes the whole of the last day
+    until = _timestamp(args.until) + 86399 if args.until else None
+    rows = archive.search(author=args.author, since=since, until=until,
+                          text=args.text, message_id=args.message_id,
+                          limit=args.limit)
+
+    if args.command == "search":
+        for row in rows:
+            sent = datetime.fromtimestamp(row['dateSent'], timezone.utc)
+            print(f"[{sent:%Y-%m-%d %H:%M}] {row['discordID']} "
+                  f"({row['messageID']}): {row['content']}")
+    else:
+        restored = await restore_messages(list(rows))
+        print(f"Restored {restored} messages")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("command", choices=("run", "search", "restore"),
+                        help="archive old messages now, search the archive, "
+                             "or restore matching messages to the live table")
+    parser.add_argument("--directory", default=ARCHIVE_DIR,
+                        help=f"archive directory (default {ARCHIVE_DIR})")
+    parser.add_argument("--author", type=int,
+                        help="only messages by this Discord user ID")
+    parser.add_argument("--since", help="only messages on or after YYYY-MM-DD")
+    parser.add_argument("--until", help="only messages on or before YYYY-MM-DD")
+    parser.add_argument("--text", help="only messages containing this text")
+    parser.add_argument("--message-id", help="only the message with this ID")
+    parser.add_argument("--limit", type=int, help="maximum messages to return")
+    parser.add_argument("--older-than", type=float, default=ARCHIVE_AFTER_DAYS,
+                        help="archive messages older than this many days "
+                             "(default ARCHIVE_AFTER_DAYS)")
+    parser.add_argument("--batch-size", type=int, default=ARCHIVE_BATCH_SIZE,
+                        help="rows moved per batch")
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(args))
+    loop.run_until_complete(db.close_pool())
+    loop.close()
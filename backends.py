@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Storage backends that the database module can run on.
+
+Queries are written for MySQL, each backend translates them into its own
+dialect where it needs to. The backend is chosen with the DB_BACKEND
+environment variable, either "mysql" (the default) or "sqlite".
+"""
+
+import os
+import re
+import sqlite3
+from functools import lru_cache
+
+# Oldest SQLite that takes an ON CONFLICT clause without a conflict target,
+# which upserts are translated into
+MIN_SQLITE_VERSION = (3, 35, 0)
+
+
+class MySQLBackend:
+    """Runs on a remote MySQL server through mysql.connector."""
+
+    name = "mysql"
+
+    def __init__(self):
+        # Only imported when it is used, so SQLite deployments don't need it
+        import mysql.connector as sql
+
+        self.sql = sql
+        self.Error = sql.errors.Error
+        self.IntegrityError = sql.errors.IntegrityError
+        self.InterfaceError = sql.errors.InterfaceError
+        self.OperationalError = sql.errors.OperationalError
+
+        user = os.getenv("SQL_USER")
+        password = os.getenv("SQL_PASS")
+        database = os.getenv("SQL_DB")
+        if user is None or password is None or database is None:
+            raise Exception("Cannot find required database login information")
+
+        self.config = {
+            'host': os.getenv("SQL_HOST", '209.97.130.228'),
+            'port': int(os.getenv("SQL_PORT", 3306)),
+            'database': database,
+            'user': user,
+            'password': password,
+            'charset': 'utf8mb4',
+            'collation': 'utf8mb4_unicode_ci',
+            'use_unicode': True,
+            'get_warnings': True,
+            'autocommit': True,
+            'raise_on_warnings': False
+        }
+
+        self.pool_size = None
+        self.workers = None
+
+    def connect(self):
+        return self.sql.Connect(**self.config)
+
+    def cursor(self, connection):
+        # Buffered so that no unread results are left on a connection
+        # when it is handed back to the pool
+        return connection.cursor(dictionary=True, buffered=True)
+
+    def ping(self, connection):
+        connection.ping(reconnect=False)
+
+    def start_transaction(self, connection):
+        connection.start_transaction()
+
+    def interrupt(self, connection):
+        """Stops the query running on `connection`, from another thread."""
+        # The server only takes KILL QUERY from a different connection
+        killer = self.connect()
+        try:
+            cursor = killer.cursor()
+            cursor.execute(f"KILL QUERY {int(connection.connection_id)}")
+            cursor.close()
+        finally:
+            killer.close()
+
+    def translate(self, query):
+        return query
+
+
+def _dict_row(cursor, row):
+    return {column[0]: value for column, value in zip(cursor.description, row)}
+
+
+@lru_cache(maxsize=512)
+def _translate_to_sqlite(query):
+    query = query.replace("%s", "?")
+    query = re.sub(r"\bINSERT\s+IGNORE\b", "INSERT OR IGNORE", query)
+    # Writes are serialised by the single writer anyway
+    query = re.sub(r"\s+FOR\s+UPDATE\b", "", query)
+
+    match = re.search(r"\bON\s+DUPLICATE\s+KEY\s+UPDATE\b", query)
+    if match:
+        update = re.sub(r"\bVALUES\((\w+)\)", r"excluded.\1",
+                        query[match.end():])
+        query = query[:match.start()] + "ON CONFLICT DO UPDATE SET" + update
+
+    return query
+
+
+class SQLiteBackend:
+    """
+    Runs on an embedded SQLite database file.
+
+    The database is opened in WAL mode, and every statement is run on a
+    single connection from a single writer thread. SQLite keeps the
+    compiled form of recently used statements, so repeated queries are
+    only prepared once.
+    """
+
+    name = "sqlite"
+
+    Error = sqlite3.Error
+    IntegrityError = sqlite3.IntegrityError
+    InterfaceError = sqlite3.InterfaceError
+    OperationalError = sqlite3.OperationalError
+
+    def __init__(self):
+        if sqlite3.sqlite_version_info < MIN_SQLITE_VERSION:
+            raise Exception(
+                f"SQLite {sqlite3.sqlite_version} is too old, the sqlite "
+                f"backend needs {'.'.join(map(str, MIN_SQLITE_VERSION))} "
+                "or newer")
+
+        self.path = os.getenv("SQLITE_PATH", "bot.db")
+
+        # SQLite only allows one writer at a time
+        self.pool_size = 1
+        self.workers = 1
+
+    def connect(self):
+        # Autocommit mode, transactions are started explicitly
+        connection = sqlite3.connect(self.path, isolation_level=None,
+                                     check_same_thread=False,
+                                     cached_statements=256)
+        connection.row_factory = _dict_row
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.execute("PRAGMA synchronous = NORMAL")
+        connection.execute("PRAGMA foreign_keys = ON")
+        return connection
+
+    def cursor(self, connection):
+        return connection.cursor()
+
+    def ping(self, connection):
+        pass
+
+    def start_transaction(self, connection):
+        # Takes the write lock straight away, like SELECT ... FOR UPDATE would
+        connection.execute("BEGIN IMMEDIATE")
+
+    def interrupt(self, connection):
+        """Stops the query running on `connection`, from another thread."""
+        connection.interrupt()
+
+    def translate(self, query):
+        return _translate_to_sqlite(query)
+
+
+BACKENDS = {
+    MySQLBackend.name: MySQLBackend,
+    SQLiteBackend.name: SQLiteBackend,
+}
+
+
+def get_backend(name=None):
+    name = (name or os.getenv("DB_BACKEND", "mysql")).lower()
+    if name not in BACKENDS:
+        raise Exception(f"Unknown database backend '{name}'")
+
+    return BACKENDS[name]()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Cog for message activity statistics."""
+
+import datetime
+import time
+import typing
+
+import discord
+from discord.ext import commands
+
+import database as db
+import rollups
+import utils as ut
+
+# Longest period statistics can be asked for, in days
+MAX_DAYS = 365
+# Width of the bars in the activity by hour chart
+BAR_WIDTH = 20
+
+
+def channel_name(channel_id):
+    if channel_id == rollups.UNKNOWN_CHANNEL:
+        return "Unknown channel"
+    return f"<#{channel_id}>"
+
+
+class ActivityCog(commands.Cog):
+    """
+    Statistics read from the hourly activity rollups, so they cost the same
+    however many messages have been logged. Counts are written every
+    ACTIVITY_FLUSH_INTERVAL seconds, so the last minute may be missing.
+    """
+
+    def __init__(self, bot):
+        """Save our bot argument that is passed in to the class."""
+        self.bot = bot
+
+    @commands.command(
+        name="stats",
+        help="Shows message activity for the server, a member or a channel "
+             "over the last few days (default 7)")
+    @commands.guild_only()
+    async def stats(self, ctx,
+                    target: typing.Optional[typing.Union[discord.Member,
+                                                         discord.TextChannel]] = None,
+                    days: int = 7):
+        days = min(max(days, 1), MAX_DAYS)
+        since = rollups.hour_of(time.time() - days * 86400)
+
+        channel_id = discord_id = None
+        if isinstance(target, discord.TextChannel):
+            channel_id = target.id
+        elif target is not None:
+            discord_id = target.id
+
+        with ctx.typing():
+            rows = await db.get_activity(ctx.guild.id, since,
+                                         channel_id=channel_id,
+                                         discord_id=discord_id)
+
+        if not rows:
+            await ctx.send("No messages have been sent in that time.")
+            return
+
+        by_channel = {}
+        by_hour = [0] * 24
+        for row in rows:
+            by_channel[row['channelID']] = (by_channel.get(row['channelID'], 0)
+                                            + row['messages'])
+            hour = datetime.datetime.fromtimestamp(row['hour'],
+                                                   datetime.timezone.utc)
+            by_hour[(await ut.get_uk_time(hour)).hour] += row['messages']
+
+        name = target.mention if target is not None else ctx.guild.name
+        embed = discord.Embed(title=f"Activity over the last {days} days",
+                              description=f"{sum(by_hour)} messages in {name}",
+                              color=0x009fe3)
+
+        if channel_id is None:
+            busiest = sorted(by_channel.items(), key=lambda item: item[1],
+                             reverse=True)[:5]
+            embed.add_field(name="Busiest channels", inline=False, value="\n".join(
+                f"{channel_name(channel)}: {messages}"
+                for channel, messages in busiest))
+
+        most = max(by_hour)
+        chart = "\n".join(
+            f"{hour:02d}:00 {'#' * round(BAR_WIDTH * messages / most):<{BAR_WIDTH}} {messages}"
+            for hour, messages in enumerate(by_hour))
+        embed.add_field(name="Messages by hour (UK time)", inline=False,
+                        value=f"```\n{chart}\n```")
+
+        await ctx.send(embed=embed)
+
+    @commands.command(
+        name="leaderboard",
+        help="Shows who sent the most messages over the last few days "
+             "(default 7), optionally in one channel")
+    @commands.guild_only()
+    async def leaderboard(self, ctx, days: typing.Optional[int] = 7,
+                          channel: discord.TextChannel = None):
+        days = min(max(days, 1), MAX_DAYS)
+        since = rollups.hour_of(time.time() - days * 86400)
+
+        with ctx.typing():
+            leaders = await db.get_leaderboard(
+                ctx.guild.id, since,
+                channel_id=channel.id if channel is not None else None)
+
+        if not leaders:
+            await ctx.send("No messages have been sent in that time.")
+            return
+
+        where = f" in #{channel.name}" if channel is not None else ""
+        # Mentions in an embed are shown without notifying anyone
+        embed = discord.Embed(
+            title=f"Most messages over the last {days} days{where}",
+            description="\n".join(
+                f"{place}. <@{leader['discordID']}>: {leader['messages']}"
+                for place, leader in enumerate(leaders, start=1)),
+            color=0x009fe3)
+        await ctx.send(embed=embed)
+
+
+def setup(bot):
+    """
+    Add the cog we have made to our bot.
+
+    This function is necessary for every cog file, multiple classes in the
+    same file all need adding and each file must have their own setup function.
+    """
+    bot.add_cog(ActivityCog(bot))
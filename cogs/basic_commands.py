@@ -9,6 +9,9 @@ from discord.ext import commands
 
 import database as db
 import re
+import sharding
+import time
+import utils as ut
 
 # Create a regex for finding id's within messages
 re_message_id = re.compile("\d{18}")
@@ -27,6 +30,31 @@ class BasicCommandsCog(commands.Cog):
     def __init__(self, bot):
         """Save our bot argument that is passed in to the class."""
         self.bot = bot
+        bot.loop.create_task(self.register_welcome_messages())
+
+    async def register_welcome_messages(self):
+        """Routes reactions on every guild's welcome message to the gate."""
+        await self.bot.database_ready.wait()
+        for guild in db.guild_cache.values():
+            if guild is not None and guild['welcomeMessageID']:
+                self.bot.reaction_router.register(
+                    guild['welcomeMessageID'], self.on_welcome_reaction)
+
+    async def on_welcome_reaction(self, payload, message):
+        """
+        Makes members of users who accept the rules on the welcome
+        message, and kicks those who reject them.
+        """
+        await message.remove_reaction(payload.emoji, payload.member)
+        if payload.emoji.name == u"\u2705":
+            registering_id = await db.get_guild_info(payload.guild_id, "registeringID")
+            member_id = await db.get_guild_info(payload.guild_id, "memberID")
+
+            await ut.add_role(payload.member, member_id)
+            await ut.remove_role(payload.member, registering_id)
+
+        elif payload.emoji.name == u"\u274E":
+            await payload.member.guild.kick(payload.member, reason="Rejected T's&C's")
 
     @commands.command(
         name="updateusers",
@@ -40,10 +68,14 @@ class BasicCommandsCog(commands.Cog):
         have the Member role, this is case-sensitive.
         """
         with ctx.typing():
-            for member in ctx.guild.members:
-                await db.add_user(member.id, member.bot, member.name)
+            counts = await db.sync_users(
+                (member.id, member.name)
+                for member in ctx.guild.members if not member.bot)
 
-            await ctx.send("Added all users to database!")
+            await ctx.send(f"Added all users to database! "
+                           f"{counts['inserted']} added, "
+                           f"{counts['updated']} renamed, "
+                           f"{counts['unchanged']} unchanged.")
 
     @commands.command(
         name="setregistering",
@@ -118,12 +150,9 @@ class BasicCommandsCog(commands.Cog):
                                          "```" + content + "```\n"
                                                            "Please react with a thumbs up to confirm.")
 
-        def check(check_reaction, check_user):
-            return check_user == ctx.author and str(check_reaction.emoji) == u"\u1F44D" \
-                   and check_reaction.message == confirm_message
-
         try:
-            reaction, user = await self.bot.wait_for('reaction_add', timeout=60.0, check=check)
+            reaction, user = await self.bot.event_dispatcher.wait_for_reaction(
+                confirm_message.id, ctx.author.id, emojis=(u"👍", ), timeout=60.0)
         except asyncio.TimeoutError:
             await confirm_message.delete()
             await ctx.send('You didn\'t respond in time. '
@@ -135,7 +164,12 @@ class BasicCommandsCog(commands.Cog):
             await message.add_reaction(u"\u2705")
             await message.add_reaction(u"\u274E")
 
+            old_message_id = await db.get_guild_info(ctx.guild.id, "welcomeMessageID")
+            if old_message_id:
+                self.bot.reaction_router.unregister(old_message_id)
+
             await db.set_guild_info(ctx.guild.id, "welcomeMessageID", message.id)
+            self.bot.reaction_router.register(message.id, self.on_welcome_reaction)
 
     @commands.command(
         name="echo",
@@ -153,6 +187,70 @@ class BasicCommandsCog(commands.Cog):
 
         await ctx.send(content)
 
+    @commands.command(
+        name="dbstats",
+        help="Shows the busiest database functions and their query latencies")
+    @commands.has_role("Admin")
+    async def db_stats(self, ctx, limit: int = 10):
+        """
+        Dumps the current database metrics.
+
+        Functions are ordered by the total time spent in their queries,
+        latencies are shown in milliseconds.
+        """
+        stats = db.stats()
+        functions = sorted(
+            stats['queries'].items(),
+            key=lambda item: item[1]['latency']['mean'] * item[1]['queries'],
+            reverse=True)
+
+        lines = [f"{'function':<28}{'calls':>7}{'rows':>8}"
+                 f"{'p50':>7}{'p95':>7}{'p99':>7}{'wait':>7}"]
+        for function, function_stats in functions[:limit]:
+            latency = function_stats['latency']
+            lines.append(
+                f"{function[:27]:<28}{function_stats['calls']:>7}"
+                f"{function_stats['rows']:>8}"
+                f"{latency['p50'] * 1000:>7.1f}{latency['p95'] * 1000:>7.1f}"
+                f"{latency['p99'] * 1000:>7.1f}"
+                f"{function_stats['acquire_wait']['p95'] * 1000:>7.1f}")
+
+        pool = stats['pool']
+        executor = stats['executor']
+        lines.append("")
+        lines.append(f"pool {pool['in_use']}/{pool['size']} in use, "
+                     f"{pool['waiting']} waiting, "
+                     f"executor queue {executor['queue_depth']}, "
+                     f"{executor['timed_out']} timed out, "
+                     f"{len(stats['slow_queries'])} slow queries")
+
+        await ctx.send("```\n" + "\n".join(lines)[:1900] + "\n```")
+
+    @commands.command(
+        name="shards",
+        help="Shows the shards run by the process serving this server, "
+             "and which processes hold the background job leases")
+    @commands.has_role("Admin")
+    async def shard_stats(self, ctx):
+        lines = [f"{'shard':<7}{'latency':>9}{'guilds':>8}{'members':>9}"
+                 f"{'connects':>10}{'resumes':>9}"]
+        for shard_id, shard in self.bot.shard_stats.stats().items():
+            lines.append(
+                f"{shard_id:<7}{shard['latency'] * 1000:>7.0f}ms"
+                f"{shard['guilds']:>8}{shard['members']:>9}"
+                f"{shard['connects']:>10}{shard['resumes']:>9}")
+
+        lines.append("")
+        lines.append(f"this process is {sharding.HOLDER_ID}")
+        now = time.time()
+        for lease in await db.get_leases():
+            expires = lease['expires'] - now
+            state = (f"expires in {expires:.0f}s" if expires > 0
+                     else "expired")
+            lines.append(f"{lease['name']} held by {lease['holder']}, {state}")
+
+        await ctx.send("```\n" + "\n".join(lines)[:1900] + "\n```")
+
     @commands.command(
         name="clear",
         help="Clears messages from the channel")
@@ -14,7 +14,6 @@ from discord.ext import commands
 import database as db
 import utils as ut
 
-# TODO: Change ut.get_confirmation calls to match changes to the coroutine
 
 class JamCog(commands.Cog):
     """Create a class that extends Cog to make our functionality in."""
@@ -49,15 +48,17 @@ class JamCog(commands.Cog):
         This command adds some help text and also required that the user
         have the Member role, this is case-sensitive.
         """
-        result, reason = await ut.get_confirmation(ctx, self.bot, "Please react with a thumbs up to stop jamming. "
-                                                                  "This will also remove you from any team.")
+        result, reason = await ut.get_confirmation(
+            ctx.channel, ctx.author, self.bot,
+            "Please react with a thumbs up to stop jamming. "
+            "This will also remove you from any team.")
 
         print(result, reason)
         if result:
-            ctx.send("You have been removed as a jammer :frowning:")
+            await ctx.send("You have been removed as a jammer :frowning:")
             await db.set_jamming(ctx.author.id, False)
         else:
-            ctx.send("Jam on! :jam_jar:")
+            await ctx.send("Jam on! :jam_jar:")
 
     @commands.command(
         name="createteam",
@@ -72,14 +73,16 @@ class JamCog(commands.Cog):
         user_team = await db.get_user_jam_team(ctx.author.id)
         if len(name) == 0 or len(git) == 0:
             ctx.send("Please pass in both a team name and a git link.")
-        result, reason = await ut.get_confirmation(ctx, self.bot, "Please react with a thumbs up to stop jamming. "
-                                                                  "This will also remove you from any team.")
+        result, reason = await ut.get_confirmation(
+            ctx.channel, ctx.author, self.bot,
+            "Please react with a thumbs up to stop jamming. "
+            "This will also remove you from any team.")
 
         if result:
-            ctx.send("You have been removed as a jammer :frowning:")
+            await ctx.send("You have been removed as a jammer :frowning:")
             await db.set_jamming(ctx.author.id, False)
         else:
-            ctx.send("Jam on! :jam_jar:")
+            await ctx.send("Jam on! :jam_jar:")
 
 
 def setup(bot):
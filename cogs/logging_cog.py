@@ -7,11 +7,262 @@ Also provides a simple base for starting a new cog.
 """
 # In this case, discord import is not needed, in some cases it may be.
 # import discord
+import asyncio
+import os
+import sys
+import traceback
+from collections import OrderedDict
 from discord.ext import commands
 from enum import Enum
 import time
 
+import archive
 import database as db
+import metrics
+import rollups
+import search_index
+import sharding
+import utils as ut
+
+# Maximum number of messages waiting to be written to the log
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))
+# Messages are written once this many are waiting...
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", 200))
+# ...or once the oldest has waited this many seconds
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", 2.0))
+# Seconds a new message may wait for space in a full queue before it is dropped
+LOG_PUT_TIMEOUT = float(os.getenv("LOG_PUT_TIMEOUT", 5.0))
+# Attempts made at writing a batch before it is given up on
+LOG_WRITE_ATTEMPTS = 3
+# Bytes of memory the recently logged messages may take up
+MESSAGE_CACHE_BYTES = int(os.getenv("MESSAGE_CACHE_BYTES", 16 * 1024 * 1024))
+
+
+class CachedMessage:
+    """The parts of a logged message needed to log its edits and deletion."""
+
+    __slots__ = ('author_id', 'content')
+
+    def __init__(self, author_id, content):
+        self.author_id = author_id
+        self.content = content
+
+
+# Rough bytes taken by a CachedMessage, its IDs and its place in the cache,
+# besides its content
+CACHED_MESSAGE_OVERHEAD = 240
+
+
+class RecentMessageCache:
+    """
+    The most recently logged messages, keyed by message ID.
+
+    Holds as many messages as fit in `max_bytes`, evicting the least
+    recently used first, so edits and deletions of recent messages
+    can be logged without reading the message log back. Cached messages
+    are never changed in place, as their size is counted when put.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._messages = OrderedDict()
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _size(message):
+        return CACHED_MESSAGE_OVERHEAD + sys.getsizeof(message.content or "")
+
+    def put(self, message_id, message):
+        self.pop(message_id)
+        self._messages[message_id] = message
+        self.size += self._size(message)
+
+        while self.size > self.max_bytes and self._messages:
+            _, evicted = self._messages.popitem(last=False)
+            self.size -= self._size(evicted)
+            self.evictions += 1
+
+    def get(self, message_id):
+        message = self._messages.get(message_id)
+        if message is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._messages.move_to_end(message_id)
+        return message
+
+    def get_many(self, message_ids):
+        """Returns a dict of the cached messages, and a list of the IDs missed."""
+        found = {}
+        missing = []
+        for message_id in message_ids:
+            message = self.get(message_id)
+            if message is None:
+                missing.append(message_id)
+            else:
+                found[message_id] = message
+        return found, missing
+
+    def pop(self, message_id):
+        message = self._messages.pop(message_id, None)
+        if message is not None:
+            self.size -= self._size(message)
+        return message
+
+    def __len__(self):
+        return len(self._messages)
+
+    def stats(self):
+        return {
+            'size': len(self._messages),
+            'bytes': self.size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class MessageLogWriter:
+    """
+    Buffers logged messages in memory and writes them to the
+    database in batches from a background task.
+
+    Producers wait when the queue is full, and messages that still can't
+    be queued after `put_timeout` seconds are dropped and counted.
+    Batches are written with `write`, and passed on to `on_written` once
+    they have been. Nothing is written until `wait_until_ready` returns,
+    messages are queued until then.
+    """
+
+    def __init__(self, max_size, batch_size, flush_interval, put_timeout,
+                 on_written=None, write=db.log_messages):
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.on_written = on_written
+        self.write = write
+
+        self._queue = None
+        self._batch_ready = None
+        self._task = None
+        # Batch taken from the queue, until it is written or given up on
+        self._batch = None
+
+        self.queued = 0
+        self.written = 0
+        self.batches = 0
+        self.overflowed = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def start(self, loop, wait_until_ready=None):
+        self._queue = asyncio.Queue(maxsize=self.max_size)
+        self._batch_ready = asyncio.Event()
+        self._task = loop.create_task(self._run(wait_until_ready))
+
+    async def put(self, row):
+        if self._queue.full():
+            self.overflowed += 1
+            try:
+                await asyncio.wait_for(self._queue.put(row), self.put_timeout)
+            except asyncio.TimeoutError:
+                self.dropped += 1
+                return False
+        else:
+            self._queue.put_nowait(row)
+
+        self.queued += 1
+        # The flusher holds one message while it waits for the rest
+        if self._queue.qsize() + 1 >= self.batch_size:
+            self._batch_ready.set()
+        return True
+
+    def _take_batch(self, first=None):
+        batch = [] if first is None else [first]
+        while len(batch) < self.batch_size and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    async def _write(self, batch, attempts=LOG_WRITE_ATTEMPTS):
+        for attempt in range(attempts):
+            try:
+                await self.write(batch)
+            except Exception:
+                traceback.print_exc()
+                if attempt + 1 < attempts:
+                    await asyncio.sleep(2 ** attempt)
+            else:
+                self._batch = None
+                self.written += len(batch)
+                self.batches += 1
+                if self.on_written is not None:
+                    try:
+                        await self.on_written(batch)
+                    except Exception:
+                        traceback.print_exc()
+                return
+
+        self._batch = None
+        self.failed += len(batch)
+        ut.log_info(f"Failed to write {len(batch)} messages to the log")
+
+    async def _run(self, wait_until_ready):
+        if wait_until_ready is not None:
+            await wait_until_ready()
+
+        while True:
+            # Waits idle until there is something to write
+            first = await self._queue.get()
+            self._batch = [first]
+
+            if self._queue.qsize() + 1 < self.batch_size:
+                self._batch_ready.clear()
+                try:
+                    await asyncio.wait_for(self._batch_ready.wait(),
+                                           self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+            self._batch = self._take_batch(first)
+            await self._write(self._batch)
+
+    async def close(self):
+        """Stops the background task and writes out everything still queued."""
+        if self._task is None:
+            return
+
+        # The task may already have been cancelled, as discord.py cancels
+        # every task when the bot is stopped by a signal
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+        # Including the batch the task had taken, if it wasn't written
+        if self._batch:
+            await self._write(self._batch, attempts=1)
+        while not self._queue.empty():
+            await self._write(self._take_batch(), attempts=1)
+
+    def stats(self):
+        return {
+            'queue_depth': self._queue.qsize() if self._queue else 0,
+            'queued': self.queued,
+            'written': self.written,
+            'batches': self.batches,
+            'overflowed': self.overflowed,
+            'dropped': self.dropped,
+            'failed': self.failed,
+        }
 
 
 class LoggingCog(commands.Cog):
@@ -20,43 +271,160 @@ class LoggingCog(commands.Cog):
     def __init__(self, bot):
         """Save our bot argument that is passed in to the class."""
         self.bot = bot
+        # Written messages are also added to the $search index
+        self.writer = MessageLogWriter(
+            LOG_QUEUE_SIZE, LOG_BATCH_SIZE, LOG_FLUSH_INTERVAL,
+            LOG_PUT_TIMEOUT, search_index.message_index.add_messages)
+        # Writers wait until the migrations have been applied, since rows
+        # are written with the columns the latest migrations add
+        self.writer.start(bot.loop, bot.database_ready.wait)
+
+        self.recent_messages = RecentMessageCache(MESSAGE_CACHE_BYTES)
+        self.event_writer = MessageLogWriter(
+            LOG_QUEUE_SIZE, LOG_BATCH_SIZE, LOG_FLUSH_INTERVAL,
+            LOG_PUT_TIMEOUT, write=db.log_message_events)
+        self.event_writer.start(bot.loop, bot.database_ready.wait)
+
+        self.activity = rollups.ActivityRollup(rollups.ACTIVITY_FLUSH_INTERVAL)
+        self.activity.start(bot.loop, bot.database_ready.wait)
+
+        self.archiver = None
+        self.archive_leader = None
+        if archive.ARCHIVE_AFTER_DAYS > 0:
+            # Only one of the bot's processes archives at a time
+            self.archive_leader = sharding.LeaderElection("archiver")
+            self.archiver = archive.MessageArchiver(
+                archive.MessageArchive(), archive.ARCHIVE_AFTER_DAYS,
+                archive.ARCHIVE_BATCH_SIZE, archive.ARCHIVE_INTERVAL,
+                leader=self.archive_leader)
+            # Both wait until the migrations have been applied
+            self.archive_leader.start(bot.loop, bot.database_ready.wait)
+            self.archiver.start(bot.loop, bot.database_ready.wait)
+
+        self.register_metrics(metrics.registry)
+
+    def register_metrics(self, registry):
+        writer_counters = ('queued', 'written', 'batches', 'overflowed',
+                           'dropped', 'failed')
+        registry.register_stats("bot_log_writer", self.writer.stats,
+                                counters=writer_counters,
+                                labels={'writer': "messages"})
+        registry.register_stats("bot_log_writer", self.event_writer.stats,
+                                counters=writer_counters,
+                                labels={'writer': "events"})
+        registry.register_stats("bot_cache", self.recent_messages.stats,
+                                counters=('hits', 'misses', 'evictions'),
+                                labels={'cache': "recent_messages"})
+        registry.register_stats("bot_activity_rollup", self.activity.stats,
+                                counters=('counted', 'flushes', 'failures'))
+        if self.archiver is not None:
+            registry.register_stats(
+                "bot_archiver", self.archiver.stats,
+                counters=('runs', 'skipped', 'archived', 'failures'))
+
+    def cog_unload(self):
+        self.bot.loop.create_task(self.shutdown())
+
+    async def shutdown(self):
+        """Called by the bot as it closes, so no queued messages are lost."""
+        if self.archiver is not None:
+            await self.archiver.close()
+            await self.archive_leader.close()
+        await self.writer.close()
+        await self.event_writer.close()
+        await self.activity.close()
+        await search_index.message_index.close()
 
     @commands.Cog.listener('on_message')
     async def log_message_add(self, message):
         if message.author.bot:
             return
-        await db.log_message(message.author.id, message.id,
-                             message.content.encode('unicode-escape'), int(time.time()))
+        now = int(time.time())
+        guild_id = message.guild.id if message.guild is not None else None
+        self.recent_messages.put(message.id, CachedMessage(
+            message.author.id, message.content))
+        if guild_id is not None:
+            self.activity.add(guild_id, message.channel.id,
+                              message.author.id, now)
+        await self.writer.put((message.author.id, message.id,
+                               message.content, now,
+                               message.channel.id, guild_id))
+
+    async def get_logged_messages(self, message_ids):
+        """
+        Returns the logged messages with the given IDs, from the cache where
+        possible, and reading the rest from the log in one query.
+        """
+        found, missing = self.recent_messages.get_many(message_ids)
+        if missing:
+            logged = await db.get_logged_messages(missing)
+            for message_id, row in logged.items():
+                found[message_id] = CachedMessage(row['discordID'],
+                                                  row['content'])
+        return found
+
+    async def log_deletions(self, message_ids, channel_id):
+        now = int(time.time())
+        for message_id, message in (await self.get_logged_messages(message_ids)).items():
+            self.recent_messages.pop(message_id)
+            await self.event_writer.put((message.author_id, message_id,
+                                         channel_id, "delete", None, now))
 
     @commands.Cog.listener('on_message_delete')
     async def on_message_delete(self, message):
-        # TODO Implement
+        # Handled by on_raw_message_delete, which also fires for
+        # messages discord.py hasn't cached
         pass
 
     @commands.Cog.listener('on_bulk_message_delete')
     async def on_bulk_message_delete(self, messages):
-        # TODO Implement
+        # Handled by on_raw_bulk_message_delete
         pass
 
     @commands.Cog.listener('on_raw_message_delete')
     async def on_raw_message_delete(self, payload):
-        # TODO Implement
-        pass
+        # Bot messages are never logged, so aren't looked up either
+        if payload.cached_message is not None \
+                and payload.cached_message.author.bot:
+            return
+        await self.log_deletions([payload.message_id], payload.channel_id)
 
     @commands.Cog.listener('on_raw_bulk_message_delete')
     async def on_raw_bulk_message_delete(self, payload):
-        # TODO Implement
-        pass
+        bot_messages = {message.id for message in payload.cached_messages
+                        if message.author.bot}
+        message_ids = [message_id for message_id in payload.message_ids
+                       if message_id not in bot_messages]
+        if message_ids:
+            await self.log_deletions(message_ids, payload.channel_id)
 
     @commands.Cog.listener('on_message_edit')
     async def on_message_edit(self, before, after):
-        # TODO Implement
+        # Handled by on_raw_message_edit, which also fires for
+        # messages discord.py hasn't cached
         pass
 
     @commands.Cog.listener('on_raw_message_edit')
     async def on_raw_message_edit(self, payload):
-        # TODO Implement
-        pass
+        # Embeds being added to a message also fire edits, without content
+        content = payload.data.get('content')
+        if content is None:
+            return
+        # Bot messages, like refreshed polls, are never logged
+        if payload.data.get('author', {}).get('bot'):
+            return
+
+        message = (await self.get_logged_messages([payload.message_id])).get(
+            payload.message_id)
+        if message is None or message.content == content:
+            return
+
+        diff = ut.text_diff(message.content or "", content)
+        self.recent_messages.put(payload.message_id,
+                                 CachedMessage(message.author_id, content))
+        await self.event_writer.put((message.author_id, payload.message_id,
+                                     payload.channel_id, "edit", diff,
+                                     int(time.time())))
 
     @commands.Cog.listener('on_guild_channel_delete')
     async def on_bulk_message_delete(self, channel):
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Cog for monitoring the bot.
+
+Serves every metric in `metrics.registry` over HTTP at /metrics, in the
+Prometheus text format, from the bot's own event loop.
+"""
+
+import asyncio
+import os
+import time
+
+from aiohttp import web
+from discord.ext import commands
+
+import metrics
+import utils as ut
+
+# Address the metrics endpoint listens on
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+# Port the metrics endpoint listens on, 0 disables it
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9400))
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class MonitoringCog(commands.Cog):
+    """Counts gateway events and commands, and serves the bot's metrics."""
+
+    def __init__(self, bot):
+        """Save our bot argument that is passed in to the class."""
+        self.bot = bot
+        self.runner = None
+
+        registry = metrics.registry
+        self.events = registry.counter(
+            "bot_gateway_events_total", "Gateway events received by type",
+            ('event', ))
+        self.commands = registry.counter(
+            "bot_commands_total", "Commands run by cog, command and outcome",
+            ('cog', 'command', 'outcome'))
+        self.command_latency = registry.histogram(
+            "bot_command_seconds", "Time taken to run commands",
+            ('cog', 'command'))
+
+        registry.register("bot_gateway_latency_seconds",
+                          "Gateway heartbeat latency", lambda: bot.latency)
+        registry.register("bot_pending_tasks",
+                          "Tasks scheduled on the event loop",
+                          lambda: len(asyncio.all_tasks(bot.loop)))
+        registry.register("bot_guilds", "Guilds the bot is in",
+                          lambda: len(bot.guilds))
+        registry.register("bot_cache_size", "Size",
+                          lambda: len(bot.cached_messages),
+                          labels={'cache': "discord_messages"})
+        registry.register("bot_cache_size", "Size", lambda: len(bot.users),
+                          labels={'cache': "discord_users"})
+
+        if METRICS_PORT:
+            bot.loop.create_task(self.start_server())
+
+    async def start_server(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self.serve_metrics)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+
+        try:
+            await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+        except OSError as error:
+            ut.log_info(f"Couldn't serve metrics on port {METRICS_PORT}: {error}")
+            await runner.cleanup()
+            return
+
+        self.runner = runner
+        ut.log_info(f"Serving metrics at http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+    async def serve_metrics(self, request):
+        return web.Response(body=metrics.registry.render().encode(),
+                            headers={'Content-Type': CONTENT_TYPE})
+
+    def cog_unload(self):
+        self.bot.loop.create_task(self.shutdown())
+
+    async def shutdown(self):
+        """Called by the bot as it closes, to stop serving metrics."""
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    @commands.Cog.listener()
+    async def on_socket_response(self, message):
+        # Only dispatches carry an event, the rest are heartbeats and the like
+        if message.get('op') == 0:
+            self.events.inc(message.get('t'))
+
+    @commands.Cog.listener()
+    async def on_command(self, ctx):
+        ctx.command_started = time.perf_counter()
+
+    @commands.Cog.listener()
+    async def on_command_completion(self, ctx):
+        self.record_command(ctx, "ok")
+
+    @commands.Cog.listener()
+    async def on_command_error(self, ctx, error):
+        # Unknown commands aren't worth a label each
+        if ctx.command is not None:
+            self.record_command(ctx, "error")
+
+    def record_command(self, ctx, outcome):
+        cog = ctx.cog.qualified_name if ctx.cog is not None else ""
+        command = ctx.command.qualified_name
+        self.commands.inc(cog, command, outcome)
+
+        started = getattr(ctx, "command_started", None)
+        if started is not None:
+            self.command_latency.labels(cog, command).observe(
+                time.perf_counter() - started)
+
+
+def setup(bot):
+    """
+    Add the cog we have made to our bot.
+
+    This function is necessary for every cog file, multiple classes in the
+    same file all need adding and each file must have their own setup function.
+    """
+    bot.add_cog(MonitoringCog(bot))
@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Cog for welcoming new members.
+
+Joins are queued and worked through by a fixed number of workers, so a
+cohort joining at once is welcomed at a pace Discord's rate limits allow,
+instead of all at once.
+"""
+
+import asyncio
+import os
+import time
+import traceback
+
+import discord
+from discord.ext import commands
+
+import database as db
+import metrics
+import utils as ut
+
+# Number of members welcomed at the same time
+ONBOARDING_WORKERS = int(os.getenv("ONBOARDING_WORKERS", 4))
+# Maximum number of members waiting to be welcomed
+ONBOARDING_QUEUE_SIZE = int(os.getenv("ONBOARDING_QUEUE_SIZE", 1000))
+# Welcome DMs sent per second, across every guild
+ONBOARDING_DM_RATE = float(os.getenv("ONBOARDING_DM_RATE", 1.0))
+# Roles granted per second in each guild
+ONBOARDING_ROLE_RATE = float(os.getenv("ONBOARDING_ROLE_RATE", 5.0))
+# Requests that may be made at once before the rates above apply
+ONBOARDING_BURST = int(os.getenv("ONBOARDING_BURST", 5))
+# New members are added to the database in batches of this many...
+ONBOARDING_BATCH_SIZE = int(os.getenv("ONBOARDING_BATCH_SIZE", 100))
+# ...or once the oldest has waited this many seconds
+ONBOARDING_FLUSH_INTERVAL = float(os.getenv("ONBOARDING_FLUSH_INTERVAL", 2.0))
+# Attempts made at sending a DM, granting a role or adding a member to
+# the database before giving up
+ONBOARDING_ATTEMPTS = 4
+# Longest wait between attempts at adding members to the database
+MAX_WRITE_DELAY = 60
+
+WELCOME_MESSAGE = (
+    'Hey {name}, welcome to the University of Sheffield Computer '
+    'Science Freshers Discord!\n'
+    'We like to know who we\'re talking to, so please change your '
+    'nickname on the server to include your real name in some way.\n'
+    'Apart from that, have fun on the server, get to know people and '
+    'feel free to ask any questions about the course that you may have, '
+    'we\'re all here to help each other!\n'
+    'Many thanks,\n'
+    'The Discord Server Admin Team'
+)
+
+
+class TokenBucket:
+    """
+    Allows `rate` requests a second on average, and up to `capacity`
+    at once after a quiet period.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.capacity,
+                               self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+def has_role(member, role_id):
+    return any(str(role.id) == str(role_id) for role in member.roles)
+
+
+def is_retryable(error):
+    # Closed DMs and missing permissions won't fix themselves
+    if isinstance(error, (discord.Forbidden, discord.NotFound)):
+        return False
+    if isinstance(error, discord.HTTPException):
+        return error.status == 429 or error.status >= 500
+    return isinstance(error, (asyncio.TimeoutError, OSError))
+
+
+class OnboardingQueue:
+    """
+    Welcomes queued members with a fixed pool of workers.
+
+    Each request goes through the token bucket for its route, DMs share
+    one bucket and role grants have one per guild. Requests that fail
+    for a temporary reason are retried with exponential backoff. New
+    members are written to the database in batches.
+    """
+
+    def __init__(self, workers, max_size, dm_rate, role_rate, burst,
+                 batch_size, flush_interval):
+        self.workers = workers
+        self.max_size = max_size
+        self.role_rate = role_rate
+        self.burst = burst
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self._queue = None
+        self._tasks = []
+        self._dm_bucket = TokenBucket(dm_rate, burst)
+        self._role_buckets = {}
+        self._users = {}
+        self._users_ready = None
+        # Failed attempts at adding each waiting member to the database
+        self._user_attempts = {}
+
+        self.time_to_onboard = metrics.Histogram()
+        self.queued = 0
+        self.overflowed = 0
+        self.onboarded = 0
+        self.retries = 0
+        self.failed_dms = 0
+        self.failed_roles = 0
+        self.failed_users = 0
+        self.dropped = 0
+
+    def start(self, loop, wait_until_ready=None):
+        self._queue = asyncio.Queue(maxsize=self.max_size)
+        self._users_ready = asyncio.Event()
+        self._tasks = [loop.create_task(self._work(wait_until_ready))
+                       for _ in range(self.workers)]
+        self._tasks.append(loop.create_task(
+            self._flush_users(wait_until_ready)))
+
+    async def put(self, member):
+        if not member.bot:
+            self._users[member.id] = member.name
+            if len(self._users) >= self.batch_size:
+                self._users_ready.set()
+
+        if self._queue.full():
+            self.overflowed += 1
+        # Waits for space rather than dropping anyone
+        await self._queue.put((member, time.monotonic()))
+        self.queued += 1
+
+    def _role_bucket(self, guild_id):
+        bucket = self._role_buckets.get(guild_id)
+        if bucket is None:
+            bucket = self._role_buckets[guild_id] = TokenBucket(
+                self.role_rate, self.burst)
+        return bucket
+
+    async def _attempt(self, bucket, func, *args):
+        """Calls `func` until it succeeds, returns whether it did."""
+        for attempt in range(ONBOARDING_ATTEMPTS):
+            await bucket.acquire()
+            try:
+                await func(*args)
+                return True
+            except Exception as error:
+                if not is_retryable(error) or attempt + 1 == ONBOARDING_ATTEMPTS:
+                    ut.log_info(f"Onboarding request failed with {error!r}")
+                    return False
+                self.retries += 1
+                await asyncio.sleep(2 ** attempt)
+
+    async def _send_welcome(self, member):
+        channel = member.dm_channel or await member.create_dm()
+        await channel.send(WELCOME_MESSAGE.format(name=member.name))
+
+    async def _grant_registering(self, member, role_id, member_role_id):
+        # Members who have got through the welcome gate while waiting
+        # aren't sent back to registering
+        if member_role_id and has_role(member, member_role_id):
+            return
+        await ut.add_role(member, role_id)
+
+    async def _onboard(self, member):
+        # The role is granted before the DM, as DMs wait on a bucket
+        # shared by every guild
+        role_id = await db.get_guild_info(member.guild.id, "registeringID")
+        member_role_id = await db.get_guild_info(member.guild.id, "memberID")
+        if role_id and not await self._attempt(
+                self._role_bucket(member.guild.id), self._grant_registering,
+                member, role_id, member_role_id):
+            self.failed_roles += 1
+
+        if not await self._attempt(self._dm_bucket, self._send_welcome, member):
+            self.failed_dms += 1
+
+    async def _work(self, wait_until_ready):
+        # Each guild's roles are looked up in the database
+        if wait_until_ready is not None:
+            await wait_until_ready()
+
+        while True:
+            member, joined = await self._queue.get()
+            try:
+                await self._onboard(member)
+                self.onboarded += 1
+                self.time_to_onboard.observe(time.monotonic() - joined)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self._queue.task_done()
+
+    async def _write_users(self):
+        """Adds the waiting members to the database, returns whether it did."""
+        if not self._users:
+            return True
+
+        users, self._users = self._users, {}
+        try:
+            await db.sync_users(users.items())
+        except Exception:
+            traceback.print_exc()
+            # Tried again with the next batch, unless tried too often already
+            given_up = 0
+            for discord_id, name in users.items():
+                attempts = self._user_attempts.pop(discord_id, 0) + 1
+                if attempts < ONBOARDING_ATTEMPTS:
+                    self._user_attempts[discord_id] = attempts
+                    self._users.setdefault(discord_id, name)
+                else:
+                    given_up += 1
+
+            if given_up:
+                self.failed_users += given_up
+                ut.log_info(f"Gave up adding {given_up} new members "
+                            f"to the database")
+            return False
+
+        for discord_id in users:
+            self._user_attempts.pop(discord_id, None)
+        return True
+
+    async def _flush_users(self, wait_until_ready):
+        if wait_until_ready is not None:
+            await wait_until_ready()
+
+        retry_delay = 1
+        while True:
+            try:
+                await asyncio.wait_for(self._users_ready.wait(),
+                                       self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._users_ready.clear()
+
+            if await self._write_users():
+                retry_delay = 1
+            else:
+                # Backs off while the database keeps failing
+                await asyncio.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, MAX_WRITE_DELAY)
+
+    async def close(self):
+        """Stops the workers, and writes out the members not yet added."""
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+
+        # Members still queued are welcomed by nobody, so are counted
+        dropped = self._queue.qsize()
+        if dropped:
+            self.dropped += dropped
+            ut.log_info(f"Stopped with {dropped} joined members not welcomed")
+
+        await self._write_users()
+
+    def stats(self):
+        return {
+            'queue_depth': self._queue.qsize() if self._queue else 0,
+            'queued': self.queued,
+            'overflowed': self.overflowed,
+            'onboarded': self.onboarded,
+            'retries': self.retries,
+            'failed_dms': self.failed_dms,
+            'failed_roles': self.failed_roles,
+            'failed_users': self.failed_users,
+            'dropped': self.dropped,
+            'pending_users': len(self._users),
+            'time_to_onboard': self.time_to_onboard.stats(),
+        }
+
+
+class OnboardingCog(commands.Cog):
+    """Welcomes new members to the server."""
+
+    def __init__(self, bot):
+        """Save our bot argument that is passed in to the class."""
+        self.bot = bot
+        self.onboarding = OnboardingQueue(
+            ONBOARDING_WORKERS, ONBOARDING_QUEUE_SIZE, ONBOARDING_DM_RATE,
+            ONBOARDING_ROLE_RATE, ONBOARDING_BURST, ONBOARDING_BATCH_SIZE,
+            ONBOARDING_FLUSH_INTERVAL)
+        self.onboarding.start(bot.loop, bot.database_ready.wait)
+
+        metrics.registry.register_stats(
+            "bot_onboarding", self.onboarding.stats,
+            counters=('queued', 'overflowed', 'onboarded', 'retries',
+                      'failed_dms', 'failed_roles', 'failed_users',
+                      'dropped'))
+        metrics.registry.register(
+            "bot_onboarding_seconds",
+            "Time from a member joining to being welcomed",
+            lambda: self.onboarding.time_to_onboard, "histogram")
+
+    def cog_unload(self):
+        self.bot.loop.create_task(self.onboarding.close())
+
+    async def shutdown(self):
+        """Called by the bot as it closes, so joined members are still added."""
+        await self.onboarding.close()
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member):
+        """Send user a welcome message, and give them the registering role."""
+        await self.onboarding.put(member)
+
+    @commands.command(
+        name="onboarding",
+        help="Shows how quickly new members are being welcomed")
+    @commands.has_role("Admin")
+    async def onboarding_stats(self, ctx):
+        stats = self.onboarding.stats()
+        timings = stats['time_to_onboard']
+        await ctx.send(
+            f"{stats['queue_depth']} members waiting, "
+            f"{stats['onboarded']} welcomed. Time to welcome: "
+            f"p50 {timings['p50']:.1f}s, p95 {timings['p95']:.1f}s, "
+            f"p99 {timings['p99']:.1f}s. "
+            f"{stats['retries']} retries, {stats['failed_dms']} DMs and "
+            f"{stats['failed_roles']} roles failed.")
+
+
+def setup(bot):
+    """
+    Add the cog we have made to our bot.
+
+    This function is necessary for every cog file, multiple classes in the
+    same file all need adding and each file must have their own setup function.
+    """
+    bot.add_cog(OnboardingCog(bot))
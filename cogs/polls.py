@@ -9,14 +9,18 @@ Author: William Lee
 
 import asyncio
 import datetime
+import heapq
+import os
 import re
 import time
 import traceback
 
 import discord
-from discord.ext import commands, tasks
+from discord.ext import commands
 
 import database as db
+import metrics
+import sharding
 import utils as ut
 
 # Regex from extracting time from format 00h00m00s
@@ -24,6 +28,136 @@ DURATION_REGEX = re.compile(
     r"((?P<days>\d+?)d)?((?P<hours>\d+?)h)?"
     r"((?P<minutes>\d+?)m)?((?P<seconds>\d+?)s)?")
 
+# Minimum number of seconds between edits of the same poll message
+POLL_REFRESH_INTERVAL = float(os.getenv("POLL_REFRESH_INTERVAL", 2.0))
+# Longest wait between attempts at loading the ongoing polls, or at
+# ending a poll
+MAX_RETRY_DELAY = 60
+
+
+class PollScheduler:
+    """
+    Keeps ongoing polls in a min-heap keyed on their end date,
+    and sleeps until the earliest one is due.
+
+    Rescheduling a poll pushes a new entry, the old entry is
+    skipped when it reaches the top of the heap.
+    """
+
+    def __init__(self, on_due):
+        self._on_due = on_due
+        self._heap = []
+        # Current end date of every scheduled poll
+        self._end_dates = {}
+        # Failed attempts at ending each poll, for backing off
+        self._failures = {}
+        self._wakeup = asyncio.Event()
+
+    def schedule(self, poll_id, end_date):
+        self._end_dates[poll_id] = end_date
+        heapq.heappush(self._heap, (end_date, poll_id))
+
+        # Only wakes the scheduler if the next deadline has moved
+        if self._heap[0] == (end_date, poll_id):
+            self._wakeup.set()
+
+    def cancel(self, poll_id):
+        self._end_dates.pop(poll_id, None)
+        self._failures.pop(poll_id, None)
+
+    def _drop_stale(self):
+        while self._heap:
+            end_date, poll_id = self._heap[0]
+            if self._end_dates.get(poll_id) == end_date:
+                return
+            heapq.heappop(self._heap)
+
+    async def run(self):
+        while True:
+            self._drop_stale()
+            self._wakeup.clear()
+
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+
+            end_date, poll_id = self._heap[0]
+            delay = end_date - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self._heap)
+            del self._end_dates[poll_id]
+            try:
+                await self._on_due(poll_id)
+                self._failures.pop(poll_id, None)
+            except Exception:
+                traceback.print_exc()
+                # Tried again later, unless it was rescheduled meanwhile
+                failures = self._failures.get(poll_id, 0) + 1
+                self._failures[poll_id] = failures
+                if poll_id not in self._end_dates:
+                    delay = min(2 ** failures, MAX_RETRY_DELAY)
+                    ut.log_info(f"Couldn't end poll {poll_id}, "
+                                f"retrying in {delay}s")
+                    self.schedule(poll_id, time.time() + delay)
+
+    def __len__(self):
+        return len(self._end_dates)
+
+
+class PollRefresher:
+    """
+    Coalesces requests to redraw a poll's results, so that each poll
+    is refreshed at most once every `interval` seconds.
+    """
+
+    def __init__(self, refresh, interval):
+        self._refresh = refresh
+        self.interval = interval
+        # Loop time each poll was last refreshed at
+        self._last_refreshed = {}
+        self._pending = set()
+        # Refreshes that are running, kept so they aren't garbage collected
+        self._tasks = set()
+
+        self.requested = 0
+        self.coalesced = 0
+
+    def mark_dirty(self, poll_id):
+        self.requested += 1
+        if poll_id in self._pending:
+            self.coalesced += 1
+            return
+
+        loop = asyncio.get_event_loop()
+        last = self._last_refreshed.get(poll_id)
+        delay = 0 if last is None else max(0, last + self.interval - loop.time())
+
+        self._pending.add(poll_id)
+        loop.call_later(delay, self._start, poll_id)
+
+    def _start(self, poll_id):
+        task = asyncio.get_event_loop().create_task(self._run(poll_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def forget(self, poll_id):
+        self._last_refreshed.pop(poll_id, None)
+
+    async def _run(self, poll_id):
+        # Changes made from here on are picked up by the next refresh
+        self._pending.discard(poll_id)
+        self._last_refreshed[poll_id] = asyncio.get_event_loop().time()
+        try:
+            await self._refresh(poll_id)
+        except Exception:
+            traceback.print_exc()
+
 
 class PollsCog(commands.Cog, name="Polls"):
     """Class for polls cog"""
@@ -31,7 +165,22 @@ class PollsCog(commands.Cog, name="Polls"):
     def __init__(self, bot):
         """Save our bot argument that is passed in to the class."""
         self.bot = bot
-        self.poll_daemon.start()
+        self.scheduler = PollScheduler(self.on_poll_due)
+        self.refresher = PollRefresher(self.refresh_poll,
+                                       POLL_REFRESH_INTERVAL)
+        # Hash of the results each poll message was last edited to show
+        self.rendered_hashes = {}
+        self.edits_performed = 0
+        self.edits_skipped = 0
+        self.scheduler_task = bot.loop.create_task(self.run_scheduler())
+
+        metrics.registry.register_stats(
+            "bot_polls", self.stats,
+            counters=('refreshes_requested', 'refreshes_coalesced',
+                      'edits_performed', 'edits_skipped'))
+
+    def cog_unload(self):
+        self.scheduler_task.cancel()
 
     async def parse_time_as_delta(self, time: str):
         """
@@ -54,13 +203,6 @@ class PollsCog(commands.Cog, name="Polls"):
             return datetime.timedelta(**values_dict)
 
     async def check_add_new_choice(self, poll, message, response):
-        # Checks an edited message against a given message
-        def get_message_edit_check(message):
-            def check(_, m):
-                return m.id == message.id
-
-            return check
-
         # Splits the message into emoji and text
         values = response.content.split(maxsplit=1)
 
@@ -86,11 +228,9 @@ class PollsCog(commands.Cog, name="Polls"):
             error_prompt = await message.channel.send(
                 f"{error_msg} You may edit your original message.")
 
-            check = get_message_edit_check(response)
-
             try:
-                _, new_response = await self.bot.wait_for(
-                    'message_edit', check=check, timeout=30.0)
+                _, new_response = await self.bot.event_dispatcher.wait_for_edit(
+                    response.id, timeout=30.0)
             except asyncio.TimeoutError:
                 await response.delete()
                 await error_prompt.delete()
@@ -100,21 +240,17 @@ class PollsCog(commands.Cog, name="Polls"):
         else:
             await response.delete()
             await db.add_poll_choice(int(poll['ID']), reaction, text)
+            self.refresher.mark_dirty(int(poll['ID']))
 
     async def get_new_choice_from_user(self, poll, message, user):
-
-        # Checks that the author of the message
-        # is the one that wants to add a new choice
-        def author_check(m):
-            return m.author == user
-
         prompt_msg = await message.channel.send(
             "Send a message for the choice in the format `<emoji> <text>`, "
             "e.g. :heart: Red Heart")
 
         try:
-            response = await self.bot.wait_for('message', check=author_check,
-                                               timeout=30.0)
+            # Only the user that wants to add a new choice can answer
+            response = await self.bot.event_dispatcher.wait_for_message(
+                message.channel.id, user.id, timeout=30.0)
         except asyncio.TimeoutError:
             pass
         else:
@@ -140,6 +276,7 @@ class PollsCog(commands.Cog, name="Polls"):
         if result:
             # The message containing the poll is deleted
             await message.delete()
+            self.bot.reaction_router.unregister(message.id)
             # Poll is also ended
             await self.end_poll(poll)
 
@@ -147,26 +284,36 @@ class PollsCog(commands.Cog, name="Polls"):
 
     async def toggle_poll_response(self, poll, user_id, reaction, message):
 
-        has_response = await db.user_has_response(
+        has_response = await db.toggle_poll_response(
             user_id, poll['ID'], reaction)
 
         if has_response is None:
             return
 
-        if has_response:
-            result, reason = await db.user_remove_response(
-                user_id, poll['ID'], reaction)
-        else:
-            result, reason = await db.user_add_response(
-                user_id, poll['ID'], reaction)
-
-        return result
+        self.refresher.mark_dirty(int(poll['ID']))
+        return True
 
-    async def end_poll(self, poll):
+    async def end_poll(self, poll, draw_results=False):
+        """
+        Closes off the poll, then updates its message. The poll has ended
+        even if its message can't be updated, say because its channel has
+        been deleted or the bot can no longer edit it.
+        """
         poll_id = int(poll['ID'])
-        channel = self.bot.get_channel(int(poll['channelID']))
-
         await db.end_poll(poll_id)
+        self.scheduler.cancel(poll_id)
+        self.refresher.forget(poll_id)
+
+        try:
+            if draw_results:
+                await self.update_response_counts(poll)
+            await self.show_poll_ended(poll)
+        except Exception:
+            traceback.print_exc()
+        self.rendered_hashes.pop(poll_id, None)
+
+    async def show_poll_ended(self, poll):
+        channel = self.bot.get_channel(int(poll['channelID']))
 
         # If the message has been deleted
         try:
@@ -201,25 +348,57 @@ class PollsCog(commands.Cog, name="Polls"):
 
         # Brings forward the end date for the poll to current time
         #
-        # The poll will end the poll on its next iteration
+        # The scheduler is woken up and ends the poll straight away
         if result:
-            await db.change_poll_end_date(
-                poll['ID'], int((await ut.get_utc_time()).timestamp()))
+            end_date = int((await ut.get_utc_time()).timestamp())
+            await db.change_poll_end_date(poll['ID'], end_date)
+            self.scheduler.schedule(int(poll['ID']), end_date)
+
+    async def refresh_poll(self, poll_id):
+        poll = await db.get_poll_by_id(poll_id)
+        if poll:
+            await self.update_response_counts(poll)
 
     async def update_response_counts(self, poll):
 
-        def key(choice):
+        def key(field):
             try:
                 # Returns the index of the choice's emoji
                 # in the list of emojis in the message reactions
-                return emojis.index(choice['reaction'])
+                return emojis.index(field[0])
             except ValueError:
                 # If emoji isn't found, then return the length
                 # of the choices list
                 #
                 # This guarantees that the choice are displayed at the end
                 # of the list (along with the others that are not found)
-                return len(choices)
+                return len(fields)
+
+        user_limit = 3
+
+        choices = await db.get_poll_tally(poll['ID'], voter_limit=user_limit)
+
+        fields = []
+        for choice in choices:
+            reaction = choice['reaction']
+            count = choice['count']
+
+            users = ', '.join([
+                f"<@{voter}>" for voter in choice['voters']])
+            if count > user_limit:
+                users += f" and {count-user_limit} more"
+
+            field_value = choice['text'] + (f" - {users}" if users else "")
+
+            fields.append((reaction, f"{reaction} {count}", field_value))
+
+        # Nothing is fetched or edited if the results look the same
+        # as they did when the message was last edited
+        poll_id = int(poll['ID'])
+        rendered_hash = hash(tuple(fields))
+        if self.rendered_hashes.get(poll_id) == rendered_hash:
+            self.edits_skipped += 1
+            return
 
         channel = self.bot.get_channel(int(poll['channelID']))
 
@@ -229,39 +408,22 @@ class PollsCog(commands.Cog, name="Polls"):
         except discord.errors.NotFound:
             return
 
-        choices = await db.get_poll_choices(poll['ID'])
-
         # Choices are sorted in the order of appearance
         # of the emoji in the message - also the order in
         # which they are added
         emojis = [reaction.emoji for reaction in message.reactions]
-        choices.sort(key=key)
+        fields.sort(key=key)
 
         embed = message.embeds[0]
         embed.clear_fields()
 
-        user_limit = 3
-
-        for choice in choices:
-            reaction = choice['reaction']
-
-            users = await db.get_discord_user_ids_for_choice(choice['ID'])
-            count = len(users)
-
-            users = ', '.join([
-                f"<@{int(user['discordID'])}>" for user in users[:user_limit]])
-            if count > user_limit:
-                users += f" and {count-user_limit} more"
-
-            field_value = choice['text'] + (f" - {users}" if users else "")
-
-            embed.add_field(name=f"{reaction} {count}",
-                            value=field_value, inline=False)
+        for _, name, value in fields:
+            embed.add_field(name=name, value=value, inline=False)
 
         # Indicates that results are being updated
         footer_text = (await ut.get_uk_time()).strftime(
             "Results last updated: %d/%m/%Y %H:%M:%S %Z\n"
-            f"Poll ID: {int(poll['ID'])}")
+            f"Poll ID: {poll_id}")
         embed.set_footer(text=footer_text)
 
         # Again, if the message is deleted
@@ -270,51 +432,76 @@ class PollsCog(commands.Cog, name="Polls"):
         except discord.errors.NotFound:
             return
 
-    @tasks.loop(seconds=1.0)
-    async def poll_daemon(self):
+        self.rendered_hashes[poll_id] = rendered_hash
+        self.edits_performed += 1
+
+    def stats(self):
+        return {
+            'scheduled_polls': len(self.scheduler),
+            'refreshes_requested': self.refresher.requested,
+            'refreshes_coalesced': self.refresher.coalesced,
+            'edits_performed': self.edits_performed,
+            'edits_skipped': self.edits_skipped,
+        }
+
+    async def run_scheduler(self):
         """
-        Task loop that update response counts
-        and ends polls that need to be ended
+        Schedules the end of every ongoing poll, then
+        ends each poll as soon as it is due
         """
 
-        # try-except can be replaced with a coroutine
-        # wrapped with discord.ext.tasks.Loop.error on release of 1.4
-        try:
-            ongoing_polls = await db.get_all_ongoing_polls()
-            for poll in ongoing_polls:
-                end_date = poll['endDate']
-                if (await ut.get_utc_time()).timestamp() >= end_date:
-                    await self.end_poll(poll)
+        # Waits until the poll index has been loaded
+        await self.bot.database_ready.wait()
 
-                await self.update_response_counts(poll)
-        except Exception:
-            traceback.print_exc()
+        for message_id in db.poll_index.message_ids():
+            self.bot.reaction_router.register(message_id,
+                                              self.on_poll_reaction)
 
-    @poll_daemon.before_loop
-    async def before_poll_daemon_start(self):
-        # Waits until the bot is ready
-        # before starting the task loop
-        await self.bot.wait_until_ready()
+        # Retried with backoff, since no poll can end until they are loaded
+        delay = 1
+        while True:
+            try:
+                polls = await db.get_ongoing_poll_deadlines()
+                break
+            except Exception as error:
+                ut.log_info(f"Couldn't load ongoing polls: {error!r}, "
+                            f"retrying in {delay}s")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+
+        # Each poll is ended by the process running its guild's shard,
+        # the only one that can see its channel
+        for poll in polls:
+            if sharding.owns_guild(self.bot, poll['guildID']):
+                self.scheduler.schedule(int(poll['ID']), int(poll['endDate']))
+
+        await self.scheduler.run()
+
+    async def on_poll_due(self, poll_id):
+        poll = await db.get_poll_by_id(poll_id)
+        if not poll or poll['ended']:
+            return
+
+        # The end date may have been changed since it was scheduled
+        end_date = int(poll['endDate'])
+        if time.time() < end_date:
+            self.scheduler.schedule(poll_id, end_date)
+            return
 
-    @commands.Cog.listener()
-    async def on_raw_reaction_add(self, payload):
+        # Final results are drawn once the poll has been closed off
+        await self.end_poll(poll, draw_results=True)
+
+    async def on_poll_reaction(self, payload, message):
         """
-        Listens for reactions to poll messages
+        Handles reactions to poll messages, routed here by the
+        reaction router. `message` is a partial message, which is
+        all that is needed to react to or delete it.
         """
-
-        # Ignores if any bots reacts
         emoji = payload.emoji
-        if payload.member.bot:
-            return
-
-        # Ignores react if the message doesn't correspond to a poll
-        message_id = payload.message_id
-        poll = await db.get_poll_by_message_id(message_id)
+        poll = await db.get_poll_by_message_id(payload.message_id)
         if not poll:
             return
 
-        channel = self.bot.get_channel(payload.channel_id)
-        message = await channel.fetch_message(message_id)
         user = payload.member
 
         if emoji.name == '✖️':
@@ -373,10 +560,17 @@ class PollsCog(commands.Cog, name="Polls"):
         # Deletes the original command message
         await ctx.message.delete()
 
-        await db.user_create_poll(
+        poll_id = await db.user_create_poll(
             ctx.author.id, message.id, message.channel.id,
             ctx.guild.id, title, int(end_date.timestamp()))
 
+        if isinstance(poll_id, int):
+            self.scheduler.schedule(poll_id, int(end_date.timestamp()))
+            self.bot.reaction_router.register(message.id,
+                                              self.on_poll_reaction)
+            # Draws the footer with the poll's ID
+            self.refresher.mark_dirty(poll_id)
+
     @commands.command(
         name="summonpoll",
         help="Moves an existing poll to the bottom of the channel")
@@ -396,6 +590,7 @@ class PollsCog(commands.Cog, name="Polls"):
         reactions = old_message.reactions
 
         await old_message.delete()
+        self.bot.reaction_router.unregister(old_message.id)
 
         new_message = await ctx.send(embed=embed)
         for reaction in reactions:
@@ -404,6 +599,8 @@ class PollsCog(commands.Cog, name="Polls"):
         await ctx.message.delete()
 
         await db.update_poll_message_id(poll_id, new_message.id)
+        self.bot.reaction_router.register(new_message.id,
+                                          self.on_poll_reaction)
 
 
 def setup(bot):
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Cog for searching the message log."""
+
+import datetime
+import re
+import time
+
+import discord
+from discord.ext import commands
+
+import search_index
+
+# Number of results shown per page
+RESULTS_PER_PAGE = 10
+
+# Filters written into the query, like from:@user after:2020-09-01 page:2
+FILTER_REGEX = re.compile(r"\b(from|after|before|page):(\S+)", re.IGNORECASE)
+MENTION_REGEX = re.compile(r"<@!?(\d+)>|(\d{17,20})")
+
+
+def parse_date(value):
+    date = datetime.datetime.strptime(value, "%Y-%m-%d")
+    return date.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+def parse_query(query):
+    """
+    Splits the filters out of a search query.
+
+    Returns the remaining search words and a dict of the filters,
+    raises ValueError if a filter can't be understood.
+    """
+    filters = {'author': None, 'since': None, 'until': None, 'page': 1}
+    for name, value in FILTER_REGEX.findall(query):
+        name = name.lower()
+        if name == "from":
+            match = MENTION_REGEX.fullmatch(value)
+            if match is None:
+                raise ValueError(f"'{value}' isn't a user mention or ID")
+            filters['author'] = int(match.group(1) or match.group(2))
+        elif name == "page":
+            filters['page'] = max(int(value), 1)
+        else:
+            try:
+                date = parse_date(value)
+            except ValueError:
+                raise ValueError(f"'{value}' isn't a date, use YYYY-MM-DD")
+            if name == "after":
+                filters['since'] = date
+            else:
+                # Includes the whole of the given day
+                filters['until'] = date + 86400
+
+    return FILTER_REGEX.sub("", query).strip(), filters
+
+
+class SearchCog(commands.Cog):
+    """Full-text search over logged messages."""
+
+    def __init__(self, bot):
+        """Save our bot argument that is passed in to the class."""
+        self.bot = bot
+
+    @commands.command(
+        name="search",
+        help="Searches logged messages. Filter with from:@user, "
+             "after:YYYY-MM-DD, before:YYYY-MM-DD and page:N")
+    @commands.guild_only()
+    @commands.has_permissions(manage_messages=True)
+    async def search(self, ctx, *, query: str):
+        """
+        Shows the newest logged messages containing every word of the query.
+
+        Words ending in * match any word starting with them. Only messages
+        in this server, in channels the caller can read, are searched.
+        """
+        try:
+            words, filters = parse_query(query)
+        except ValueError as error:
+            await ctx.send(str(error))
+            return
+
+        if not words:
+            await ctx.send("You must include something to search for.")
+            return
+
+        channels = [channel.id for channel in ctx.guild.text_channels
+                    if channel.permissions_for(ctx.author).read_messages]
+
+        started = time.perf_counter()
+        page = filters['page']
+        # One extra result shows whether there is another page
+        results = await search_index.message_index.search(
+            words, author=filters['author'], guild=ctx.guild.id,
+            channels=channels, since=filters['since'],
+            until=filters['until'], limit=RESULTS_PER_PAGE + 1,
+            offset=(page - 1) * RESULTS_PER_PAGE)
+        elapsed = time.perf_counter() - started
+
+        if not results:
+            await ctx.send("No messages found." if page == 1
+                           else f"There is no page {page} of results.")
+            return
+
+        lines = []
+        for result in results[:RESULTS_PER_PAGE]:
+            sent = datetime.datetime.fromtimestamp(
+                result['dateSent'], datetime.timezone.utc)
+            lines.append(f"`{sent:%Y-%m-%d %H:%M}` <@{result['discordID']}>: "
+                         f"{result['snippet']}")
+
+        footer = f"Page {page} - {elapsed * 1000:.0f}ms"
+        if len(results) > RESULTS_PER_PAGE:
+            footer += f" - add page:{page + 1} for more"
+
+        # Mentions in an embed are shown without notifying anyone
+        embed = discord.Embed(title=f"Search results for {words}"[:256],
+                              description="\n".join(lines)[:2048],
+                              color=0x009fe3)
+        embed.set_footer(text=footer)
+        await ctx.send(embed=embed)
+
+
+def setup(bot):
+    """
+    Add the cog we have made to our bot.
+
+    This function is necessary for every cog file, multiple classes in the
+    same file all need adding and each file must have their own setup function.
+    """
+    bot.add_cog(SearchCog(bot))
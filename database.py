@@ -2,193 +2,730 @@
 # -*- coding: utf-8 -*-
 """Class to handle all database connections."""
 
+import asyncio
+import contextvars
+import json
 import os
-import mysql.connector as sql
-from time import time
-
+import sys
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, time
+
+import backends
+import metrics
 import utils as ut
 
 # Load env if we're just running this file.
 if __name__ == "__main__":
     from dotenv import load_dotenv
     load_dotenv()
-SQL_USER = os.getenv("SQL_USER")
-SQL_PASS = os.getenv("SQL_PASS")
-SQL_DB = os.getenv("SQL_DB")
 
-if SQL_USER is None or SQL_PASS is None or SQL_DB is None:
-    raise Exception("Cannot find required database login information")
+# The storage backend, picked with the DB_BACKEND environment variable
+backend = backends.get_backend()
+
+DatabaseError = backend.Error
+IntegrityError = backend.IntegrityError
+InterfaceError = backend.InterfaceError
+OperationalError = backend.OperationalError
+
+SQL_POOL_SIZE = backend.pool_size or int(os.getenv("SQL_POOL_SIZE", 5))
+# Connections older than this many seconds are closed and replaced
+SQL_POOL_RECYCLE = int(os.getenv("SQL_POOL_RECYCLE", 3600))
+# Connections idle for longer than this many seconds are pinged before reuse
+SQL_POOL_PING_AFTER = int(os.getenv("SQL_POOL_PING_AFTER", 30))
+# Number of threads the blocking driver calls are run on
+SQL_WORKERS = backend.workers or int(os.getenv("SQL_WORKERS", SQL_POOL_SIZE))
+# Seconds a single query may take before the caller gives up on it
+SQL_QUERY_TIMEOUT = float(os.getenv("SQL_QUERY_TIMEOUT", 10))
+# Number of discord ID to user ID mappings kept in memory
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 10000))
+# Queries taking longer than this many milliseconds are logged, 0 disables it
+SQL_SLOW_QUERY_MS = float(os.getenv("SQL_SLOW_QUERY_MS", 500))
+# Number of slow queries kept in memory for export
+SQL_SLOW_QUERY_LOG_SIZE = int(os.getenv("SQL_SLOW_QUERY_LOG_SIZE", 100))
+# Rows written by each statement adding to the activity rollups
+ACTIVITY_CHUNK_SIZE = 500
+
+
+class QueryExecutor:
+    """
+    Runs blocking driver calls on a bounded set of worker threads,
+    so that queries never block the event loop.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="database")
+        self._lock = threading.Lock()
+
+        self.queued = 0
+        self.max_queued = 0
+        self.running = 0
+        self.completed = 0
+        self.dropped = 0
+        self.timed_out = 0
+        self.interrupted = 0
+
+    def _call(self, func, args):
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+        try:
+            return func(*args)
+        finally:
+            with self._lock:
+                self.running -= 1
+                self.completed += 1
+
+    def _on_done(self, future):
+        # Calls cancelled before a worker picked them up never ran
+        if future.cancelled():
+            with self._lock:
+                self.queued -= 1
+                self.dropped += 1
+
+    def submit(self, func, *args):
+        """Queues `func` to run on a worker, returning a concurrent future."""
+        with self._lock:
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+        future = self._executor.submit(self._call, func, args)
+        future.add_done_callback(self._on_done)
+        return future
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'queue_depth': self.queued,
+            'max_queue_depth': self.max_queued,
+            'running': self.running,
+            'completed': self.completed,
+            'dropped': self.dropped,
+            'timed_out': self.timed_out,
+            'interrupted': self.interrupted,
+        }
 
 
-class Database:
+executor = QueryExecutor(SQL_WORKERS)
+
+
+class PooledConnection:
+    """A connection held by the pool, along with its age information."""
+
+    __slots__ = ('connection', 'created', 'last_used')
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.created = time()
+        self.last_used = self.created
+
+
+class ConnectionPool:
+    """
+    Bounded pool of connections shared by every database coroutine.
+
+    At most `size` connections are checked out at once, any further callers
+    wait in line for one to be released. Idle connections are pinged before
+    being reused and are replaced once they are older than `recycle` seconds.
+
+    Anything that talks to the server is run on the query executor.
+    """
+
+    def __init__(self, size, recycle, ping_after):
+        self.size = size
+        self.recycle = recycle
+        self.ping_after = ping_after
+        self._idle = deque()
+        # Created lazily so that they are bound to the running event loop
+        self._semaphore = None
+        self._loop = None
+        self._loop_thread = None
+        # Guards the counters updated from worker threads
+        self._lock = threading.Lock()
+
+        self.opened = 0
+        self.recycled = 0
+        self.failed_checks = 0
+        self.acquired = 0
+        self.waited = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.total_wait_time = 0.0
+
+    def _connect(self):
+        connection = backend.connect()
+        with self._lock:
+            self.opened += 1
+        return PooledConnection(connection)
+
+    def _close(self, pooled):
+        try:
+            pooled.connection.close()
+        except DatabaseError:
+            pass
+
+    def _is_usable(self, pooled):
+        now = time()
+        if now - pooled.created >= self.recycle:
+            with self._lock:
+                self.recycled += 1
+            return False
+
+        if now - pooled.last_used >= self.ping_after:
+            try:
+                backend.ping(pooled.connection)
+            except DatabaseError:
+                with self._lock:
+                    self.failed_checks += 1
+                return False
+
+        return True
+
+    def _get_connection(self):
+        # Runs on a worker thread, other workers may be taking
+        # idle connections at the same time
+        while True:
+            try:
+                pooled = self._idle.pop()
+            except IndexError:
+                return self._connect()
+            if self._is_usable(pooled):
+                return pooled
+            self._close(pooled)
+
+    def _put_connection(self, pooled, discard):
+        # Runs on a worker thread
+        try:
+            if discard:
+                self._close(pooled)
+                return
+            if pooled.connection.in_transaction:
+                pooled.connection.rollback()
+            pooled.last_used = time()
+            self._idle.append(pooled)
+        except DatabaseError:
+            self._close(pooled)
+
+    def _release_slot(self, _=None):
+        # May be called from a worker thread
+        if threading.get_ident() == self._loop_thread:
+            self._semaphore.release()
+        else:
+            self._loop.call_soon_threadsafe(self._semaphore.release)
+
+    def _release_when_done(self, future):
+        # Hands a connection back once a call that
+        # was abandoned by its caller has finished
+        def callback(done):
+            if done.cancelled() or done.exception() is not None:
+                self._release_slot()
+            else:
+                self.release(done.result())
+
+        future.add_done_callback(callback)
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Scripts may run several event loops one after another
+            self._semaphore = asyncio.Semaphore(self.size)
+            self._loop = loop
+            self._loop_thread = threading.get_ident()
+
+        if self._semaphore.locked():
+            self.waited += 1
+
+        start = perf_counter()
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.total_wait_time += perf_counter() - start
+        self.acquired += 1
+
+        future = executor.submit(self._get_connection)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            # The connection may still be opened after we have gone
+            self._release_when_done(future)
+            raise
+        except BaseException:
+            self._semaphore.release()
+            raise
+
+    def release(self, pooled, discard=False, pending=None):
+        """
+        Hands a connection back to the pool.
+
+        If `pending` is a call still running on the connection, the
+        connection is discarded once that call has finished.
+        """
+        if pending is not None and not pending.done():
+            pending.add_done_callback(
+                lambda _: self.release(pooled, discard=True))
+            return
+
+        if discard or pooled.connection.in_transaction:
+            future = executor.submit(self._put_connection, pooled, discard)
+            future.add_done_callback(self._release_slot)
+        else:
+            pooled.last_used = time()
+            self._idle.append(pooled)
+            self._release_slot()
+
+    def close(self):
+        while self._idle:
+            self._close(self._idle.pop())
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'idle': len(self._idle),
+            'in_use': self.size - self._semaphore._value
+            if self._semaphore else 0,
+            'opened': self.opened,
+            'recycled': self.recycled,
+            'failed_checks': self.failed_checks,
+            'acquired': self.acquired,
+            'waited': self.waited,
+            'waiting': self.waiting,
+            'max_waiting': self.max_waiting,
+            'total_wait_time': self.total_wait_time,
+        }
+
+
+pool = ConnectionPool(SQL_POOL_SIZE, SQL_POOL_RECYCLE, SQL_POOL_PING_AFTER)
+
+# Maps discord IDs to USERS.ID, which never changes once a user is added
+user_cache = ut.LRUCache(USER_CACHE_SIZE)
 
-    def __enter__(self, *args, **kwargs):
-        # Connect to the database
-
-        self.db_config = {
-            'host': '209.97.130.228',
-            'port': 3306,
-            'database': SQL_DB,
-            'user': SQL_USER,
-            'password': SQL_PASS,
-            'charset': 'utf8',
-            'use_unicode': True,
-            'get_warnings': True,
-            'autocommit': True,
-            'raise_on_warnings': False
+# Maps discord guild IDs to their GUILDS row, or None if they have no row
+guild_cache = {}
+
+
+class PollMessageIndex:
+    """
+    In-memory index of the message IDs of every poll,
+    so that reactions on other messages need no query.
+
+    Until it has been loaded, every message is assumed to be a poll.
+    """
+
+    def __init__(self):
+        self._polls = {}
+        self._messages = {}
+        self.loaded = False
+
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, poll_id, message_id):
+        self.remove(poll_id)
+        self._polls[int(message_id)] = int(poll_id)
+        self._messages[int(poll_id)] = int(message_id)
+
+    def remove(self, poll_id):
+        message_id = self._messages.pop(int(poll_id), None)
+        if message_id is not None:
+            self._polls.pop(message_id, None)
+
+    def message_ids(self):
+        return list(self._polls)
+
+    def might_be_poll(self, message_id):
+        if not self.loaded or int(message_id) in self._polls:
+            self.hits += 1
+            return True
+
+        self.misses += 1
+        return False
+
+    def stats(self):
+        return {
+            'size': len(self._polls),
+            'hits': self.hits,
+            'misses': self.misses,
         }
 
-        self.connection = sql.Connect(**self.db_config)
 
-        self.cursor = self.connection.cursor(dictionary=True)
+poll_index = PollMessageIndex()
+
+# Query counts and timings, keyed by the function that made the queries
+query_metrics = metrics.QueryMetrics()
+# The most recent slow queries, oldest first
+slow_queries = deque(maxlen=SQL_SLOW_QUERY_LOG_SIZE)
+
+metrics.registry.register_stats(
+    "bot_db_pool", pool.stats,
+    counters=('opened', 'recycled', 'failed_checks', 'acquired', 'waited'))
+metrics.registry.register_stats(
+    "bot_db_executor", executor.stats,
+    counters=('completed', 'dropped', 'timed_out', 'interrupted'))
+metrics.registry.register_stats(
+    "bot_cache", user_cache.stats, counters=('hits', 'misses', 'evictions'),
+    labels={'cache': "users"})
+metrics.registry.register(
+    "bot_cache_size", "Size", lambda: len(guild_cache), labels={'cache': "guilds"})
+metrics.registry.register_stats(
+    "bot_cache", poll_index.stats, counters=('hits', 'misses'),
+    labels={'cache': "poll_messages"})
+metrics.registry.register(
+    "bot_db_slow_queries", "Slow queries kept in the slow query log",
+    lambda: len(slow_queries))
+for _field in ('calls', 'queries', 'errors', 'timeouts', 'rows'):
+    metrics.registry.register(
+        f"bot_db_{_field}_total", f"Database {_field} by calling function",
+        lambda field=_field: query_metrics.values(field), "counter",
+        label_names=('function', ))
+metrics.registry.register(
+    "bot_db_query_seconds", "Database query latency by calling function",
+    lambda: query_metrics.values('latency'), "histogram",
+    label_names=('function', ))
+metrics.registry.register(
+    "bot_db_acquire_wait_seconds",
+    "Time spent waiting for a pooled connection by calling function",
+    lambda: query_metrics.values('acquire_wait'), "histogram",
+    label_names=('function', ))
+
+
+def _describe_value(value):
+    if isinstance(value, (str, bytes)):
+        return f"{type(value).__name__}[{len(value)}]"
+    return type(value).__name__
+
+
+def _params_shape(params, many=False):
+    """
+    Describes the types of query parameters without their values,
+    so that message contents and the like never end up in the logs.
+    """
+    if many:
+        params = list(params)
+        if not params:
+            return "0 x ()"
+        return f"{len(params)} x {_params_shape(params[0])}"
+
+    if isinstance(params, dict):
+        return "{" + ", ".join(f"{key}: {_describe_value(value)}"
+                               for key, value in params.items()) + "}"
+
+    params = list(params or ())
+    shape = ", ".join(_describe_value(value) for value in params[:10])
+    if len(params) > 10:
+        shape += f", ... {len(params)} params"
+    return f"({shape})"
+
+
+def _record_slow_query(function, query, params, many, duration, error):
+    if not SQL_SLOW_QUERY_MS or duration * 1000 < SQL_SLOW_QUERY_MS:
+        return
+
+    entry = {
+        'function': function,
+        'query': " ".join(query.split()),
+        'params': _params_shape(params, many),
+        'duration': duration,
+        'error': type(error).__name__ if error is not None else None,
+        'time': time(),
+    }
+    slow_queries.append(entry)
+    ut.log_info(f"Slow query in {function} took {duration * 1000:.0f}ms: "
+                f"{entry['query']} {entry['params']}")
+
+
+class Session:
+    """
+    A pooled connection shared by every `Database` block
+    opened within the same task.
+    """
+
+    def __init__(self, pooled):
+        self.pooled = pooled
+        self.connection = pooled.connection
+        self.task = asyncio.current_task()
+        # A call abandoned by its caller that may still be running
+        self.pending = None
+        self.in_transaction = False
+        self.savepoints = 0
+        # Called once the outermost transaction has committed
+        self.on_commit = []
+
+
+# The session of the innermost open Database block
+_current_session = contextvars.ContextVar("database_session", default=None)
+
+
+class Database:
+    """
+    Checks a connection out of the pool for the duration of the block.
+
+    Use as `async with Database() as db:`, the connection is handed back
+    to the pool when the block exits. Queries are run on the query executor
+    with `await db.execute(...)`, and their rows are read back with
+    `db.fetchone()` and `db.fetchall()`.
+
+    Blocks opened while another is open in the same task reuse its
+    connection, so one logical operation only ever holds one connection.
+
+    With `transaction=True` the block is run as a transaction, which is
+    committed when the block exits and rolled back if it raises. Nested
+    transactions are run as savepoints of the outer one. Calls to
+    `commit()` inside a transaction are left to the transaction.
+    """
+
+    def __init__(self, transaction=False, name=None):
+        self.transaction = transaction
+        # Queries are tagged with the function that opened the block
+        self.name = name or sys._getframe(1).f_code.co_name
+
+    async def __aenter__(self):
+        session = _current_session.get()
+        if session is None or session.task is not asyncio.current_task():
+            started = perf_counter()
+            session = Session(await pool.acquire())
+            query_metrics.record_call(self.name, perf_counter() - started)
+            self._token = _current_session.set(session)
+        else:
+            query_metrics.record_call(self.name)
+            self._token = None
+
+        self._session = session
+        self.connection = session.connection
+
+        self.cursor = backend.cursor(self.connection)
+
+        self._rows = []
+        self.rowcount = -1
+        self.lastrowid = None
+
+        self._began = False
+        self._savepoint = None
+        # Callbacks added before this block's savepoint was made
+        self._callbacks_kept = 0
+        self._finished = False
+        if self.transaction:
+            try:
+                await self._start_transaction()
+            except BaseException as error:
+                await self._close(error)
+                raise
 
         return self
 
-    def __exit__(self, exception_type, value, traceback):
-        self.connection.close()
-
-
-async def create_tables():
-    with Database() as db:
-        query_list = (
-            """
-            CREATE TABLE IF NOT EXISTS
-            USERS (
-                ID INT NOT NULL AUTO_INCREMENT,
-                name VARCHAR(255) NOT NULL,
-                discordID VARCHAR(255) UNIQUE NOT NULL,
-                jamming INT,
-                PRIMARY KEY (ID)
-            )
-            """,
-            """
-            CREATE TABLE IF NOT EXISTS
-            JAM_TEAM (
-                ID INT NOT NULL AUTO_INCREMENT,
-                teamName VARCHAR(255) NOT NULL UNIQUE,
-                gitLink VARCHAR(255) NOT NULL UNIQUE,
-                PRIMARY KEY (ID)
-            )
-            """,
-            """
-            CREATE TABLE IF NOT EXISTS
-            JAM_TEAM_MEMBER (
-                ID INT NOT NULL AUTO_INCREMENT,
-                teamID INT NOT NULL,
-                userID INT NOT NULL UNIQUE,
-                creator INT NOT NULL DEFAULT 0,
-                PRIMARY KEY (ID)
-            )
-            """,
-            """
-            CREATE TABLE IF NOT EXISTS
-            EVENTS (
-                ID INT PRIMARY KEY AUTO_INCREMENT,
-                title VARCHAR(255) NOT NULL,
-                description VARCHAR(1024) NOT NULL,
-                date DATETIME NOT NULL,
-                creator INT NOT NULL,
-                FOREIGN KEY (creator)
-                    REFERENCES USERS(ID)
-            )
-            """,
-            """
-            CREATE TABLE IF NOT EXISTS
-            GUILDS (
-                ID INT PRIMARY KEY AUTO_INCREMENT,
-                guildID VARCHAR(255) NOT NULL UNIQUE,
-                registeringID VARCHAR(255) UNIQUE,
-                memberID VARCHAR(255) UNIQUE,
-                welcomeMessageID VARCHAR(255) UNIQUE
-            )
-            """,
-            """
-            CREATE TABLE IF NOT EXISTS
-            CHANNELS (
-                ID INT PRIMARY KEY AUTO_INCREMENT,
-                channelID VARCHAR(255) NOT NULL UNIQUE,
-                voice INT NOT NULL,
-                owner INT NOT NULL UNIQUE,
-                createdDate INT NOT NULL,
-
-                FOREIGN KEY (owner)
-                    REFERENCES USERS(ID)
-            )""",
-            """
-            CREATE TABLE IF NOT EXISTS
-            POLLS (
-                ID INT PRIMARY KEY AUTO_INCREMENT,
-                messageID VARCHAR(255) NOT NULL,
-                channelID VARCHAR(255) NOT NULL,
-                guild INT NOT NULL,
-                creator INT NOT NULL,
-                title VARCHAR(255) NOT NULL,
-                endDate INT NOT NULL,
-                ended BOOLEAN NOT NULL DEFAULT FALSE,
-
-                FOREIGN KEY(creator)
-                    REFERENCES USERS(ID),
-                FOREIGN KEY(guild)
-                    REFERENCES GUILDS(ID)
-            )
-            """,
-            """
-            CREATE TABLE IF NOT EXISTS
-            POLL_CHOICES (
-                ID INT PRIMARY KEY AUTO_INCREMENT,
-                poll INT NOT NULL,
-                reaction VARCHAR(255) NOT NULL,
-                text VARCHAR(255) NOT NULL,
-
-                UNIQUE KEY (poll, reaction),
-                FOREIGN KEY (poll)
-                    REFERENCES POLLS(ID)
-                    ON DELETE CASCADE
-            )
-            """,
-            """
-            CREATE TABLE IF NOT EXISTS
-            POLL_RESPONSES (
-                ID INT PRIMARY KEY AUTO_INCREMENT,
-                user INT NOT NULL,
-                choice INT NOT NULL,
-
-                UNIQUE KEY (user, choice),
-                FOREIGN KEY (user)
-                    REFERENCES USERS(ID),
-                FOREIGN KEY (choice)
-                    REFERENCES POLL_CHOICES(ID)
-                    ON DELETE CASCADE
-            )
-            """,
-            """
-            CREATE TABLE IF NOT EXISTS
-            MESSAGE_LOG (
-                ID INT PRIMARY KEY AUTO_INCREMENT,
-                authorID INT NOT NULL,
-                messageID VARCHAR(255) NOT NULL,
-                content VARCHAR(4096),
-                dateSent INT NOT NULL,
-                FOREIGN KEY (authorID)
-                    REFERENCES USERS(ID)
-            )
-            """
-        )
-
-        for query in query_list:
+    async def __aexit__(self, exception_type, value, traceback):
+        try:
+            if not self._finished and (self._began or self._savepoint):
+                if value is None:
+                    await self._end_transaction(commit=True)
+                else:
+                    await self._end_transaction(commit=False)
+        finally:
+            await self._close(value)
+
+    async def _close(self, value):
+        if self._token is None:
+            return
+
+        _current_session.reset(self._token)
+        # Connection errors leave the connection in an unknown state
+        discard = isinstance(value, (InterfaceError, OperationalError))
+        pool.release(self._session.pooled, discard=discard,
+                     pending=self._session.pending)
+
+    async def _start_transaction(self):
+        session = self._session
+        if session.in_transaction:
+            session.savepoints += 1
+            self._savepoint = f"savepoint_{session.savepoints}"
+            self._callbacks_kept = len(session.on_commit)
+            await self.execute(f"SAVEPOINT {self._savepoint}")
+        else:
+            await self._run(backend.start_transaction, self.connection)
+            session.in_transaction = True
+            self._began = True
+
+    async def _end_transaction(self, commit):
+        self._finished = True
+        if self._savepoint is not None:
+            if commit:
+                await self.execute(f"RELEASE SAVEPOINT {self._savepoint}")
+                return
+
+            del self._session.on_commit[self._callbacks_kept:]
+            if self._session.pending is None:
+                await self.execute(
+                    f"ROLLBACK TO SAVEPOINT {self._savepoint}")
+            return
+
+        self._session.in_transaction = False
+        callbacks, self._session.on_commit = self._session.on_commit, []
+        if commit:
+            await self._run(self.connection.commit)
+            for callback in callbacks:
+                callback()
+        elif self._session.pending is None:
+            # A connection left busy is discarded, which rolls it back anyway
+            await self._run(self.connection.rollback)
+
+    async def _run(self, func, *args, timeout=None):
+        session = self._session
+        if session.pending is not None:
+            raise OperationalError(
+                "Connection is still busy with an abandoned query")
+
+        future = executor.submit(func, *args)
+        try:
+            return await asyncio.wait_for(
+                asyncio.wrap_future(future),
+                SQL_QUERY_TIMEOUT if timeout is None else timeout)
+        except asyncio.TimeoutError:
+            executor.timed_out += 1
+            # The call may still be running on the connection
+            session.pending = future
+            self._interrupt(future)
+            raise
+        except asyncio.CancelledError:
+            session.pending = future
+            self._interrupt(future)
+            raise
+
+    def _interrupt(self, future):
+        """
+        Stops an abandoned call on the server, so that it doesn't hold its
+        worker and pool slot until it finishes by itself. The connection is
+        discarded once the call has ended.
+        """
+        # Calls still queued are simply never run
+        if future.done() or future.cancel():
+            return
+
+        connection = self.connection
+
+        def interrupt():
             try:
-                db.cursor.execute(query)
-            except sql.errors.ProgrammingError:
-                ut.log_error(f"Query \n'{query}'\n raised an error, ensure that the "
-                             "syntax is correct.")
+                backend.interrupt(connection)
+                with executor._lock:
+                    executor.interrupted += 1
+            except Exception as error:
+                ut.log_info(f"Couldn't interrupt an abandoned query: {error!r}")
+
+        # Not on the query executor, whose workers may all be busy
+        asyncio.get_event_loop().run_in_executor(None, interrupt)
+
+    def _execute(self, query, params, many):
+        # Runs on a worker thread
+        query = backend.translate(query)
+        if many:
+            self.cursor.executemany(query, params)
+        else:
+            self.cursor.execute(query, params)
+
+        has_rows = self.cursor.description is not None
+        self._rows = self.cursor.fetchall() if has_rows else []
+        self.rowcount = self.cursor.rowcount
+        self.lastrowid = self.cursor.lastrowid
+
+    async def _timed_execute(self, query, params, many, timeout):
+        started = perf_counter()
+        error = None
+        try:
+            await self._run(self._execute, query, params, many,
+                            timeout=timeout)
+        except BaseException as exception:
+            error = exception
+            raise
+        finally:
+            duration = perf_counter() - started
+            query_metrics.record_query(
+                self.name, duration,
+                rows=len(self._rows) if error is None else 0,
+                error=error,
+                timed_out=isinstance(error, asyncio.TimeoutError))
+            _record_slow_query(self.name, query, params, many,
+                               duration, error)
+
+    async def execute(self, query, params=(), timeout=None):
+        await self._timed_execute(query, params, False, timeout)
+
+    async def executemany(self, query, seq_params, timeout=None):
+        await self._timed_execute(query, seq_params, True, timeout)
+
+    async def commit(self):
+        if not self._session.in_transaction:
+            await self._run(self.connection.commit)
+
+    def on_commit(self, callback):
+        """
+        Calls `callback` once what has been written is committed, straight
+        away outside a transaction. It is dropped if the transaction, or
+        the savepoint it was added in, is rolled back.
+        """
+        if self._session.in_transaction:
+            self._session.on_commit.append(callback)
+        else:
+            callback()
+
+    async def rollback(self):
+        """
+        Rolls back this block's transaction, or its savepoint
+        if it is nested within another transaction.
+        """
+        if (self._began or self._savepoint) and not self._finished:
+            await self._end_transaction(commit=False)
+
+    def fetchone(self):
+        if self._rows:
+            return self._rows.pop(0)
+        return None
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+
+def transaction():
+    """Shorthand for `Database(transaction=True)`."""
+    return Database(transaction=True, name=sys._getframe(1).f_code.co_name)
+
+
+async def close_pool():
+    pool.close()
+    executor.shutdown()
+
+
+def stats():
+    """Returns the current connection pool and query executor metrics."""
+    return {
+        'pool': pool.stats(),
+        'executor': executor.stats(),
+        'user_cache': user_cache.stats(),
+        'guild_cache': {'size': len(guild_cache)},
+        'poll_index': poll_index.stats(),
+        'queries': query_metrics.snapshot(),
+        'slow_queries': list(slow_queries),
+    }
+
+
+def reset_query_metrics():
+    query_metrics.reset()
+    slow_queries.clear()
 
 
 async def add_user(discord_id, bot, name):
-    with Database() as db:
-        if bot:
-            return
+    if bot:
+        return
+    user_cache.invalidate(int(discord_id))
+    async with Database() as db:
         try:
-            db.cursor.execute(f"""
+            await db.execute(f"""
                 INSERT INTO USERS (
                     name, discordID
                 )
@@ -198,31 +735,117 @@ async def add_user(discord_id, bot, name):
                 )
             """, (name, discord_id))
 
-            db.connection.commit()
-            return db.cursor.lastrowid
-        except sql.errors.IntegrityError:
+            await db.commit()
+        except IntegrityError:
             return False
 
+        # The row doesn't exist if an outer transaction is rolled back
+        user_id = db.lastrowid
+        db.on_commit(lambda: user_cache.set(int(discord_id), user_id))
+        return user_id
 
-async def get_user_id(discord_id):
-    with Database() as db:
-        db.cursor.execute(f"""
+
+async def _select_user_id(discord_id):
+    async with Database() as db:
+        await db.execute(f"""
             SELECT ID FROM USERS
             WHERE discordID = %s
         """, (discord_id, ))
 
-        result = db.cursor.fetchone()
+        result = db.fetchone()
         if result:
-            return result['ID']
+            # The row may have been added by a transaction still open
+            user_id = result['ID']
+            db.on_commit(lambda: user_cache.set(int(discord_id), user_id))
+            return user_id
+
+
+async def get_user_id(discord_id):
+    user_id = user_cache.get(int(discord_id))
+    if user_id is not None:
+        return user_id
+
+    async with Database():
+        user_id = await _select_user_id(discord_id)
+        if user_id is not None:
+            return user_id
 
         result = await add_user(discord_id, False, "Unknown")
+        if result is False:
+            # Someone else added the user in the meantime
+            return await _select_user_id(discord_id)
         return result
 
 
+async def sync_users(users, chunk_size=1000):
+    """
+    Adds or renames many users at once.
+
+    `users` is an iterable of (discord_id, name) pairs. Users are upserted
+    in chunks, and a dict counting the inserted, updated and unchanged
+    users is returned.
+    """
+    counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+    users = list(users)
+
+    for start in range(0, len(users), chunk_size):
+        chunk = users[start:start + chunk_size]
+        placeholders = ", ".join(["%s"] * len(chunk))
+
+        async with Database() as db:
+            await db.execute(f"""
+                SELECT discordID, name FROM USERS
+                WHERE discordID IN ({placeholders})
+            """, tuple(str(discord_id) for discord_id, _ in chunk))
+
+            existing = {row['discordID']: row['name']
+                        for row in db.fetchall()}
+
+            changed = []
+            for discord_id, name in chunk:
+                old_name = existing.get(str(discord_id))
+                if old_name is None:
+                    counts['inserted'] += 1
+                elif old_name != name:
+                    counts['updated'] += 1
+                else:
+                    counts['unchanged'] += 1
+                    continue
+                changed.extend((name, str(discord_id)))
+
+            if not changed:
+                continue
+
+            values = ", ".join(["(%s, %s)"] * (len(changed) // 2))
+            await db.execute(f"""
+                INSERT INTO USERS (name, discordID)
+                VALUES {values}
+                ON DUPLICATE KEY UPDATE name = VALUES(name)
+            """, tuple(changed))
+
+            await db.commit()
+
+    return counts
+
+
+async def warm_user_cache():
+    """Loads the most recently added users into the user ID cache."""
+    async with Database() as db:
+        await db.execute("""
+            SELECT ID, discordID FROM USERS
+            ORDER BY ID DESC
+            LIMIT %s
+        """, (USER_CACHE_SIZE, ))
+
+        # Added oldest first so the newest users are evicted last
+        for row in reversed(db.fetchall()):
+            user_cache.set(int(row['discordID']), row['ID'])
+
+
 async def add_guild(guild_id, registering_id, member_id):
-    with Database() as db:
+    async with Database() as db:
         try:
-            db.cursor.execute(f"""
+            await db.execute(f"""
                 INSERT INTO GUILDS (
                     guildID, registeringID, memberID
                 )
@@ -233,66 +856,100 @@ async def add_guild(guild_id, registering_id, member_id):
                 )
             """, (guild_id, registering_id, member_id))
 
-            db.connection.commit()
-        except sql.errors.IntegrityError:
+            await db.commit()
+        except IntegrityError:
             pass
 
+    await load_guild_info(guild_id)
 
-async def get_guild_info(guild_id, field="*"):
-    # We use string formatting for field since it is only created internally
-    # and if we used the same method as guild_id, it would be escaped.
-    with Database() as db:
-        db.cursor.execute(f"""
-            SELECT {field} FROM GUILDS
-            WHERE guildID = %s
-        """, (guild_id,))
 
-        result = db.cursor.fetchone()
+async def load_guild_info(guild_id=None):
+    """
+    Loads GUILDS rows into the guild cache.
 
-        if field != "*" and result[field]:
-            return int(result[field])
-        if result:
-            return result
+    Loads every guild if no `guild_id` is given.
+    """
+    async with Database() as db:
+        if guild_id is None:
+            await db.execute("SELECT * FROM GUILDS")
+        else:
+            await db.execute("""
+                SELECT * FROM GUILDS
+                WHERE guildID = %s
+            """, (guild_id, ))
+
+        rows = db.fetchall()
+
+    if guild_id is None:
+        guild_cache.clear()
+    else:
+        # Remembers that the guild has no row, so it isn't looked up again
+        guild_cache[int(guild_id)] = None
+
+    for row in rows:
+        guild_cache[int(row['guildID'])] = row
+
+
+async def get_guild_info(guild_id, field="*"):
+    # Guild rows are read from the cache, and are only
+    # queried the first time a guild is seen
+    if int(guild_id) not in guild_cache:
+        await load_guild_info(guild_id)
+
+    result = guild_cache[int(guild_id)]
+    if not result:
         return False
+    if field == "*":
+        return result
+    if result[field]:
+        return int(result[field])
+    return False
 
 
 async def set_guild_info(guild_id, field, new_value):
     # We use string formatting for field since it is only created internally
     # and if we used the same method as guild_id, it would be escaped.
-    with Database() as db:
+    async with Database() as db:
         try:
-            db.cursor.execute(f"""
+            await db.execute(f"""
                 UPDATE GUILDS
                 SET {field} = %s
                 WHERE guildID = %s
             """, (new_value, guild_id))
 
-            db.connection.commit()
-        except sql.errors.IntegrityError:
+            await db.commit()
+        except IntegrityError:
             return False
 
+    # Written through to the cache once the update has succeeded
+    result = guild_cache.get(int(guild_id))
+    if result:
+        result[field] = None if new_value is None else str(new_value)
+    else:
+        await load_guild_info(guild_id)
+
 
 async def set_jamming(user_id, new_value):
-    with Database() as db:
-        db.cursor.execute(f"""
+    async with Database() as db:
+        await db.execute(f"""
             UPDATE USERS
             SET jamming = %s
             WHERE discordID = %s
         """, (new_value, user_id))
 
-        db.connection.commit()
+        await db.commit()
         return True
 
 
 async def get_user_jam_team(discord_id):
-    with Database() as db:
+    async with Database() as db:
         user_id = await get_user_id(discord_id)
-        db.cursor.execute(f"""
+        await db.execute(f"""
             SELECT teamID FROM JAM_TEAM_MEMBER
             WHERE userID = %s
         """, (user_id,))
 
-        result = db.cursor.fetchone()
+        result = db.fetchone()
 
         if result:
             return result['teamID']
@@ -300,295 +957,559 @@ async def get_user_jam_team(discord_id):
 
 
 async def add_user_jam_team(user_id, jam_team, creator="0"):
-    with Database() as db:
+    async with Database() as db:
         try:
-            db.cursor.execute(f"""
+            await db.execute(f"""
                 INSERT INTO JAM_TEAM_MEMBER
                 (teamID, userID, creator)
                 VALUES
                 (%s, %s, %s)
             """, (jam_team, user_id, creator))
 
-            db.connection.commit()
+            await db.commit()
             return True
-        except sql.errors.IntegrityError:
+        except IntegrityError:
             return False
 
 
 async def create_jam_team(discord_id, team_name, git_link):
-    jam_team_id = await get_user_jam_team(discord_id)
-    if jam_team_id:
-        return False, "User is already a member of a team."
-    with Database() as db:
+    # The team is only kept if its creator is added to it
+    async with transaction() as db:
+        jam_team_id = await get_user_jam_team(discord_id)
+        if jam_team_id:
+            return False, "User is already a member of a team."
         try:
-            db.cursor.execute(f"""
+            await db.execute(f"""
                 INSERT INTO JAM_TEAM
                 (teamName, gitLink)
                 VALUES
                 (%s, %s)
             """, (team_name, git_link))
-
-            jam_team = db.cursor.lastrowid
-            user_id = await get_user_id(discord_id)
-            await add_user_jam_team(user_id, jam_team, creator="1")
-            db.connection.commit()
-        except sql.errors.IntegrityError:
+        except IntegrityError:
             return False, "Team name or git link already in use."
 
+        jam_team = db.lastrowid
+        user_id = await get_user_id(discord_id)
+        if not await add_user_jam_team(user_id, jam_team, creator="1"):
+            await db.rollback()
+            return False, "User is already a member of a team."
+
 
 async def user_create_channel(discord_id, channel_id, is_voice):
-    with Database() as db:
+    async with Database() as db:
         user_id = await get_user_id(discord_id)
         try:
-            db.cursor.execute(f"""
+            await db.execute(f"""
                 INSERT INTO CHANNELS
                 (channelID, voice, owner, createdDate)
                 VALUES
                 (%s, %s, %s, %s)
             """, (channel_id, is_voice, user_id, int(time())))
-            db.connection.commit()
-        except sql.errors.IntegrityError:
+            await db.commit()
+        except IntegrityError:
             return False, "UNIQUE constraint failed..."
 
 
 async def user_delete_channel(discord_id):
-    with Database() as db:
+    async with Database() as db:
         user_id = await get_user_id(discord_id)
         try:
-            db.cursor.execute(f"""
+            await db.execute(f"""
                 DELETE FROM CHANNELS
                 WHERE owner = %s
             """, (user_id,))
-            db.connection.commit()
-        except sql.errors.IntegrityError:
+            await db.commit()
+        except IntegrityError:
             return False, "UNIQUE constraint failed..."
 
 
 async def user_has_channel(discord_id):
-    with Database() as db:
+    async with Database() as db:
         user_id = await get_user_id(discord_id)
-        db.cursor.execute(f"""
+        await db.execute(f"""
             SELECT channelID FROM CHANNELS
             WHERE owner = %s
         """, (user_id,))
 
-        result = db.cursor.fetchone()
+        result = db.fetchone()
         if result:
             return result['channelID']
         return False
 
 
 async def get_poll_by_id(poll_id, field="*"):
-    with Database() as db:
-        db.cursor.execute(f"""
+    async with Database() as db:
+        await db.execute(f"""
             SELECT {field} FROM POLLS
             WHERE ID = %s
         """, (poll_id, ))
 
-        return db.cursor.fetchone()
+        return db.fetchone()
+
+
+async def load_poll_index():
+    """Loads the message ID of every poll into the poll message index."""
+    async with Database() as db:
+        await db.execute("SELECT ID, messageID FROM POLLS")
+
+        for row in db.fetchall():
+            poll_index.add(row['ID'], row['messageID'])
+        poll_index.loaded = True
+
+
+def is_poll_message(message_id):
+    return poll_index.might_be_poll(message_id)
 
 
 async def get_poll_by_message_id(message_id, field="*"):
-    with Database() as db:
-        db.cursor.execute(f"""
+    # Most messages aren't polls, and are turned away without a query
+    if not is_poll_message(message_id):
+        return None
+
+    async with Database() as db:
+        await db.execute(f"""
             SELECT {field} FROM POLLS
             WHERE messageID = %s
         """, (message_id, ))
 
-        return db.cursor.fetchone()
+        return db.fetchone()
 
 
 async def user_create_poll(discord_id, message_id, channel_id,
                            discord_guild_id, poll_title, end_date: int):
-    with Database() as db:
+    async with Database() as db:
         user_id = await get_user_id(discord_id)
         guild_id = await get_guild_info(discord_guild_id, field="ID")
         try:
-            db.cursor.execute("""
+            await db.execute("""
                 INSERT INTO POLLS
                 (creator, messageID, channelID, guild, title, endDate)
                 VALUES
                 (%s, %s, %s, %s, %s, %s)
             """, (user_id, message_id, channel_id,
                   guild_id, poll_title, end_date))
-            db.connection.commit()
-        except sql.errors.IntegrityError:
+            await db.commit()
+        except IntegrityError:
             return False, "UNIQUE constraint failed"
 
+    poll_index.add(db.lastrowid, message_id)
+    return db.lastrowid
+
 
 async def update_poll_message_id(poll_id, message_id):
-    with Database() as db:
+    async with Database() as db:
         try:
-            db.cursor.execute("""
+            await db.execute("""
                 UPDATE POLLS SET messageID = %s
                 WHERE ID = %s
             """, (message_id, poll_id))
-            db.connection.commit()
-        except sql.errors.IntegrityError:
+            await db.commit()
+        except IntegrityError:
             return False, "Integrity error"
 
+    poll_index.add(poll_id, message_id)
 
-async def get_all_ongoing_polls(field="*"):
-    with Database() as db:
-        db.cursor.execute(f"""
-            SELECT {field} FROM POLLS
-            WHERE ended = FALSE
+
+async def get_ongoing_poll_deadlines():
+    """Returns the ID, end date and Discord guild ID of every ongoing poll."""
+    async with Database() as db:
+        await db.execute("""
+            SELECT P.ID, P.endDate, G.guildID
+            FROM POLLS P
+            JOIN GUILDS G ON G.ID = P.guild
+            WHERE P.ended = FALSE
         """)
 
-        return db.cursor.fetchall()
+        return db.fetchall()
 
 
 async def change_poll_end_date(poll_id, end_date):
-    with Database() as db:
-        db.cursor.execute("""
+    async with Database() as db:
+        await db.execute("""
             UPDATE POLLS SET endDate = %s
             WHERE ID = %s
         """, (end_date, poll_id))
 
 
 async def end_poll(poll_id):
-    with Database() as db:
-        db.cursor.execute("""
+    async with Database() as db:
+        await db.execute("""
             UPDATE POLLS SET ended = TRUE
             WHERE ID = %s
         """, (poll_id, ))
 
-        return db.cursor.rowcount > 0
+        return db.rowcount > 0
 
 
 async def delete_poll(poll_id):
-    with Database() as db:
-        db.cursor.execute("""
+    async with Database() as db:
+        await db.execute("""
             DELETE FROM POLLS
             WHERE ID = %s
         """, (poll_id, ))
-        db.connection.commit()
+        await db.commit()
+
+    poll_index.remove(poll_id)
 
 
 async def get_poll_choice(poll_id, reaction, field="*"):
-    with Database() as db:
-        db.cursor.execute(f"""
+    async with Database() as db:
+        await db.execute(f"""
             SELECT {field} FROM POLL_CHOICES
             WHERE poll = %s AND reaction = %s
-        """, (poll_id, reaction.encode('unicode-escape')))
+        """, (poll_id, reaction))
 
-        result = db.cursor.fetchone()
-        if result:
-            for key in result:
-                if key in ('reaction', 'text'):
-                    result[key] = result[key].decode('unicode-escape')
-        
-        return result
+        return db.fetchone()
 
 
 async def add_poll_choice(poll_id, reaction, text):
-    with Database() as db:
+    async with Database() as db:
         try:
-            db.cursor.execute("""
+            await db.execute("""
                 INSERT INTO POLL_CHOICES
                 (poll, reaction, text)
                 VALUES
                 (%s, %s, %s)
-            """, (poll_id, reaction.encode('unicode-escape'), 
-                  text.encode('unicode-escape')))
-        except sql.errors.IntegrityError:
+            """, (poll_id, reaction, text))
+        except IntegrityError:
             return False, "UNIQUE constraint failed"
 
 
-async def user_has_response(discord_id, poll_id, reaction):
-    with Database() as db:
-        user_id = await get_user_id(discord_id)
-        choice = await get_poll_choice(poll_id, reaction, field="ID")
-        if choice is None:
-            return
-
-        choice_id = choice['ID']
-        
-        db.cursor.execute("""
-            SELECT ID FROM POLL_RESPONSES
-            WHERE POLL_RESPONSES.user = %s AND POLL_RESPONSES.choice = %s
-        """, (user_id, choice_id))
-
-        return db.cursor.fetchone() is not None
-
+async def toggle_poll_response(discord_id, poll_id, reaction):
+    """
+    Adds the user's response to a poll choice, or removes it if they
+    already have it, within a single transaction.
 
-async def user_add_response(discord_id, poll_id, reaction):
-    with Database() as db:
+    Returns True if the user now has the response, False if it was
+    removed, or None if the poll has no choice for the reaction.
+    """
+    async with transaction() as db:
         user_id = await get_user_id(discord_id)
-        choice = await get_poll_choice(poll_id, reaction, field="ID")
-        choice_id = choice['ID']
-        try:
-            db.cursor.execute("""
-                INSERT INTO POLL_RESPONSES
-                (choice, user)
-                VALUES
-                (%s, %s)
-            """, (choice_id, user_id))
-            return True, None
-        except sql.errors.IntegrityError:
-            return False, "UNIQUE constraint failed"
 
+        # Locking the choice makes toggles of it take turns,
+        # so a double click adds then removes the response
+        await db.execute("""
+            SELECT ID FROM POLL_CHOICES
+            WHERE poll = %s AND reaction = %s
+            FOR UPDATE
+        """, (poll_id, reaction))
 
-async def user_remove_response(discord_id, poll_id, reaction):
-    with Database() as db:
-        user_id = await get_user_id(discord_id)
-        choice = await get_poll_choice(poll_id, reaction, field="ID")
-        choice_id = choice['ID']
+        choice = db.fetchone()
+        if choice is None:
+            return None
 
-        db.cursor.execute("""
+        await db.execute("""
             DELETE FROM POLL_RESPONSES
             WHERE choice = %s AND user = %s
-        """, (choice_id, user_id))
-
-        if db.cursor.rowcount > 0:
-            return True, None
-        return False, "Response did not exist"
+        """, (choice['ID'], user_id))
 
-
-async def get_poll_choices(poll_id):
-    with Database() as db:
-        db.cursor.execute("""
-            SELECT ID, reaction, text
+        has_response = db.rowcount == 0
+        if has_response:
+            await db.execute("""
+                INSERT IGNORE INTO POLL_RESPONSES
+                (choice, user)
+                VALUES
+                (%s, %s)
+            """, (choice['ID'], user_id))
+
+        return has_response
+
+
+async def get_poll_tally(poll_id, voter_limit=3):
+    """
+    Returns every choice of a poll in a single query, each with its
+    number of votes and the discord IDs of up to `voter_limit` voters.
+    """
+    if backend.name == "sqlite":
+        voters = """
+            (SELECT GROUP_CONCAT(discordID, ',') FROM (
+                SELECT USERS.discordID
+                FROM POLL_RESPONSES AS RESPONSES
+                JOIN USERS ON USERS.ID = RESPONSES.user
+                WHERE RESPONSES.choice = POLL_CHOICES.ID
+                ORDER BY RESPONSES.ID
+                LIMIT %s)) AS voters
+        """
+    else:
+        voters = """
+            SUBSTRING_INDEX(
+                GROUP_CONCAT(USERS.discordID
+                             ORDER BY POLL_RESPONSES.ID SEPARATOR ','),
+                ',', %s) AS voters
+        """
+
+    async with Database() as db:
+        await db.execute(f"""
+            SELECT POLL_CHOICES.ID, POLL_CHOICES.reaction, POLL_CHOICES.text,
+                COUNT(POLL_RESPONSES.ID) AS count,
+                {voters}
             FROM POLL_CHOICES
+            LEFT JOIN POLL_RESPONSES
+                ON POLL_RESPONSES.choice = POLL_CHOICES.ID
+            LEFT JOIN USERS
+                ON USERS.ID = POLL_RESPONSES.user
             WHERE POLL_CHOICES.poll = %s
-        """, (poll_id, ))
+            GROUP BY POLL_CHOICES.ID, POLL_CHOICES.reaction, POLL_CHOICES.text
+            ORDER BY POLL_CHOICES.ID
+        """, (voter_limit, poll_id))
 
-        results = db.cursor.fetchall()
-        if results:
-            for result in results:
-                for k in result:
-                    if k in ('reaction', 'text'):
-                        result[k] = result[k].decode('unicode-escape')
+        results = db.fetchall()
+        for result in results:
+            result['count'] = int(result['count'])
+            result['voters'] = ([int(voter) for voter in result['voters'].split(',')]
+                                if result['voters'] else [])
 
         return results
 
 
-async def get_discord_user_ids_for_choice(choice_id):
-    with Database() as db:
-        db.cursor.execute("""
-            SELECT USERS.discordID
-            FROM USERS, POLL_RESPONSES
-            WHERE USERS.ID = POLL_RESPONSES.user AND POLL_RESPONSES.choice = %s 
-        """, (choice_id, ))
+def unescape(value):
+    """Decodes text that was stored with the old unicode-escape encoding."""
+    if isinstance(value, str):
+        value = value.encode('latin-1')
+    return bytes(value).decode('unicode-escape')
 
-        return db.cursor.fetchall()
 
+def message_content(row):
+    """Returns the text of a MESSAGE_LOG row, whichever way it was stored."""
+    if row.get('escaped') and row['content'] is not None:
+        return unescape(row['content'])
+    return row['content']
 
-async def log_message(discord_id, message_id, message, date_sent):
-    with Database() as db:
-        try:
-            user_id = await get_user_id(discord_id)
-            db.cursor.execute(f"""
-                INSERT INTO MESSAGE_LOG
-                (authorID, messageID, content, dateSent)
-                VALUES
-                (%s, %s, %s, %s)
-            """, (user_id, message_id, message, date_sent))
 
-            db.connection.commit()
-            return True
-        except sql.errors.IntegrityError:
-            return False
+async def log_messages(messages):
+    """
+    Inserts a batch of messages into the message log in one statement.
+
+    `messages` is a list of (discord_id, message_id, message, date_sent,
+    channel_id, guild_id) tuples, the number of rows inserted is returned.
+    """
+    async with Database() as db:
+        rows = []
+        for discord_id, message_id, message, date_sent, channel_id, guild_id in messages:
+            user_id = await get_user_id(discord_id)
+            rows.append((user_id, message_id, message, date_sent,
+                         channel_id, guild_id))
+
+        # The driver rewrites this into a single multi-row INSERT
+        await db.executemany("""
+            INSERT INTO MESSAGE_LOG
+            (authorID, messageID, content, dateSent, channelID, guildID)
+            VALUES
+            (%s, %s, %s, %s, %s, %s)
+        """, rows)
+
+        await db.commit()
+        return db.rowcount
+
+
+async def log_message_events(events):
+    """
+    Records a batch of message edits and deletions.
+
+    `events` is a list of (discord_id, message_id, channel_id, event_type,
+    diff, event_date) tuples, where `diff` is a `utils.text_diff` list for
+    edits and None for deletions. The author may be None if it isn't known.
+    """
+    async with Database() as db:
+        rows = []
+        for discord_id, message_id, channel_id, event_type, diff, event_date in events:
+            user_id = await get_user_id(discord_id) if discord_id else None
+            rows.append((message_id, channel_id, user_id, event_type,
+                         json.dumps(diff, ensure_ascii=False) if diff is not None else None,
+                         event_date))
+
+        await db.executemany("""
+            INSERT INTO MESSAGE_EVENTS
+            (messageID, channelID, authorID, eventType, diff, eventDate)
+            VALUES
+            (%s, %s, %s, %s, %s, %s)
+        """, rows)
+
+        await db.commit()
+        return db.rowcount
+
+
+async def get_logged_messages(message_ids):
+    """
+    Looks up logged messages by their Discord message ID, in one query.
+
+    Returns a dict of message ID to a dict with the author's discordID,
+    the content as of its latest recorded edit, and dateSent. Messages that
+    were never logged, or have since been archived, are left out.
+    """
+    message_ids = [str(message_id) for message_id in message_ids]
+    if not message_ids:
+        return {}
+
+    placeholders = ", ".join(["%s"] * len(message_ids))
+    async with Database() as db:
+        await db.execute(f"""
+            SELECT ML.*, U.discordID
+            FROM MESSAGE_LOG ML
+            LEFT JOIN USERS U ON U.ID = ML.authorID
+            WHERE ML.messageID IN ({placeholders})
+        """, message_ids)
+
+        messages = {}
+        for row in db.fetchall():
+            messages[int(row['messageID'])] = {
+                'discordID': int(row['discordID']) if row['discordID'] else None,
+                'content': message_content(row),
+                'dateSent': row['dateSent'],
+            }
+        if not messages:
+            return messages
+
+        await db.execute(f"""
+            SELECT messageID, diff FROM MESSAGE_EVENTS
+            WHERE messageID IN ({placeholders}) AND eventType = 'edit'
+            ORDER BY ID
+        """, message_ids)
+
+        for row in db.fetchall():
+            message = messages.get(int(row['messageID']))
+            if message is not None and message['content'] is not None:
+                message['content'] = ut.apply_text_diff(
+                    message['content'], json.loads(row['diff']))
+
+        return messages
+
+
+async def add_activity(counts):
+    """
+    Adds message counts to the activity rollups.
+
+    `counts` is a dict of (guild_id, channel_id, discord_id, hour) to the
+    number of messages sent, where `hour` is the timestamp the hour starts.
+    """
+    async with Database() as db:
+        rows = []
+        for (guild_id, channel_id, discord_id, hour), messages in counts.items():
+            user_id = await get_user_id(discord_id)
+            rows.append((str(guild_id), hour, str(channel_id), user_id,
+                         messages))
+
+        await upsert_activity(db, rows)
+        await db.commit()
+
+
+async def upsert_activity(db, rows):
+    """
+    Adds rows of (guild_id, hour, channel_id, user_id, messages) to the
+    activity rollups, on the connection of the open block `db`.
+
+    The multi-row statements are built by hand, as the driver's
+    executemany rewrite mangles the VALUES(messages) in the update clause.
+    """
+    for start in range(0, len(rows), ACTIVITY_CHUNK_SIZE):
+        chunk = rows[start:start + ACTIVITY_CHUNK_SIZE]
+        values = ", ".join(["(%s, %s, %s, %s, %s)"] * len(chunk))
+        await db.execute(f"""
+            INSERT INTO ACTIVITY_ROLLUP
+            (guildID, hour, channelID, authorID, messages)
+            VALUES {values}
+            ON DUPLICATE KEY UPDATE messages = messages + VALUES(messages)
+        """, tuple(value for row in chunk for value in row))
+
+
+async def get_leaderboard(guild_id, since, channel_id=None, limit=10):
+    """
+    Returns the users who sent the most messages in a guild since the
+    given timestamp, as a list of dicts with discordID and messages.
+    """
+    channel_filter = "AND AR.channelID = %s" if channel_id is not None else ""
+    params = [str(guild_id), since]
+    if channel_id is not None:
+        params.append(str(channel_id))
+    params.append(limit)
+
+    async with Database() as db:
+        await db.execute(f"""
+            SELECT U.discordID, SUM(AR.messages) AS messages
+            FROM ACTIVITY_ROLLUP AR
+            JOIN USERS U ON U.ID = AR.authorID
+            WHERE AR.guildID = %s AND AR.hour >= %s {channel_filter}
+            GROUP BY U.discordID
+            ORDER BY messages DESC
+            LIMIT %s
+        """, params)
+
+        return [{'discordID': int(row['discordID']),
+                 'messages': int(row['messages'])}
+                for row in db.fetchall()]
+
+
+async def get_activity(guild_id, since, channel_id=None, discord_id=None):
+    """
+    Returns a guild's message counts since the given timestamp, optionally
+    only in one channel or by one user, as a list of dicts of the hour,
+    channelID and messages.
+    """
+    filters = ""
+    params = [str(guild_id), since]
+    if channel_id is not None:
+        filters += " AND AR.channelID = %s"
+        params.append(str(channel_id))
+    if discord_id is not None:
+        filters += " AND U.discordID = %s"
+        params.append(str(discord_id))
+
+    async with Database() as db:
+        await db.execute(f"""
+            SELECT AR.hour, AR.channelID, SUM(AR.messages) AS messages
+            FROM ACTIVITY_ROLLUP AR
+            JOIN USERS U ON U.ID = AR.authorID
+            WHERE AR.guildID = %s AND AR.hour >= %s {filters}
+            GROUP BY AR.hour, AR.channelID
+        """, params)
+
+        return [{'hour': row['hour'], 'channelID': int(row['channelID']),
+                 'messages': int(row['messages'])}
+                for row in db.fetchall()]
+
+
+async def acquire_lease(name, holder, ttl):
+    """
+    Takes or renews the lease `name` for `ttl` seconds, unless another
+    holder's lease on it hasn't expired yet. Returns whether `holder`
+    now holds the lease.
+
+    Expiry is compared against the local clock, so the clocks of the
+    processes sharing a lease must agree to well within `ttl`.
+    """
+    now = time()
+    async with transaction() as db:
+        # The holder is assigned first, MySQL then sees the new holder
+        # when setting the expiry, SQLite sees the old one
+        await db.execute("""
+            INSERT INTO LEASES (name, holder, expires)
+            VALUES (%s, %s, %s)
+            ON DUPLICATE KEY UPDATE
+                holder = CASE WHEN holder = VALUES(holder) OR expires < %s
+                    THEN VALUES(holder) ELSE holder END,
+                expires = CASE WHEN holder = VALUES(holder) OR expires < %s
+                    THEN VALUES(expires) ELSE expires END
+        """, (name, holder, now + ttl, now, now))
+
+        await db.execute("SELECT holder FROM LEASES WHERE name = %s", (name, ))
+        return db.fetchone()['holder'] == holder
+
+
+async def release_lease(name, holder):
+    """Lets another process take the lease straight away."""
+    async with Database() as db:
+        await db.execute("""
+            UPDATE LEASES SET expires = 0
+            WHERE name = %s AND holder = %s
+        """, (name, holder))
+
+        await db.commit()
+
+
+async def get_leases():
+    async with Database() as db:
+        await db.execute("SELECT name, holder, expires FROM LEASES")
+        return db.fetchall()
 
 
 async def test_function():
@@ -596,8 +1517,6 @@ async def test_function():
 
 
 if __name__ == "__main__":
-    import asyncio
-
     loop = asyncio.get_event_loop()
     loop.run_until_complete(test_function())
     loop.close()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Routes reaction and message events to the prompts and messages waiting
+for them.
+
+`bot.wait_for` runs the check of every pending wait against every event,
+so each open prompt slows down every event. Here waits are kept in a dict
+keyed by what they are waiting for, so an event only ever looks at the
+waits that could match it, and timeouts share one timer.
+"""
+
+import asyncio
+import heapq
+import itertools
+
+import metrics
+
+
+def _emoji_check(emojis):
+    emojis = set(emojis)
+
+    def check(reaction, _):
+        return str(reaction.emoji) in emojis
+
+    return check
+
+
+class Waiter:
+    """A single pending wait."""
+
+    __slots__ = ('key', 'future', 'check', 'deadline')
+
+    def __init__(self, key, future, check, deadline):
+        self.key = key
+        self.future = future
+        self.check = check
+        self.deadline = deadline
+
+
+class EventDispatcher:
+    """
+    Waits for reactions on a message by a user, messages in a channel by
+    an author, and edits of a message.
+
+    Waits time out with `asyncio.TimeoutError`, like `bot.wait_for`.
+    Deadlines are kept in a min-heap, and a single timer is set for the
+    earliest one. Finished waits are left in the heap and skipped when
+    they reach the top.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._waiters = {}
+        self._deadlines = []
+        self._counter = itertools.count()
+        self._timer = None
+
+        self.waiting = 0
+        self.max_waiting = 0
+        self.dispatched = 0
+        self.matched = 0
+        self.timed_out = 0
+
+        metrics.registry.register_stats(
+            "bot_dispatcher", self.stats,
+            counters=('dispatched', 'matched', 'timed_out'))
+
+        bot.add_listener(self.on_reaction_add, 'on_reaction_add')
+        bot.add_listener(self.on_message, 'on_message')
+        bot.add_listener(self.on_message_edit, 'on_message_edit')
+
+    def _add(self, waiter):
+        self._waiters.setdefault(waiter.key, []).append(waiter)
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+
+    def _remove(self, waiter):
+        waiters = self._waiters.get(waiter.key)
+        if waiters is None or waiter not in waiters:
+            return
+
+        waiters.remove(waiter)
+        if not waiters:
+            del self._waiters[waiter.key]
+        self.waiting -= 1
+
+    def _schedule(self, waiter):
+        heapq.heappush(self._deadlines,
+                       (waiter.deadline, next(self._counter), waiter))
+        # Only the earliest deadline needs a timer
+        if self._deadlines[0][2] is waiter:
+            if self._timer is not None:
+                self._timer.cancel()
+            loop = asyncio.get_event_loop()
+            self._timer = loop.call_at(waiter.deadline, self._expire)
+
+    def _expire(self):
+        self._timer = None
+        loop = asyncio.get_event_loop()
+        now = loop.time()
+        while self._deadlines:
+            deadline, _, waiter = self._deadlines[0]
+            if waiter.future.done():
+                heapq.heappop(self._deadlines)
+            elif deadline <= now:
+                heapq.heappop(self._deadlines)
+                self._remove(waiter)
+                self.timed_out += 1
+                waiter.future.set_exception(asyncio.TimeoutError())
+            else:
+                self._timer = loop.call_at(deadline, self._expire)
+                return
+
+    async def wait(self, key, timeout=None, check=None):
+        """
+        Waits for the next event dispatched under `key` that passes
+        `check`, and returns the event's arguments.
+        """
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout if timeout is not None else None
+        waiter = Waiter(key, loop.create_future(), check, deadline)
+
+        self._add(waiter)
+        if deadline is not None:
+            self._schedule(waiter)
+
+        try:
+            return await waiter.future
+        finally:
+            # Cleans up after a cancelled wait
+            self._remove(waiter)
+
+    def dispatch(self, key, *args):
+        waiters = self._waiters.get(key)
+        if not waiters:
+            return
+
+        self.dispatched += 1
+        for waiter in list(waiters):
+            if waiter.future.done():
+                continue
+            if waiter.check is not None and not waiter.check(*args):
+                continue
+
+            self._remove(waiter)
+            self.matched += 1
+            waiter.future.set_result(args)
+
+    def wait_for_reaction(self, message_id, user_id, emojis=None,
+                          timeout=None):
+        """
+        Waits for `user_id` to react to `message_id`, optionally with one of
+        `emojis`. Returns the reaction and user, like `bot.wait_for`.
+        """
+        check = _emoji_check(emojis) if emojis is not None else None
+        return self.wait(('reaction_add', message_id, user_id),
+                         timeout=timeout, check=check)
+
+    async def wait_for_message(self, channel_id, author_id, timeout=None):
+        """Waits for `author_id` to send a message in `channel_id`."""
+        message, = await self.wait(('message', channel_id, author_id),
+                                   timeout=timeout)
+        return message
+
+    def wait_for_edit(self, message_id, timeout=None):
+        """Waits for `message_id` to be edited, returns it before and after."""
+        return self.wait(('message_edit', message_id), timeout=timeout)
+
+    async def on_reaction_add(self, reaction, user):
+        self.dispatch(('reaction_add', reaction.message.id, user.id),
+                      reaction, user)
+
+    async def on_message(self, message):
+        self.dispatch(('message', message.channel.id, message.author.id),
+                      message)
+
+    async def on_message_edit(self, before, after):
+        self.dispatch(('message_edit', after.id), before, after)
+
+    def stats(self):
+        return {
+            'waiting': self.waiting,
+            'max_waiting': self.max_waiting,
+            'dispatched': self.dispatched,
+            'matched': self.matched,
+            'timed_out': self.timed_out,
+        }
+
+
+class ReactionRouter:
+    """
+    Sends raw reaction events on interactive messages to the handler
+    registered for that message.
+
+    Cogs register the messages they care about, so a reaction anywhere
+    else is turned away with one dict lookup, and never causes a query or
+    a REST call. Handlers are called with the payload and a message, which
+    is a `discord.PartialMessage` unless the handler was registered with
+    `fetch=True`. A partial message is enough to add or remove reactions
+    and to delete the message without fetching it first, though not to
+    edit it on discord.py 1.6.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._handlers = {}
+
+        self.routed = 0
+        self.ignored = 0
+        self.fetched = 0
+
+        metrics.registry.register_stats(
+            "bot_reaction_router", self.stats,
+            counters=('routed', 'ignored', 'fetched'))
+
+        bot.add_listener(self.on_raw_reaction_add, 'on_raw_reaction_add')
+
+    def register(self, message_id, handler, fetch=False):
+        self._handlers[int(message_id)] = (handler, fetch)
+
+    def unregister(self, message_id):
+        self._handlers.pop(int(message_id), None)
+
+    def __contains__(self, message_id):
+        return int(message_id) in self._handlers
+
+    async def on_raw_reaction_add(self, payload):
+        entry = self._handlers.get(payload.message_id)
+        if entry is None or payload.user_id == self.bot.user.id \
+                or (payload.member is not None and payload.member.bot):
+            self.ignored += 1
+            return
+
+        channel = self.bot.get_channel(payload.channel_id)
+        if channel is None:
+            self.ignored += 1
+            return
+
+        handler, fetch = entry
+        if fetch:
+            message = await channel.fetch_message(payload.message_id)
+            self.fetched += 1
+        else:
+            message = channel.get_partial_message(payload.message_id)
+
+        self.routed += 1
+        await handler(payload, message)
+
+    def stats(self):
+        return {
+            'registered': len(self._handlers),
+            'routed': self.routed,
+            'ignored': self.ignored,
+            'fetched': self.fetched,
+        }
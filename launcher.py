@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Runs the bot as several processes, each connected to a range of its
+shards, and restarts any process that exits.
+
+Each process runs main.py with SHARD_COUNT and SHARD_IDS set, see
+sharding.py. Processes are started one after another, since Discord only
+lets a bot connect a shard every few seconds.
+"""
+
+import argparse
+import asyncio
+import os
+import signal
+import sys
+
+# Load env if we're just running this file.
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
+
+import utils as ut
+
+MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+# Seconds Discord makes a bot wait between connecting shards
+IDENTIFY_INTERVAL = 5
+# Longest wait before restarting a process that keeps exiting
+MAX_RESTART_DELAY = 300
+
+
+def shard_ranges(shard_count, processes):
+    """Splits the shards into `processes` ranges, as evenly as possible."""
+    size, extra = divmod(shard_count, processes)
+    ranges = []
+    start = 0
+    for process in range(processes):
+        end = start + size + (1 if process < extra else 0)
+        if end > start:
+            ranges.append(range(start, end))
+        start = end
+    return ranges
+
+
+async def sleep_unless(stopping, delay):
+    try:
+        await asyncio.wait_for(stopping.wait(), delay)
+    except asyncio.TimeoutError:
+        pass
+
+
+class Worker:
+    """Runs one bot process for a range of shards, restarting it when it exits."""
+
+    def __init__(self, shard_count, shard_ids):
+        self.shard_count = shard_count
+        self.shard_ids = shard_ids
+        self.process = None
+        self.restarts = 0
+
+    @property
+    def name(self):
+        return f"shards {self.shard_ids[0]}-{self.shard_ids[-1]}"
+
+    async def run(self, stopping, delay, metrics_port=0):
+        await sleep_unless(stopping, delay)
+
+        loop = asyncio.get_event_loop()
+        restart_delay = 1
+        while not stopping.is_set():
+            env = dict(os.environ, SHARD_COUNT=str(self.shard_count),
+                       SHARD_IDS=f"{self.shard_ids[0]}-{self.shard_ids[-1]}",
+                       METRICS_PORT=str(metrics_port))
+            started = loop.time()
+            self.process = await asyncio.create_subprocess_exec(
+                sys.executable, MAIN, env=env, cwd=os.path.dirname(MAIN))
+            ut.log_info(f"Started {self.name} as process {self.process.pid}")
+
+            code = await self.process.wait()
+            self.process = None
+            if stopping.is_set():
+                return
+
+            # Backs off while the process keeps exiting soon after starting
+            if loop.time() - started > MAX_RESTART_DELAY:
+                restart_delay = 1
+            ut.log_info(f"{self.name} exited with {code}, "
+                        f"restarting in {restart_delay}s")
+            self.restarts += 1
+            await sleep_unless(stopping, restart_delay)
+            restart_delay = min(restart_delay * 2, MAX_RESTART_DELAY)
+
+    def terminate(self):
+        if self.process is not None and self.process.returncode is None:
+            self.process.terminate()
+
+
+async def main(args):
+    stopping = asyncio.Event()
+    workers = [Worker(args.shards, list(shard_ids))
+               for shard_ids in shard_ranges(args.shards, args.processes)]
+
+    def stop():
+        ut.log_info("Stopping bot processes...")
+        stopping.set()
+        for worker in workers:
+            worker.terminate()
+
+    loop = asyncio.get_event_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop)
+
+    # Each process starts once the shards before it have had time to connect,
+    # and serves its metrics on the port after the one before it
+    delay = 0
+    runs = []
+    for index, worker in enumerate(workers):
+        metrics_port = args.metrics_port + index if args.metrics_port else 0
+        runs.append(worker.run(stopping, delay, metrics_port))
+        delay += len(worker.shard_ids) * args.identify_interval
+    await asyncio.gather(*runs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--shards", type=int,
+                        default=int(os.getenv("SHARD_COUNT", 1)),
+                        help="total number of shards (default SHARD_COUNT, or 1)")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="number of bot processes to split the shards "
+                             "between (default 1)")
+    parser.add_argument("--identify-interval", type=float,
+                        default=IDENTIFY_INTERVAL,
+                        help="seconds allowed for each shard to connect "
+                             f"(default {IDENTIFY_INTERVAL})")
+    parser.add_argument("--metrics-port", type=int,
+                        default=int(os.getenv("METRICS_PORT", 9400)),
+                        help="metrics port of the first process, the others "
+                             "use the ports after it, 0 disables "
+                             "(default METRICS_PORT, or 9400)")
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(args))
+    loop.close()
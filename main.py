@@ -6,7 +6,9 @@ Main file of sheffield uni freshers comp sci discord bot.
 Authored by:
 Felix Randle
 """
+import asyncio
 import os
+import traceback
 from discord.ext import commands
 from dotenv import load_dotenv
 
@@ -14,6 +16,9 @@ from dotenv import load_dotenv
 load_dotenv()
 
 import database as db
+import dispatcher
+import migrations
+import sharding
 import utils as ut
 
 
@@ -22,8 +27,56 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 if BOT_TOKEN is None:
     raise Exception("Cannot find required bot token.")
 
+# Longest wait between attempts at setting up the database
+MAX_SETUP_DELAY = 300
+
+
+# Sharded bots connect to Discord once per shard, see launcher.py
+BotBase = commands.AutoShardedBot if sharding.SHARD_COUNT else commands.Bot
+
+
+class Bot(BotBase):
+    """Bot that cleans up after its cogs and database when it shuts down."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # on_ready fires again after every reconnect,
+        # so startup work is only started the first time
+        self.setup_task = None
+        # Set once the startup work has succeeded
+        self.setup_done = False
+        # Set once the migrations have been applied and the caches loaded
+        self.database_ready = asyncio.Event()
+        # Routes reactions and messages to the prompts waiting for them
+        self.event_dispatcher = dispatcher.EventDispatcher(self)
+        # Routes reactions on interactive messages to the cog that owns them
+        self.reaction_router = dispatcher.ReactionRouter(self)
+        # Connection history of each of this process's shards
+        self.shard_stats = sharding.ShardStats(self)
+
+    async def close(self):
+        await super().close()
+
+        # Lets cogs finish off any work they have buffered
+        for cog in list(self.cogs.values()):
+            shutdown = getattr(cog, "shutdown", None)
+            if shutdown is not None:
+                # One cog failing doesn't stop the rest finishing off
+                try:
+                    await shutdown()
+                except Exception:
+                    traceback.print_exc()
+
+        await db.close_pool()
+
+
 # Set our bot's prefix to ! this must be typed before any command
-bot = commands.Bot(command_prefix="$", case_insensitive=True)
+if sharding.SHARD_COUNT:
+    bot = Bot(command_prefix="$", case_insensitive=True,
+              shard_count=sharding.SHARD_COUNT,
+              shard_ids=sharding.parse_shard_ids(sharding.SHARD_IDS))
+else:
+    bot = Bot(command_prefix="$", case_insensitive=True)
 
 # Load all of our cogs
 if os.path.exists("./cogs"):
@@ -37,7 +90,33 @@ async def on_ready():
     """Run post-launch setup."""
     ut.log_info(f'{bot.user.name} has successfully connected to Discord!')
 
-    await db.create_tables()
+    if bot.setup_task is None:
+        bot.setup_task = bot.loop.create_task(set_up_database())
+
+
+async def set_up_database():
+    """
+    Applies the migrations and loads the caches, retrying with backoff
+    until it succeeds, as everything using the database waits on it.
+    """
+    delay = 1
+    while True:
+        try:
+            await migrations.migrate()
+            await db.warm_user_cache()
+            await db.load_guild_info()
+            await db.load_poll_index()
+            break
+        except Exception as error:
+            traceback.print_exc()
+            ut.log_info(f"Database setup failed with {error!r}, "
+                        f"retrying in {delay}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_SETUP_DELAY)
+
+    bot.setup_done = True
+    bot.database_ready.set()
+    ut.log_info("Database is ready")
 
 @bot.event
 async def on_guild_join(guild):
@@ -52,49 +131,6 @@ async def on_guild_join(guild):
     await db.add_guild(guild.id, registering_id, member_id)
 
 
-@bot.event
-async def on_member_join(member):
-    """Send user a welcome message."""
-    await member.create_dm()
-    await member.dm_channel.send(
-        f'Hey {member.name}, welcome to the University of Sheffield Computer '
-        'Science Freshers Discord!\n'
-        'We like to know who we\'re talking to, so please change your '
-        'nickname on the server to include your real name in some way.\n'
-        'Apart from that, have fun on the server, get to know people and '
-        'feel free to ask any questions about the course that you may have, '
-        'we\'re all here to help each other!\n'
-        'Many thanks,\n'
-        'The Discord Server Admin Team'
-    )
-
-    await db.add_user(member.id, member.bot, member.name)
-
-    role_id = await db.get_guild_info(member.guild.id, "registeringID")
-
-    await add_role(member, role_id)
-
-
-@bot.event
-async def on_raw_reaction_add(payload):
-    if payload.member.bot:
-        return
-
-    expected_id = await db.get_guild_info(payload.guild_id, "welcomeMessageID")
-    if payload.message_id == expected_id:
-        message = await payload.member.guild.get_channel(payload.channel_id).fetch_message(payload.message_id)
-        await message.remove_reaction(payload.emoji, payload.member)
-        if payload.emoji.name == u"\u2705":
-            registering_id = await db.get_guild_info(payload.guild_id, "registeringID")
-            member_id = await db.get_guild_info(payload.guild_id, "memberID")
-
-            await add_role(payload.member, member_id)
-            await remove_role(payload.member, registering_id)
-
-        elif payload.emoji.name == u"\u274E":
-            await payload.member.guild.kick(payload.member, reason="Rejected T's&C's")
-
-
 @bot.event
 async def on_command_error(ctx, error):
     """Handle any command errors that may appear."""
@@ -118,19 +154,6 @@ async def on_command_error(ctx, error):
         ut.log_error(error)
 
 
-async def add_role(member, role_id):
-    role = member.guild.get_role(role_id)
-
-    if role:
-        await member.add_roles(role)
-
-
-async def remove_role(member, role_id):
-    role = member.guild.get_role(role_id)
-
-    if role:
-        await member.remove_roles(role)
-
 # Start the bot
 ut.log_info("Starting bot...")
 bot.run(BOT_TOKEN)
@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Lightweight in-process metrics for the bot."""
+
+import bisect
+import threading
+
+
+def _default_bounds():
+    # Roughly logarithmic buckets from 0.1ms to 60s
+    bounds = []
+    value = 0.0001
+    while value < 60:
+        for step in (1, 2, 5):
+            bounds.append(value * step)
+        value *= 10
+    return bounds
+
+
+DEFAULT_BOUNDS = _default_bounds()
+
+
+class Histogram:
+    """
+    Counts observed values into fixed buckets.
+
+    Percentiles are estimated from the buckets, so memory use stays
+    constant no matter how many values are observed.
+    """
+
+    def __init__(self, bounds=DEFAULT_BOUNDS):
+        self.bounds = list(bounds)
+        # One extra bucket for values above the last bound
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def copy(self):
+        histogram = Histogram(self.bounds)
+        histogram.counts = list(self.counts)
+        histogram.count = self.count
+        histogram.total = self.total
+        histogram.max = self.max
+        return histogram
+
+    def percentile(self, percent):
+        """Returns the upper bound of the bucket holding the given percentile."""
+        if not self.count:
+            return 0.0
+
+        target = self.count * percent / 100
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                if index < len(self.bounds):
+                    return min(self.bounds[index], self.max)
+                return self.max
+        return self.max
+
+    def stats(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'max': self.max,
+        }
+
+
+class QueryStats:
+    """Call counts and timings for the queries made by one function."""
+
+    def __init__(self):
+        self.calls = 0
+        self.queries = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.rows = 0
+        self.latency = Histogram()
+        self.acquire_wait = Histogram()
+
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'queries': self.queries,
+            'errors': self.errors,
+            'timeouts': self.timeouts,
+            'rows': self.rows,
+            'latency': self.latency.stats(),
+            'acquire_wait': self.acquire_wait.stats(),
+        }
+
+
+class QueryMetrics:
+    """
+    Query metrics keyed by the name of the function that made them.
+
+    Written to from the event loop and read from anywhere,
+    a lock keeps snapshots consistent.
+    """
+
+    def __init__(self):
+        self._functions = {}
+        self._lock = threading.Lock()
+
+    def _get(self, function):
+        stats = self._functions.get(function)
+        if stats is None:
+            stats = self._functions[function] = QueryStats()
+        return stats
+
+    def record_call(self, function, wait=None):
+        with self._lock:
+            stats = self._get(function)
+            stats.calls += 1
+            if wait is not None:
+                stats.acquire_wait.observe(wait)
+
+    def record_query(self, function, duration, rows=0, error=None,
+                     timed_out=False):
+        with self._lock:
+            stats = self._get(function)
+            stats.queries += 1
+            stats.rows += rows
+            stats.latency.observe(duration)
+            if timed_out:
+                stats.timeouts += 1
+            elif error is not None:
+                stats.errors += 1
+
+    def reset(self):
+        with self._lock:
+            self._functions.clear()
+
+    def snapshot(self):
+        with self._lock:
+            return {function: stats.stats()
+                    for function, stats in self._functions.items()}
+
+    def values(self, field):
+        """Returns a copy of one count or histogram of every function."""
+        with self._lock:
+            return {function: (getattr(stats, field).copy()
+                               if field in ('latency', 'acquire_wait')
+                               else getattr(stats, field))
+                    for function, stats in self._functions.items()}
+
+
+def _escape(value):
+    return (str(value).replace("\\", "\\\\").replace("\n", "\\n")
+            .replace('"', '\\"'))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"'
+                          for name, value in labels) + "}"
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value) if value == value else "NaN"
+    return str(int(value))
+
+
+class Counter:
+    """A count that only goes up, kept per combination of label values."""
+
+    def __init__(self):
+        self._values = {}
+
+    def inc(self, *label_values, amount=1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def values(self):
+        return dict(self._values)
+
+
+class HistogramFamily:
+    """A `Histogram` per combination of label values."""
+
+    def __init__(self, bounds=DEFAULT_BOUNDS):
+        self.bounds = bounds
+        self._histograms = {}
+
+    def labels(self, *label_values):
+        histogram = self._histograms.get(label_values)
+        if histogram is None:
+            histogram = self._histograms[label_values] = Histogram(self.bounds)
+        return histogram
+
+    def values(self):
+        return dict(self._histograms)
+
+
+class Metric:
+    """A named metric, and the functions its samples are read from."""
+
+    def __init__(self, name, help, kind, label_names):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.label_names = tuple(label_names)
+        # Constant labels of each source, to the function returning its value
+        self.sources = {}
+
+    def samples(self):
+        """
+        Yields the labels and value of each sample. Sources return a
+        single value, or a dict of label values to values.
+        """
+        for labels, func in list(self.sources.items()):
+            value = func()
+            if not isinstance(value, dict):
+                yield labels, value
+                continue
+
+            for label_values, sample in value.items():
+                if not isinstance(label_values, tuple):
+                    label_values = (label_values, )
+                yield labels + tuple(zip(self.label_names, label_values)), sample
+
+    def render(self):
+        lines = [f"# HELP {self.name} {_escape(self.help)}",
+                 f"# TYPE {self.name} {self.kind}"]
+        for labels, value in self.samples():
+            if self.kind != "histogram":
+                lines.append(f"{self.name}{_format_labels(labels)} "
+                             f"{_format_value(value)}")
+                continue
+
+            cumulative = 0
+            for bound, count in zip(value.bounds, value.counts):
+                cumulative += count
+                bucket = labels + (("le", f"{bound:g}"), )
+                lines.append(f"{self.name}_bucket{_format_labels(bucket)} "
+                             f"{cumulative}")
+            bucket = labels + (("le", "+Inf"), )
+            lines.append(f"{self.name}_bucket{_format_labels(bucket)} "
+                         f"{value.count}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} "
+                         f"{_format_value(float(value.total))}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} "
+                         f"{value.count}")
+        return "\n".join(lines)
+
+
+class Registry:
+    """
+    Metrics exported in the Prometheus text format.
+
+    Counters and histograms made here are updated as things happen.
+    Values that components already keep are registered as functions, and
+    only read when the metrics are rendered. Registering a source again
+    with the same constant labels replaces it, so reloaded cogs don't
+    leave stale copies behind.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+
+    def _metric(self, name, help, kind, label_names=()):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = Metric(name, help, kind,
+                                                  label_names)
+        elif metric.kind != kind:
+            raise ValueError(f"{name} is already registered as a {metric.kind}")
+        return metric
+
+    def register(self, name, help, func, kind="gauge", label_names=(),
+                 labels=None):
+        """
+        Registers `func` as a source of the metric `name`. It returns a
+        value, or a dict of `label_names` values to values, and the
+        sample is given the constant `labels`.
+        """
+        labels = tuple(sorted((labels or {}).items()))
+        self._metric(name, help, kind, label_names).sources[labels] = func
+
+    def counter(self, name, help, label_names=()):
+        counter = Counter()
+        self.register(name, help, counter.values, "counter", label_names)
+        return counter
+
+    def histogram(self, name, help, label_names=(), bounds=DEFAULT_BOUNDS):
+        histograms = HistogramFamily(bounds)
+        self.register(name, help, histograms.values, "histogram", label_names)
+        return histograms
+
+    def register_stats(self, prefix, stats, counters=(), labels=None):
+        """
+        Registers each number in the dict returned by `stats` as a metric
+        named after its key. Keys in `counters` are registered as
+        counters, the rest as gauges.
+        """
+        for key, value in stats().items():
+            if not isinstance(value, (int, float)):
+                continue
+
+            def read(key=key):
+                return stats()[key]
+
+            help = key.replace('_', ' ').capitalize()
+            if key in counters:
+                self.register(f"{prefix}_{key}_total", help, read, "counter",
+                              labels=labels)
+            else:
+                self.register(f"{prefix}_{key}", help, read, labels=labels)
+
+    def render(self):
+        return "\n".join(metric.render()
+                         for metric in self._metrics.values()) + "\n"
+
+
+# Every metric exported by the bot
+registry = Registry()
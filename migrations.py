@@ -0,0 +1,740 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Versioned schema migrations for the bot's database.
+
+Each migration is applied once, in order, and the versions that have been
+applied are recorded in the SCHEMA_VERSION table. Run this file directly
+with --dry-run to print the pending migrations without applying them.
+"""
+
+import argparse
+import asyncio
+from time import time
+
+# Load env if we're just running this file.
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
+
+import archive
+import database as db
+import utils as ut
+
+# Name of the lock that stops two processes migrating at once
+MIGRATION_LOCK = "sheffield_bot_migrations"
+# Seconds a single migration statement may take
+MIGRATION_TIMEOUT = 3600
+# Seconds each attempt at taking the migration lock waits, kept well
+# under the query timeout
+LOCK_ATTEMPT_WAIT = 5
+
+MIGRATIONS = []
+
+
+def migration(version, description):
+    """
+    Registers a migration.
+
+    The decorated coroutine is passed an open `Database` and returns the
+    list of statements to run, so it can inspect the schema first and
+    leave out anything that has already been done. Steps that can't be
+    written in SQL are given as coroutine functions taking the `Database`,
+    and are described by their docstring in a dry run.
+    """
+    def decorator(func):
+        MIGRATIONS.append((version, description, func))
+        return func
+
+    return decorator
+
+
+async def index_exists(conn, table, index):
+    if db.backend.name == "sqlite":
+        await conn.execute("""
+            SELECT 1 FROM sqlite_master
+            WHERE type = 'index' AND tbl_name = %s AND name = %s
+        """, (table, index))
+        return conn.fetchone() is not None
+
+    await conn.execute("""
+        SELECT 1 FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE()
+            AND TABLE_NAME = %s AND INDEX_NAME = %s
+        LIMIT 1
+    """, (table, index))
+
+    return conn.fetchone() is not None
+
+
+async def table_exists(conn, table):
+    if db.backend.name == "sqlite":
+        await conn.execute("""
+            SELECT 1 FROM sqlite_master
+            WHERE type = 'table' AND name = %s
+        """, (table, ))
+        return conn.fetchone() is not None
+
+    await conn.execute("""
+        SELECT 1 FROM information_schema.TABLES
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+        LIMIT 1
+    """, (table, ))
+
+    return conn.fetchone() is not None
+
+
+async def column_exists(conn, table, column):
+    if db.backend.name == "sqlite":
+        await conn.execute("""
+            SELECT 1 FROM pragma_table_info(%s)
+            WHERE name = %s
+        """, (table, column))
+        return conn.fetchone() is not None
+
+    await conn.execute("""
+        SELECT 1 FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE()
+            AND TABLE_NAME = %s AND COLUMN_NAME = %s
+        LIMIT 1
+    """, (table, column))
+
+    return conn.fetchone() is not None
+
+
+async def create_missing_indexes(conn, indexes):
+    """Returns CREATE INDEX statements for any of `indexes` that are missing."""
+    statements = []
+    for table, index, columns in indexes:
+        if not await index_exists(conn, table, index):
+            statements.append(
+                f"CREATE INDEX {index} ON {table} ({', '.join(columns)})")
+
+    return statements
+
+
+@migration(1, "Create initial tables")
+async def create_tables(conn):
+    if db.backend.name == "sqlite":
+        return SQLITE_TABLES
+
+    return [
+        """
+        CREATE TABLE IF NOT EXISTS
+        USERS (
+            ID INT NOT NULL AUTO_INCREMENT,
+            name VARCHAR(255) NOT NULL,
+            discordID VARCHAR(255) UNIQUE NOT NULL,
+            jamming INT,
+            PRIMARY KEY (ID)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS
+        JAM_TEAM (
+            ID INT NOT NULL AUTO_INCREMENT,
+            teamName VARCHAR(255) NOT NULL UNIQUE,
+            gitLink VARCHAR(255) NOT NULL UNIQUE,
+            PRIMARY KEY (ID)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS
+        JAM_TEAM_MEMBER (
+            ID INT NOT NULL AUTO_INCREMENT,
+            teamID INT NOT NULL,
+            userID INT NOT NULL UNIQUE,
+            creator INT NOT NULL DEFAULT 0,
+            PRIMARY KEY (ID)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS
+        EVENTS (
+            ID INT PRIMARY KEY AUTO_INCREMENT,
+            title VARCHAR(255) NOT NULL,
+            description VARCHAR(1024) NOT NULL,
+            date DATETIME NOT NULL,
+            creator INT NOT NULL,
+            FOREIGN KEY (creator)
+                REFERENCES USERS(ID)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS
+        GUILDS (
+            ID INT PRIMARY KEY AUTO_INCREMENT,
+            guildID VARCHAR(255) NOT NULL UNIQUE,
+            registeringID VARCHAR(255) UNIQUE,
+            memberID VARCHAR(255) UNIQUE,
+            welcomeMessageID VARCHAR(255) UNIQUE
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS
+        CHANNELS (
+            ID INT PRIMARY KEY AUTO_INCREMENT,
+            channelID VARCHAR(255) NOT NULL UNIQUE,
+            voice INT NOT NULL,
+            owner INT NOT NULL UNIQUE,
+            createdDate INT NOT NULL,
+
+            FOREIGN KEY (owner)
+                REFERENCES USERS(ID)
+        )""",
+        """
+        CREATE TABLE IF NOT EXISTS
+        POLLS (
+            ID INT PRIMARY KEY AUTO_INCREMENT,
+            messageID VARCHAR(255) NOT NULL,
+            channelID VARCHAR(255) NOT NULL,
+            guild INT NOT NULL,
+            creator INT NOT NULL,
+            title VARCHAR(255) NOT NULL,
+            endDate INT NOT NULL,
+            ended BOOLEAN NOT NULL DEFAULT FALSE,
+
+            FOREIGN KEY(creator)
+                REFERENCES USERS(ID),
+            FOREIGN KEY(guild)
+                REFERENCES GUILDS(ID)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS
+        POLL_CHOICES (
+            ID INT PRIMARY KEY AUTO_INCREMENT,
+            poll INT NOT NULL,
+            reaction VARCHAR(255) NOT NULL,
+            text VARCHAR(255) NOT NULL,
+
+            UNIQUE KEY (poll, reaction),
+            FOREIGN KEY (poll)
+                REFERENCES POLLS(ID)
+                ON DELETE CASCADE
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS
+        POLL_RESPONSES (
+            ID INT PRIMARY KEY AUTO_INCREMENT,
+            user INT NOT NULL,
+            choice INT NOT NULL,
+
+            UNIQUE KEY (user, choice),
+            FOREIGN KEY (user)
+                REFERENCES USERS(ID),
+            FOREIGN KEY (choice)
+                REFERENCES POLL_CHOICES(ID)
+                ON DELETE CASCADE
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS
+        MESSAGE_LOG (
+            ID INT PRIMARY KEY AUTO_INCREMENT,
+            authorID INT NOT NULL,
+            messageID VARCHAR(255) NOT NULL,
+            content VARCHAR(4096),
+            dateSent INT NOT NULL,
+            FOREIGN KEY (authorID)
+                REFERENCES USERS(ID)
+        )
+        """
+    ]
+
+
+# The initial tables written for SQLite, which only allows
+# AUTOINCREMENT on a column declared as INTEGER PRIMARY KEY
+SQLITE_TABLES = [
+    """
+    CREATE TABLE IF NOT EXISTS
+    USERS (
+        ID INTEGER PRIMARY KEY AUTOINCREMENT,
+        name VARCHAR(255) NOT NULL,
+        discordID VARCHAR(255) UNIQUE NOT NULL,
+        jamming INT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS
+    JAM_TEAM (
+        ID INTEGER PRIMARY KEY AUTOINCREMENT,
+        teamName VARCHAR(255) NOT NULL UNIQUE,
+        gitLink VARCHAR(255) NOT NULL UNIQUE
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS
+    JAM_TEAM_MEMBER (
+        ID INTEGER PRIMARY KEY AUTOINCREMENT,
+        teamID INT NOT NULL,
+        userID INT NOT NULL UNIQUE,
+        creator INT NOT NULL DEFAULT 0
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS
+    EVENTS (
+        ID INTEGER PRIMARY KEY AUTOINCREMENT,
+        title VARCHAR(255) NOT NULL,
+        description VARCHAR(1024) NOT NULL,
+        date DATETIME NOT NULL,
+        creator INT NOT NULL REFERENCES USERS(ID)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS
+    GUILDS (
+        ID INTEGER PRIMARY KEY AUTOINCREMENT,
+        guildID VARCHAR(255) NOT NULL UNIQUE,
+        registeringID VARCHAR(255) UNIQUE,
+        memberID VARCHAR(255) UNIQUE,
+        welcomeMessageID VARCHAR(255) UNIQUE
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS
+    CHANNELS (
+        ID INTEGER PRIMARY KEY AUTOINCREMENT,
+        channelID VARCHAR(255) NOT NULL UNIQUE,
+        voice INT NOT NULL,
+        owner INT NOT NULL UNIQUE REFERENCES USERS(ID),
+        createdDate INT NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS
+    POLLS (
+        ID INTEGER PRIMARY KEY AUTOINCREMENT,
+        messageID VARCHAR(255) NOT NULL,
+        channelID VARCHAR(255) NOT NULL,
+        guild INT NOT NULL REFERENCES GUILDS(ID),
+        creator INT NOT NULL REFERENCES USERS(ID),
+        title VARCHAR(255) NOT NULL,
+        endDate INT NOT NULL,
+        ended BOOLEAN NOT NULL DEFAULT FALSE
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS
+    POLL_CHOICES (
+        ID INTEGER PRIMARY KEY AUTOINCREMENT,
+        poll INT NOT NULL REFERENCES POLLS(ID) ON DELETE CASCADE,
+        reaction VARCHAR(255) NOT NULL,
+        text VARCHAR(255) NOT NULL,
+
+        UNIQUE (poll, reaction)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS
+    POLL_RESPONSES (
+        ID INTEGER PRIMARY KEY AUTOINCREMENT,
+        user INT NOT NULL REFERENCES USERS(ID),
+        choice INT NOT NULL REFERENCES POLL_CHOICES(ID) ON DELETE CASCADE,
+
+        UNIQUE (user, choice)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS
+    MESSAGE_LOG (
+        ID INTEGER PRIMARY KEY AUTOINCREMENT,
+        authorID INT NOT NULL REFERENCES USERS(ID),
+        messageID VARCHAR(255) NOT NULL,
+        content VARCHAR(4096),
+        dateSent INT NOT NULL
+    )
+    """,
+]
+
+
+@migration(2, "Index poll and message log lookups")
+async def add_lookup_indexes(conn):
+    return await create_missing_indexes(conn, (
+        ("POLLS", "idx_polls_message", ("messageID", )),
+        ("POLLS", "idx_polls_ended_end", ("ended", "endDate")),
+        ("MESSAGE_LOG", "idx_message_log_message", ("messageID", )),
+        ("MESSAGE_LOG", "idx_message_log_author_date",
+         ("authorID", "dateSent")),
+    ))
+
+
+async def unescape_poll_choices(conn):
+    """Decode the unicode-escaped reaction and text of every poll choice"""
+    await conn.execute("""
+        SELECT ID, reaction, text FROM POLL_CHOICES
+        WHERE escaped = TRUE
+    """)
+
+    rows = [(db.unescape(row['reaction']), db.unescape(row['text']), row['ID'])
+            for row in conn.fetchall()]
+    if rows:
+        await conn.executemany("""
+            UPDATE POLL_CHOICES
+            SET reaction = %s, text = %s, escaped = FALSE
+            WHERE ID = %s
+        """, rows, timeout=MIGRATION_TIMEOUT)
+
+
+@migration(3, "Store text as utf8mb4 instead of unicode-escaped utf8")
+async def use_utf8mb4(conn):
+    if db.backend.name == "sqlite":
+        # SQLite always stores UTF-8, and its tables
+        # were never written to with unicode-escape
+        return [
+            f"""
+            ALTER TABLE {table}
+            ADD COLUMN escaped BOOLEAN NOT NULL DEFAULT FALSE
+            """
+            for table in ("POLL_CHOICES", "MESSAGE_LOG")
+            if not await column_exists(conn, table, "escaped")
+        ]
+
+    statements = [
+        f"ALTER TABLE {table} CONVERT TO CHARACTER SET utf8mb4 "
+        "COLLATE utf8mb4_unicode_ci"
+        for table in ("USERS", "JAM_TEAM", "EVENTS", "POLLS",
+                      "POLL_CHOICES", "MESSAGE_LOG")
+    ]
+
+    # Emoji are compared byte for byte, as the unicode collation
+    # treats many different emoji as equal
+    statements.append("""
+        ALTER TABLE POLL_CHOICES
+        MODIFY reaction VARCHAR(255)
+            CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL
+    """)
+
+    # Existing rows are flagged as escaped, rows added from now on aren't
+    for table in ("POLL_CHOICES", "MESSAGE_LOG"):
+        if not await column_exists(conn, table, "escaped"):
+            statements.append(f"""
+                ALTER TABLE {table}
+                ADD COLUMN escaped BOOLEAN NOT NULL DEFAULT TRUE
+            """)
+        statements.append(f"""
+            ALTER TABLE {table}
+            ALTER COLUMN escaped SET DEFAULT FALSE
+        """)
+
+    # Poll choices are few enough to convert straight away, the message
+    # log is converted in batches by unescape_message_log
+    statements.append(unescape_poll_choices)
+    return statements
+
+
+@migration(4, "Partition the message log by month")
+async def partition_message_log(conn):
+    """
+    Splits MESSAGE_LOG into monthly partitions on dateSent, so archived
+    months can be dropped whole instead of deleted row by row.
+
+    MySQL doesn't allow foreign keys on partitioned tables, and needs the
+    partition column in the primary key, so both are changed first.
+    This rebuilds the table, so it takes a while on a large message log.
+    SQLite has no partitioning, there the archiver's batched deletes are
+    all that's needed.
+    """
+    if db.backend.name == "sqlite":
+        return []
+    if await archive.get_partitions(conn):
+        return []
+
+    await conn.execute("""
+        SELECT CONSTRAINT_NAME AS name
+        FROM information_schema.REFERENTIAL_CONSTRAINTS
+        WHERE CONSTRAINT_SCHEMA = DATABASE() AND TABLE_NAME = 'MESSAGE_LOG'
+    """)
+    statements = [f"ALTER TABLE MESSAGE_LOG DROP FOREIGN KEY {row['name']}"
+                  for row in conn.fetchall()]
+
+    statements.append("""
+        ALTER TABLE MESSAGE_LOG
+        DROP PRIMARY KEY,
+        ADD PRIMARY KEY (ID, dateSent)
+    """)
+
+    now = int(time())
+    oldest = now
+    # In a dry run on a new database, migration 1 hasn't created it yet
+    if await table_exists(conn, "MESSAGE_LOG"):
+        await conn.execute("SELECT MIN(dateSent) AS oldest FROM MESSAGE_LOG")
+        oldest = conn.fetchone()['oldest'] or now
+    definitions = ",\n".join(
+        f"PARTITION {name} VALUES LESS THAN ({bound})"
+        for name, bound in archive.month_partitions(
+            oldest, archive.months_ahead(now)))
+    statements.append(f"""
+        ALTER TABLE MESSAGE_LOG
+        PARTITION BY RANGE (dateSent) (
+            {definitions},
+            PARTITION pmax VALUES LESS THAN MAXVALUE
+        )
+    """)
+
+    return statements
+
+
+@migration(5, "Log message edits and deletions")
+async def add_message_events(conn):
+    if db.backend.name == "sqlite":
+        return [
+            """
+            CREATE TABLE IF NOT EXISTS
+            MESSAGE_EVENTS (
+                ID INTEGER PRIMARY KEY AUTOINCREMENT,
+                messageID VARCHAR(255) NOT NULL,
+                channelID VARCHAR(255),
+                authorID INT,
+                eventType VARCHAR(16) NOT NULL,
+                diff TEXT,
+                eventDate INT NOT NULL
+            )
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_message_events_message
+            ON MESSAGE_EVENTS (messageID)
+            """,
+        ]
+
+    # Edits are stored as a diff against the previous content,
+    # see utils.text_diff
+    return [
+        """
+        CREATE TABLE IF NOT EXISTS
+        MESSAGE_EVENTS (
+            ID INT PRIMARY KEY AUTO_INCREMENT,
+            messageID VARCHAR(255) NOT NULL,
+            channelID VARCHAR(255),
+            authorID INT,
+            eventType VARCHAR(16) NOT NULL,
+            diff TEXT,
+            eventDate INT NOT NULL,
+            INDEX idx_message_events_message (messageID)
+        ) CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci
+        """
+    ]
+
+
+@migration(6, "Roll up message activity per channel, user and hour")
+async def add_activity_rollups(conn):
+    """
+    Adds the channel and guild to logged messages, and the ACTIVITY_ROLLUP
+    table that counts messages per guild, channel, user and hour.
+
+    Messages logged before this migration are counted by
+    rollups.backfill, up to the last message ID recorded here.
+    """
+    statements = [
+        f"ALTER TABLE MESSAGE_LOG ADD COLUMN {column} VARCHAR(255)"
+        for column in ("channelID", "guildID")
+        if not await column_exists(conn, "MESSAGE_LOG", column)
+    ]
+
+    statements += [
+        """
+        CREATE TABLE IF NOT EXISTS
+        ACTIVITY_ROLLUP (
+            guildID VARCHAR(255) NOT NULL,
+            hour INT NOT NULL,
+            channelID VARCHAR(255) NOT NULL,
+            authorID INT NOT NULL,
+            messages INT NOT NULL,
+            PRIMARY KEY (guildID, hour, channelID, authorID)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS
+        ROLLUP_STATE (
+            name VARCHAR(64) PRIMARY KEY,
+            value BIGINT NOT NULL
+        )
+        """,
+        # Messages from here on are counted as they are logged
+        """
+        INSERT IGNORE INTO ROLLUP_STATE (name, value)
+        SELECT 'backfillUntil', COALESCE(MAX(ID), 0) FROM MESSAGE_LOG
+        """,
+        """
+        INSERT IGNORE INTO ROLLUP_STATE (name, value)
+        VALUES ('backfilledID', 0)
+        """,
+    ]
+
+    return statements
+
+
+@migration(7, "Add leases for electing a leader among bot processes")
+async def add_leases(conn):
+    """
+    Adds the LEASES table, used by sharding.LeaderElection so background
+    jobs run in only one process.
+    """
+    return [
+        """
+        CREATE TABLE IF NOT EXISTS
+        LEASES (
+            name VARCHAR(64) PRIMARY KEY,
+            holder VARCHAR(255) NOT NULL,
+            expires DOUBLE NOT NULL
+        )
+        """
+    ]
+
+
+async def unescape_message_log(batch_size=1000, pause=0.1):
+    """
+    Converts message log rows stored with the old unicode-escape encoding,
+    a batch at a time, while the bot carries on logging.
+
+    Returns the number of rows converted.
+    """
+    converted = 0
+    last_id = 0
+    while True:
+        async with db.transaction() as conn:
+            # Walks the primary key so each batch only touches its own rows
+            await conn.execute("""
+                SELECT ID, content FROM MESSAGE_LOG
+                WHERE ID > %s AND escaped = TRUE
+                ORDER BY ID
+                LIMIT %s
+            """, (last_id, batch_size))
+
+            rows = conn.fetchall()
+            if not rows:
+                return converted
+
+            await conn.executemany("""
+                UPDATE MESSAGE_LOG
+                SET content = %s, escaped = FALSE
+                WHERE ID = %s
+            """, [(db.message_content(dict(row, escaped=True)), row['ID'])
+                  for row in rows])
+
+        converted += len(rows)
+        last_id = rows[-1]['ID']
+        ut.log_info(f"Converted {converted} message log rows")
+        await asyncio.sleep(pause)
+
+
+async def get_schema_version(conn, create=True):
+    """
+    Returns the newest migration applied, 0 if there is none. Without
+    `create`, a missing SCHEMA_VERSION table is left missing.
+    """
+    if not create and not await table_exists(conn, "SCHEMA_VERSION"):
+        return 0
+
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS
+        SCHEMA_VERSION (
+            version INT PRIMARY KEY,
+            description VARCHAR(255) NOT NULL,
+            appliedDate INT NOT NULL
+        )
+    """)
+    await conn.execute("SELECT MAX(version) AS version FROM SCHEMA_VERSION")
+
+    return conn.fetchone()['version'] or 0
+
+
+def describe(statement):
+    if callable(statement):
+        return f"({statement.__doc__.strip().splitlines()[0]})"
+    return ' '.join(statement.split())
+
+
+async def migrate(dry_run=False):
+    """
+    Applies every migration newer than the current schema version.
+
+    With `dry_run`, the plan is printed and nothing is changed.
+    Returns the list of versions that were (or would be) applied.
+    """
+    applied = []
+    # SQLite databases are only used by one process
+    use_lock = db.backend.name == "mysql"
+    async with db.Database() as conn:
+        if use_lock:
+            # Another process may hold the lock for as long as its
+            # longest migration takes
+            waited = 0
+            while True:
+                await conn.execute("SELECT GET_LOCK(%s, %s) AS locked",
+                                   (MIGRATION_LOCK, LOCK_ATTEMPT_WAIT))
+                if conn.fetchone()['locked']:
+                    break
+
+                if waited == 0:
+                    ut.log_info("Waiting for another process to migrate...")
+                waited += LOCK_ATTEMPT_WAIT
+                if waited >= MIGRATION_TIMEOUT:
+                    ut.log_error("Timed out waiting for another process "
+                                 "to migrate")
+
+        try:
+            current = await get_schema_version(conn, create=not dry_run)
+            for version, description, plan in sorted(MIGRATIONS):
+                if version <= current:
+                    continue
+
+                statements = await plan(conn)
+                if dry_run:
+                    print(f"Migration {version}: {description}")
+                    for statement in statements:
+                        print(f"    {describe(statement)}")
+                    applied.append(version)
+                    continue
+
+                ut.log_info(f"Applying migration {version}: {description}")
+                for statement in statements:
+                    try:
+                        if callable(statement):
+                            await statement(conn)
+                        else:
+                            await conn.execute(statement,
+                                               timeout=MIGRATION_TIMEOUT)
+                    except db.DatabaseError as error:
+                        ut.log_error(f"Migration {version} failed on "
+                                     f"\n'{describe(statement)}'\n "
+                                     f"with {error}")
+
+                await conn.execute("""
+                    INSERT INTO SCHEMA_VERSION
+                    (version, description, appliedDate)
+                    VALUES
+                    (%s, %s, %s)
+                """, (version, description, int(time())))
+                await conn.commit()
+                applied.append(version)
+        finally:
+            if use_lock:
+                await conn.execute("SELECT RELEASE_LOCK(%s)",
+                                   (MIGRATION_LOCK, ))
+
+    if dry_run and not applied:
+        print("Schema is up to date.")
+    return applied
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--dry-run", action="store_true",
+                        help="print the pending migrations without applying them")
+    parser.add_argument("--unescape-messages", action="store_true",
+                        help="convert message log rows stored with the old "
+                             "unicode-escape encoding, in batches")
+    parser.add_argument("--batch-size", type=int, default=1000,
+                        help="rows converted per batch (default 1000)")
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(migrate(dry_run=args.dry_run))
+    if args.unescape_messages and not args.dry_run:
+        loop.run_until_complete(
+            unescape_message_log(batch_size=args.batch_size))
+    loop.run_until_complete(db.close_pool())
+    loop.close()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Hourly message activity rollups.
+
+Messages are counted per guild, channel, user and hour as they are logged,
+so activity statistics never need to scan the message log. Run this file
+directly to count the messages logged before the rollups existed.
+"""
+
+import argparse
+import asyncio
+import os
+import traceback
+
+# Load env if we're just running this file.
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
+
+import database as db
+import utils as ut
+
+# Seconds between writes of the counts kept in memory
+ACTIVITY_FLUSH_INTERVAL = float(os.getenv("ACTIVITY_FLUSH_INTERVAL", 60))
+# Channel recorded for messages logged before channels were
+UNKNOWN_CHANNEL = 0
+
+
+def hour_of(timestamp):
+    return int(timestamp) - int(timestamp) % 3600
+
+
+class ActivityRollup:
+    """
+    Counts messages in memory and adds the counts to the ACTIVITY_ROLLUP
+    table every `flush_interval` seconds, so each busy channel costs
+    one row write per user per hour rather than one per message.
+    """
+
+    def __init__(self, flush_interval):
+        self.flush_interval = flush_interval
+        self._counts = {}
+        self._task = None
+        self._stopping = None
+
+        self.counted = 0
+        self.flushes = 0
+        self.failures = 0
+
+    def add(self, guild_id, channel_id, discord_id, date_sent):
+        key = (guild_id, channel_id, discord_id, hour_of(date_sent))
+        self._counts[key] = self._counts.get(key, 0) + 1
+        self.counted += 1
+
+    def start(self, loop, wait_until_ready=None):
+        self._stopping = asyncio.Event()
+        self._task = loop.create_task(self._run(wait_until_ready))
+
+    async def flush(self):
+        if not self._counts:
+            return
+
+        counts, self._counts = self._counts, {}
+        try:
+            await db.add_activity(counts)
+            self.flushes += 1
+        except asyncio.CancelledError:
+            # Kept for close() to write out
+            self._restore(counts)
+            raise
+        except Exception:
+            self.failures += 1
+            traceback.print_exc()
+            # Kept for the next flush, along with anything counted since
+            self._restore(counts)
+
+    def _restore(self, counts):
+        for key, messages in counts.items():
+            self._counts[key] = self._counts.get(key, 0) + messages
+
+    async def _run(self, wait_until_ready):
+        if wait_until_ready is not None:
+            waiting = asyncio.ensure_future(wait_until_ready())
+            stopping = asyncio.ensure_future(self._stopping.wait())
+            await asyncio.wait((waiting, stopping),
+                               return_when=asyncio.FIRST_COMPLETED)
+            waiting.cancel()
+            stopping.cancel()
+
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(),
+                                       self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    async def close(self):
+        """Stops the background task, writing out what has been counted."""
+        if self._task is None:
+            return
+
+        self._stopping.set()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            # Already cancelled, as discord.py cancels every task
+            # when the bot is stopped by a signal
+            pass
+        self._task = None
+
+        await self.flush()
+
+    def stats(self):
+        return {
+            'pending': len(self._counts),
+            'counted': self.counted,
+            'flushes': self.flushes,
+            'failures': self.failures,
+        }
+
+
+async def get_state(conn, name):
+    await conn.execute("SELECT value FROM ROLLUP_STATE WHERE name = %s",
+                       (name, ))
+    return conn.fetchone()['value']
+
+
+async def backfill(guild_id=None, chunk_size=10000, pause=0.1):
+    """
+    Counts the messages logged before the rollups were added, a range of
+    IDs at a time. Each chunk's counts and the progress made are committed
+    together, so the backfill can be stopped and rerun without counting
+    anything twice.
+
+    Messages logged before their guild was recorded are counted in
+    `guild_id`, or skipped if it isn't given. Returns the number of
+    messages counted.
+    """
+    counted = 0
+    while True:
+        async with db.transaction() as conn:
+            until = await get_state(conn, "backfillUntil")
+            start = await get_state(conn, "backfilledID")
+            if start >= until:
+                return counted
+            end = min(start + chunk_size, until)
+
+            await conn.execute("""
+                SELECT COALESCE(guildID, %s) AS guildID,
+                    COALESCE(channelID, %s) AS channelID,
+                    authorID, dateSent - dateSent % 3600 AS hour,
+                    COUNT(*) AS messages
+                FROM MESSAGE_LOG
+                WHERE ID > %s AND ID <= %s
+                GROUP BY 1, 2, 3, 4
+            """, (None if guild_id is None else str(guild_id),
+                  str(UNKNOWN_CHANNEL), start, end))
+            rows = [(row['guildID'], row['hour'], row['channelID'],
+                     row['authorID'], int(row['messages']))
+                    for row in conn.fetchall() if row['guildID'] is not None]
+
+            await db.upsert_activity(conn, rows)
+
+            await conn.execute("""
+                UPDATE ROLLUP_STATE SET value = %s
+                WHERE name = 'backfilledID'
+            """, (end, ))
+
+        counted += sum(row[4] for row in rows)
+        ut.log_info(f"Backfilled activity up to message log ID {end} of {until}")
+        await asyncio.sleep(pause)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--guild", type=int,
+                        help="guild to count messages logged without one in")
+    parser.add_argument("--chunk-size", type=int, default=10000,
+                        help="message log IDs counted per chunk (default 10000)")
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    total = loop.run_until_complete(
+        backfill(guild_id=args.guild, chunk_size=args.chunk_size))
+    print(f"Counted {total} messages")
+    loop.run_until_complete(db.close_pool())
+    loop.close()
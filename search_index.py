@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Full-text index of logged messages for the $search command.
+
+MySQL can't put a FULLTEXT index on the partitioned message log, so
+messages are indexed in a local SQLite FTS5 database instead, fed by the
+message log writer as batches are written. Run this file directly with
+--rebuild to index the messages already in the database and archive.
+"""
+
+import argparse
+import asyncio
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+# Load env if we're just running this file.
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
+
+import archive
+import database as db
+import metrics
+import utils as ut
+
+# File the search index is kept in
+SEARCH_INDEX_PATH = os.getenv("SEARCH_INDEX_PATH", "search.sqlite3")
+
+# Discord IDs are snowflakes, whose top bits are the milliseconds
+# since this epoch, so they sort by the time the message was sent
+DISCORD_EPOCH = 1420070400000
+
+
+def snowflake_at(timestamp):
+    """Returns the lowest snowflake created at `timestamp`."""
+    return max(int(timestamp * 1000) - DISCORD_EPOCH, 0) << 22
+
+
+def match_expression(query, author=None, guild=None):
+    """
+    Turns a search query into an FTS5 match expression.
+
+    Every word is matched as a literal, so punctuation in the query
+    can't be read as FTS5 syntax, and a trailing * matches a prefix.
+    """
+    terms = []
+    for word in query.split():
+        prefix = word.endswith("*")
+        word = word.rstrip("*")
+        if word:
+            term = '"' + word.replace('"', '""') + '"'
+            terms.append(term + " *" if prefix else term)
+
+    if not terms:
+        return None
+
+    expression = "content : (" + " AND ".join(terms) + ")"
+    if author is not None:
+        expression = f'author : "u{int(author)}" AND {expression}'
+    if guild is not None:
+        expression = f'guild : "g{int(guild)}" AND {expression}'
+    return expression
+
+
+class MessageSearchIndex:
+    """
+    An FTS5 table keyed by message ID.
+
+    Messages are ordered by their snowflake ID, so date filters become a
+    range on the table's rowid and the newest matches are found without
+    sorting. The author and guild are indexed as tokens, so their filters
+    are answered by the full-text index too. Only guild messages are
+    indexed, never DMs. Every call is run on one dedicated thread, which
+    owns the connection.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = None
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="search_index")
+
+        self.indexed = 0
+        self.searches = 0
+
+    def _connect(self):
+        if self._connection is None:
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = NORMAL")
+            columns = [row[1] for row in connection.execute(
+                "PRAGMA table_info(MESSAGE_FTS)")]
+            if columns and "guild" not in columns:
+                # Indexes from before guilds were recorded can't be
+                # filtered by guild, so they are started again
+                ut.log_info("Search index has no guilds, it must be rebuilt "
+                            "with search_index.py --rebuild")
+                connection.execute("DROP TABLE MESSAGE_FTS")
+            connection.execute("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS
+                MESSAGE_FTS USING fts5 (
+                    content,
+                    author,
+                    guild,
+                    channel UNINDEXED,
+                    dateSent UNINDEXED,
+                    prefix = '2 3'
+                )
+            """)
+            self._connection = connection
+        return self._connection
+
+    def _run(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self._executor, func, *args)
+
+    def _add(self, messages):
+        rows = [(int(message_id), content, f"u{int(discord_id)}",
+                 f"g{int(guild_id)}", int(channel_id or 0), date_sent)
+                for (discord_id, message_id, content, date_sent,
+                     channel_id, guild_id) in messages
+                if content and guild_id is not None]
+        connection = self._connect()
+        with connection:
+            connection.executemany("""
+                INSERT OR REPLACE INTO MESSAGE_FTS
+                (rowid, content, author, guild, channel, dateSent)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, rows)
+        self.indexed += len(rows)
+
+    def _search(self, query, author, guild, channels, since, until, limit,
+                offset):
+        expression = match_expression(query, author, guild)
+        if expression is None or channels is not None and not channels:
+            return []
+
+        low = snowflake_at(since) if since is not None else 0
+        high = snowflake_at(until) if until is not None else 2 ** 63 - 1
+
+        channel_filter = ""
+        params = [expression, low, high]
+        if channels is not None:
+            channel_filter = ("AND channel IN ("
+                              + ", ".join(["?"] * len(channels)) + ")")
+            params.extend(int(channel) for channel in channels)
+
+        connection = self._connect()
+        rows = connection.execute(f"""
+            SELECT rowid, author, channel, dateSent,
+                snippet(MESSAGE_FTS, 0, '**', '**', '...', 16) AS snippet
+            FROM MESSAGE_FTS
+            WHERE MESSAGE_FTS MATCH ?
+                AND rowid >= ? AND rowid < ? {channel_filter}
+            ORDER BY rowid DESC
+            LIMIT ? OFFSET ?
+        """, params + [limit, offset]).fetchall()
+        self.searches += 1
+
+        return [{
+            'messageID': message_id,
+            'discordID': int(author[1:]),
+            'channelID': channel,
+            'dateSent': date_sent,
+            'snippet': snippet,
+        } for message_id, author, channel, date_sent, snippet in rows]
+
+    def _optimize(self):
+        connection = self._connect()
+        with connection:
+            connection.execute(
+                "INSERT INTO MESSAGE_FTS (MESSAGE_FTS) VALUES ('optimize')")
+
+    async def add_messages(self, messages):
+        """
+        Indexes (discord_id, message_id, content, date_sent, channel_id,
+        guild_id) tuples, the same rows the message log writer writes.
+        Messages without a guild are DMs, and are left out.
+        """
+        if messages:
+            await self._run(self._add, messages)
+
+    async def search(self, query, author=None, guild=None, channels=None,
+                     since=None, until=None, limit=10, offset=0):
+        """
+        Returns the newest messages matching every word of `query`.
+
+        `author` is a Discord user ID, `guild` a guild ID, `channels` the
+        IDs of the only channels to search, and `since` and `until` are
+        timestamps. Each result has the message, author and channel IDs,
+        the time it was sent and a snippet with the matched words in bold.
+        """
+        return await self._run(self._search, query, author, guild, channels,
+                               since, until, limit, offset)
+
+    async def optimize(self):
+        """Merges the index's segments, making searches faster."""
+        await self._run(self._optimize)
+
+    def _close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    async def close(self):
+        """Closes the index, it is reopened the next time it is used."""
+        await self._run(self._close)
+
+    def stats(self):
+        return {
+            'indexed': self.indexed,
+            'searches': self.searches,
+        }
+
+
+message_index = MessageSearchIndex(SEARCH_INDEX_PATH)
+metrics.registry.register_stats("bot_search_index", message_index.stats,
+                                counters=('indexed', 'searches'))
+
+
+async def rebuild(index=message_index, batch_size=5000, include_archive=True):
+    """
+    Indexes every message in the message log, and the archive.
+    Messages already indexed are replaced, so this is safe to rerun.
+    """
+    indexed = 0
+    if include_archive:
+        cold = archive.MessageArchive()
+        batch = []
+        for row in cold.search():
+            batch.append((row['discordID'] or 0, row['messageID'],
+                          row['content'], row['dateSent'],
+                          row.get('channelID'), row.get('guildID')))
+            if len(batch) >= batch_size:
+                await index.add_messages(batch)
+                indexed += len(batch)
+                batch = []
+        await index.add_messages(batch)
+        indexed += len(batch)
+
+    last_id = 0
+    while True:
+        async with db.Database() as conn:
+            await conn.execute("""
+                SELECT ML.*, U.discordID
+                FROM MESSAGE_LOG ML
+                LEFT JOIN USERS U ON U.ID = ML.authorID
+                WHERE ML.ID > %s
+                ORDER BY ML.ID
+                LIMIT %s
+            """, (last_id, batch_size))
+            rows = conn.fetchall()
+        if not rows:
+            break
+
+        await index.add_messages([
+            (row['discordID'] or 0, row['messageID'],
+             db.message_content(row), row['dateSent'],
+             row['channelID'], row['guildID'])
+            for row in rows])
+        indexed += len(rows)
+        last_id = rows[-1]['ID']
+        ut.log_info(f"Indexed {indexed} messages")
+
+    await index.optimize()
+    return indexed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rebuild", action="store_true",
+                        help="index every message in the database and archive")
+    parser.add_argument("--skip-archive", action="store_true",
+                        help="don't index archived messages when rebuilding")
+    parser.add_argument("--search", help="print the newest matches for a query")
+    parser.add_argument("--author", type=int,
+                        help="only messages by this Discord user ID")
+    parser.add_argument("--guild", type=int,
+                        help="only messages in this guild")
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    if args.rebuild:
+        loop.run_until_complete(
+            rebuild(include_archive=not args.skip_archive))
+    if args.search:
+        for result in loop.run_until_complete(
+                message_index.search(args.search, author=args.author,
+                                     guild=args.guild)):
+            sent = datetime.fromtimestamp(result['dateSent'], timezone.utc)
+            print(f"[{sent:%Y-%m-%d %H:%M}] {result['discordID']} "
+                  f"({result['messageID']}): {result['snippet']}")
+    loop.run_until_complete(message_index.close())
+    loop.run_until_complete(db.close_pool())
+    loop.close()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Support for running the bot as several processes, each connected to some
+of its shards.
+
+Each guild belongs to exactly one shard, so work tied to a guild is done
+by the process running that guild's shard. Work that isn't tied to a
+guild is done by whichever process holds its lease in the LEASES table.
+"""
+
+import asyncio
+import os
+import socket
+import traceback
+from collections import Counter
+from functools import partial
+
+import database as db
+import metrics
+import utils as ut
+
+# Total number of shards, the bot runs unsharded if unset
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", 0)) or None
+# Shards run by this process, like 0,1 or 0-3, all of them if unset
+SHARD_IDS = os.getenv("SHARD_IDS")
+# Seconds a lease lasts if its holder stops renewing it
+LEASE_TTL = float(os.getenv("LEASE_TTL", 30))
+
+# Names this process when it holds a lease
+HOLDER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+# Every leader election in this process, by lease name
+elections = {}
+
+
+def parse_shard_ids(value):
+    """Parses a list of shard IDs and ranges, like 0,2,4-7."""
+    if not value:
+        return None
+
+    shard_ids = []
+    for part in value.split(","):
+        start, _, end = part.strip().partition("-")
+        shard_ids.extend(range(int(start), int(end or start) + 1))
+    return shard_ids
+
+
+def shard_of(guild_id, shard_count):
+    """Returns the shard Discord sends a guild's events on."""
+    return (int(guild_id) >> 22) % shard_count
+
+
+def owns_guild(bot, guild_id):
+    """Returns whether the guild's shard is run by this process."""
+    shard_ids = getattr(bot, "shard_ids", None)
+    if not bot.shard_count or shard_ids is None:
+        return True
+    return shard_of(guild_id, bot.shard_count) in shard_ids
+
+
+class ShardStats:
+    """Counts the connects, disconnects and resumes of each shard."""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.connects = Counter()
+        self.disconnects = Counter()
+        self.resumes = Counter()
+
+        for field, help, kind in (
+                ('latency', "Gateway heartbeat latency in seconds", "gauge"),
+                ('guilds', "Guilds on the shard", "gauge"),
+                ('members', "Members of the guilds on the shard", "gauge"),
+                ('connects', "Gateway connections made", "counter"),
+                ('disconnects', "Gateway disconnections", "counter"),
+                ('resumes', "Gateway sessions resumed", "counter")):
+            name = f"bot_shard_{field}" + ("_total" if kind == "counter" else "")
+            metrics.registry.register(name, help, partial(self._field, field),
+                                      kind, label_names=('shard', ))
+
+        bot.add_listener(self.on_shard_connect, 'on_shard_connect')
+        bot.add_listener(self.on_shard_disconnect, 'on_shard_disconnect')
+        bot.add_listener(self.on_shard_resumed, 'on_shard_resumed')
+
+    async def on_shard_connect(self, shard_id):
+        self.connects[shard_id] += 1
+
+    async def on_shard_disconnect(self, shard_id):
+        self.disconnects[shard_id] += 1
+
+    async def on_shard_resumed(self, shard_id):
+        self.resumes[shard_id] += 1
+
+    def _field(self, field):
+        return {shard_id: shard[field]
+                for shard_id, shard in self.stats().items()}
+
+    def stats(self):
+        guilds = Counter()
+        members = Counter()
+        for guild in self.bot.guilds:
+            guilds[guild.shard_id or 0] += 1
+            members[guild.shard_id or 0] += guild.member_count or 0
+
+        shards = getattr(self.bot, "shards", None)
+        if shards:
+            latencies = {shard_id: shard.latency
+                         for shard_id, shard in shards.items()}
+        else:
+            latencies = {self.bot.shard_id or 0: self.bot.latency}
+
+        return {
+            shard_id: {
+                'latency': latency,
+                'guilds': guilds[shard_id],
+                'members': members[shard_id],
+                'connects': self.connects[shard_id],
+                'disconnects': self.disconnects[shard_id],
+                'resumes': self.resumes[shard_id],
+            }
+            for shard_id, latency in sorted(latencies.items())
+        }
+
+
+class LeaderElection:
+    """
+    Keeps trying to take the lease `name`, and renews it while held.
+
+    The lease is renewed every third of `ttl`, and leadership is given up
+    as soon as a renewal fails, so two processes never both believe they
+    hold the lease. A holder that dies is replaced once its lease expires.
+    """
+
+    def __init__(self, name, ttl=LEASE_TTL):
+        self.name = name
+        self.ttl = ttl
+        self.is_leader = False
+
+        self._task = None
+        self._stopping = None
+
+        self.terms = 0
+        self.failures = 0
+
+        elections[name] = self
+        metrics.registry.register_stats("bot_lease", self.stats,
+                                        counters=('terms', 'failures'),
+                                        labels={'lease': name})
+
+    def start(self, loop, wait_until_ready=None):
+        self._stopping = asyncio.Event()
+        self._task = loop.create_task(self._run(wait_until_ready))
+
+    async def _run(self, wait_until_ready):
+        if wait_until_ready is not None:
+            waiting = asyncio.ensure_future(wait_until_ready())
+            stopping = asyncio.ensure_future(self._stopping.wait())
+            await asyncio.wait((waiting, stopping),
+                               return_when=asyncio.FIRST_COMPLETED)
+            waiting.cancel()
+            stopping.cancel()
+
+        while not self._stopping.is_set():
+            try:
+                is_leader = await db.acquire_lease(self.name, HOLDER_ID,
+                                                   self.ttl)
+            except Exception:
+                self.failures += 1
+                traceback.print_exc()
+                is_leader = False
+
+            if is_leader and not self.is_leader:
+                self.terms += 1
+                ut.log_info(f"Became leader for {self.name}")
+            elif self.is_leader and not is_leader:
+                ut.log_info(f"Lost leadership for {self.name}")
+            self.is_leader = is_leader
+
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.ttl / 3)
+            except asyncio.TimeoutError:
+                pass
+
+    async def close(self):
+        """Stops renewing the lease, and hands it over if it is held."""
+        if self._task is None:
+            return
+
+        self._stopping.set()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            # Already cancelled, as discord.py cancels every task
+            # when the bot is stopped by a signal
+            pass
+        self._task = None
+
+        if self.is_leader:
+            self.is_leader = False
+            await db.release_lease(self.name, HOLDER_ID)
+
+    def stats(self):
+        return {
+            'is_leader': self.is_leader,
+            'terms': self.terms,
+            'failures': self.failures,
+        }
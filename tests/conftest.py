@@ -0,0 +1,35 @@
+"""
+Shared fixtures. Every test runs on the sqlite backend, which needs no
+server, with a fresh database file per test.
+"""
+
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Read when the database module is first imported
+os.environ["DB_BACKEND"] = "sqlite"
+
+
+def run(coroutine):
+    """Runs a coroutine on a new event loop, as the bot's scripts do."""
+    return asyncio.run(coroutine)
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """The database module, on a migrated database in `tmp_path`."""
+    import database as db
+    import migrations
+
+    monkeypatch.setattr(db.backend, "path", str(tmp_path / "bot.db"))
+    run(migrations.migrate())
+    yield db
+
+    db.pool.close()
+    db.user_cache.clear()
+    db.guild_cache.clear()
@@ -0,0 +1,61 @@
+import sqlite3
+
+import pytest
+
+import backends
+
+
+def translate(query):
+    return " ".join(backends._translate_to_sqlite(query).split())
+
+
+def test_placeholders_are_translated():
+    assert translate("SELECT * FROM USERS WHERE ID = %s AND name = %s") == \
+        "SELECT * FROM USERS WHERE ID = ? AND name = ?"
+
+
+def test_insert_ignore_is_translated():
+    assert translate("INSERT IGNORE INTO USERS (name) VALUES (%s)") == \
+        "INSERT OR IGNORE INTO USERS (name) VALUES (?)"
+
+
+def test_for_update_is_dropped():
+    assert translate("SELECT ID FROM POLLS WHERE ID = %s FOR UPDATE") == \
+        "SELECT ID FROM POLLS WHERE ID = ?"
+
+
+def test_upsert_is_translated():
+    assert translate("""
+        INSERT INTO USERS (name, discordID) VALUES (%s, %s), (%s, %s)
+        ON DUPLICATE KEY UPDATE name = VALUES(name)
+    """) == ("INSERT INTO USERS (name, discordID) VALUES (?, ?), (?, ?) "
+             "ON CONFLICT DO UPDATE SET name = excluded.name")
+
+
+def test_sqlite_is_new_enough_for_translated_upserts():
+    assert sqlite3.sqlite_version_info >= backends.MIN_SQLITE_VERSION
+
+
+def test_translated_upsert_adds_to_existing_rows():
+    connection = sqlite3.connect(":memory:")
+    connection.execute("""
+        CREATE TABLE COUNTS (
+            name TEXT PRIMARY KEY,
+            total INT NOT NULL
+        )
+    """)
+
+    query = backends._translate_to_sqlite("""
+        INSERT INTO COUNTS (name, total) VALUES (%s, %s), (%s, %s)
+        ON DUPLICATE KEY UPDATE total = total + VALUES(total)
+    """)
+    connection.execute(query, ("a", 1, "b", 2))
+    connection.execute(query, ("a", 3, "c", 4))
+
+    assert dict(connection.execute("SELECT name, total FROM COUNTS")) == \
+        {"a": 4, "b": 2, "c": 4}
+
+
+def test_unknown_backend_is_refused():
+    with pytest.raises(Exception, match="postgres"):
+        backends.get_backend("postgres")
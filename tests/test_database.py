@@ -0,0 +1,189 @@
+import asyncio
+import time
+
+import pytest
+
+from conftest import run
+
+SLOW_QUERY = """
+    WITH RECURSIVE numbers(n) AS (
+        SELECT 1 UNION ALL SELECT n + 1 FROM numbers WHERE n < 1000000000
+    )
+    SELECT COUNT(*) AS n FROM numbers
+"""
+
+
+async def add_user(db, name, discord_id):
+    async with db.Database() as conn:
+        await conn.execute(
+            "INSERT INTO USERS (name, discordID) VALUES (%s, %s)",
+            (name, str(discord_id)))
+        await conn.commit()
+
+
+async def user_names(db):
+    async with db.Database() as conn:
+        await conn.execute("SELECT name FROM USERS ORDER BY name")
+        return [row['name'] for row in conn.fetchall()]
+
+
+def test_connections_are_reused(database):
+    async def main():
+        for _ in range(3):
+            async with database.Database() as conn:
+                await conn.execute("SELECT 1 AS one")
+                assert conn.fetchone() == {'one': 1}
+
+    opened = database.pool.opened
+    run(main())
+    stats = database.pool.stats()
+    assert stats['opened'] == opened
+    assert stats['in_use'] == 0
+
+
+def test_nested_blocks_share_a_connection(database):
+    async def main():
+        async with database.Database() as outer:
+            acquired = database.pool.acquired
+            async with database.Database() as inner:
+                assert inner.connection is outer.connection
+            assert database.pool.acquired == acquired
+
+    run(main())
+
+
+def test_tasks_wait_for_a_free_connection(database):
+    async def query():
+        async with database.Database() as conn:
+            await asyncio.sleep(0.05)
+            await conn.execute("SELECT 1 AS one")
+            return conn.fetchone()['one']
+
+    async def main():
+        return await asyncio.gather(*(query() for _ in range(3)))
+
+    # The sqlite backend has a single connection
+    waited = database.pool.waited
+    assert run(main()) == [1, 1, 1]
+    assert database.pool.waited > waited
+    assert database.pool.stats()['in_use'] == 0
+
+
+def test_executor_counts_calls(database):
+    completed = database.executor.completed
+    run(user_names(database))
+    stats = database.executor.stats()
+    assert stats['completed'] > completed
+    assert stats['running'] == 0
+    assert stats['queue_depth'] == 0
+
+
+def test_timed_out_query_is_interrupted(database):
+    async def main():
+        async with database.Database() as conn:
+            with pytest.raises(asyncio.TimeoutError):
+                await conn.execute(SLOW_QUERY, timeout=0.2)
+
+        # Runs as soon as the abandoned query has been stopped
+        started = time.perf_counter()
+        assert await user_names(database) == []
+        return time.perf_counter() - started
+
+    interrupted = database.executor.interrupted
+    assert run(main()) < 2
+    assert database.executor.interrupted == interrupted + 1
+    assert database.pool.stats()['in_use'] == 0
+
+
+def test_transaction_commits(database):
+    async def main():
+        async with database.transaction():
+            await add_user(database, "alice", 1)
+        return await user_names(database)
+
+    assert run(main()) == ["alice"]
+
+
+def test_transaction_rolls_back_on_error(database):
+    async def main():
+        with pytest.raises(ValueError):
+            async with database.transaction():
+                # Left to the transaction, rather than committed here
+                await add_user(database, "alice", 1)
+                raise ValueError
+        return await user_names(database)
+
+    assert run(main()) == []
+
+
+def test_nested_transaction_rolls_back_to_its_savepoint(database):
+    async def main():
+        async with database.transaction():
+            await add_user(database, "alice", 1)
+            with pytest.raises(ValueError):
+                async with database.transaction():
+                    await add_user(database, "bob", 2)
+                    raise ValueError
+            async with database.transaction():
+                await add_user(database, "carol", 3)
+        return await user_names(database)
+
+    assert run(main()) == ["alice", "carol"]
+
+
+def test_on_commit_waits_for_the_outermost_commit(database):
+    called = []
+
+    async def main():
+        async with database.transaction() as outer:
+            async with database.transaction() as inner:
+                inner.on_commit(lambda: called.append("kept"))
+            async with database.transaction() as inner:
+                inner.on_commit(lambda: called.append("rolled back"))
+                await inner.rollback()
+            assert called == []
+            outer.on_commit(lambda: called.append("outer"))
+
+        with pytest.raises(ValueError):
+            async with database.transaction() as conn:
+                conn.on_commit(lambda: called.append("failed"))
+                raise ValueError
+
+        async with database.Database() as conn:
+            conn.on_commit(lambda: called.append("no transaction"))
+
+    run(main())
+    assert called == ["kept", "outer", "no transaction"]
+
+
+def test_user_ids_are_only_cached_once_committed(database):
+    async def main():
+        with pytest.raises(ValueError):
+            async with database.transaction():
+                assert await database.get_user_id(111) is not None
+                raise ValueError
+        assert 111 not in database.user_cache
+
+        async with database.transaction():
+            user_id = await database.get_user_id(222)
+        assert database.user_cache.get(222) == user_id
+
+    run(main())
+
+
+def test_activity_counts_are_added(database, monkeypatch):
+    async def main():
+        await database.add_activity({(1, 2, 111, 3600): 3,
+                                     (1, 3, 222, 3600): 1})
+        await database.add_activity({(1, 2, 111, 3600): 4})
+        async with database.Database() as conn:
+            await conn.execute("""
+                SELECT channelID, messages FROM ACTIVITY_ROLLUP
+                ORDER BY channelID
+            """)
+            return [(row['channelID'], row['messages'])
+                    for row in conn.fetchall()]
+
+    # Split across statements, as large flushes are
+    monkeypatch.setattr(database, "ACTIVITY_CHUNK_SIZE", 1)
+    assert run(main()) == [("2", 7), ("3", 1)]
@@ -0,0 +1,85 @@
+import pytest
+
+import metrics
+
+
+def test_histogram_percentiles():
+    histogram = metrics.Histogram([1, 2, 5])
+    for value in (0.5, 1.5, 1.5, 4, 10):
+        histogram.observe(value)
+
+    assert histogram.counts == [1, 2, 1, 1]
+    assert histogram.percentile(50) == 2
+    assert histogram.percentile(99) == 10
+    assert histogram.stats()['mean'] == pytest.approx(3.5)
+
+
+def test_counters_render_with_labels():
+    registry = metrics.Registry()
+    commands = registry.counter("bot_commands_total", "Commands run",
+                                ('command', 'outcome'))
+    commands.inc("poll", "ok")
+    commands.inc("poll", "ok")
+    commands.inc("ping", "error")
+
+    assert registry.render() == (
+        '# HELP bot_commands_total Commands run\n'
+        '# TYPE bot_commands_total counter\n'
+        'bot_commands_total{command="poll",outcome="ok"} 2\n'
+        'bot_commands_total{command="ping",outcome="error"} 1\n')
+
+
+def test_histograms_render_cumulative_buckets():
+    registry = metrics.Registry()
+    latency = registry.histogram("bot_seconds", "Latency", ('cog', ),
+                                 bounds=[0.1, 1])
+    latency.labels("polls").observe(0.05)
+    latency.labels("polls").observe(0.5)
+    latency.labels("polls").observe(3)
+
+    assert registry.render().splitlines()[2:] == [
+        'bot_seconds_bucket{cog="polls",le="0.1"} 1',
+        'bot_seconds_bucket{cog="polls",le="1"} 2',
+        'bot_seconds_bucket{cog="polls",le="+Inf"} 3',
+        'bot_seconds_sum{cog="polls"} 3.55',
+        'bot_seconds_count{cog="polls"} 3',
+    ]
+
+
+def test_stats_are_registered_as_gauges_and_counters():
+    registry = metrics.Registry()
+    stats = {'queue_depth': 3, 'written': 10, 'name': "ignored"}
+    registry.register_stats("bot_log", lambda: stats, counters=('written', ),
+                            labels={'writer': "messages"})
+    stats['written'] = 12
+
+    lines = registry.render().splitlines()
+    assert '# TYPE bot_log_queue_depth gauge' in lines
+    assert 'bot_log_queue_depth{writer="messages"} 3' in lines
+    assert '# TYPE bot_log_written_total counter' in lines
+    assert 'bot_log_written_total{writer="messages"} 12' in lines
+    assert not any("name" in line for line in lines)
+
+
+def test_label_values_are_escaped():
+    registry = metrics.Registry()
+    registry.register("bot_info", "Info", lambda: 1,
+                      labels={'value': 'say "hi"\\\n'})
+
+    assert 'bot_info{value="say \\"hi\\"\\\\\\n"} 1' in \
+        registry.render().splitlines()
+
+
+def test_registering_again_replaces_the_source():
+    registry = metrics.Registry()
+    registry.register("bot_guilds", "Guilds", lambda: 1)
+    registry.register("bot_guilds", "Guilds", lambda: 2)
+
+    assert registry.render().splitlines()[2:] == ['bot_guilds 2']
+
+
+def test_a_name_keeps_its_kind():
+    registry = metrics.Registry()
+    registry.register("bot_guilds", "Guilds", lambda: 1)
+    with pytest.raises(ValueError):
+        registry.counter("bot_guilds", "Guilds")
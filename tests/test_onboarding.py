@@ -0,0 +1,47 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import discord
+import pytest
+
+from conftest import run
+from cogs import onboarding
+
+
+def timed_acquires(bucket, count):
+    async def main():
+        started = time.monotonic()
+        for _ in range(count):
+            await bucket.acquire()
+        return time.monotonic() - started
+
+    return run(main())
+
+
+def test_token_bucket_allows_a_burst():
+    assert timed_acquires(onboarding.TokenBucket(1, 5), 5) < 0.05
+
+
+def test_token_bucket_limits_the_rate_after_a_burst():
+    # Two at once, then four more at 20 a second
+    assert timed_acquires(onboarding.TokenBucket(20, 2), 6) >= 0.18
+
+
+def http_error(error_type, status):
+    response = SimpleNamespace(status=status, reason="")
+    return error_type(response, "")
+
+
+@pytest.mark.parametrize("error, retryable", [
+    (http_error(discord.HTTPException, 429), True),
+    (http_error(discord.HTTPException, 503), True),
+    (http_error(discord.HTTPException, 400), False),
+    (http_error(discord.Forbidden, 403), False),
+    (http_error(discord.NotFound, 404), False),
+    (asyncio.TimeoutError(), True),
+    (ConnectionResetError(), True),
+    (ValueError(), False),
+])
+def test_only_temporary_errors_are_retried(error, retryable):
+    assert onboarding.is_retryable(error) is retryable
@@ -0,0 +1,98 @@
+import asyncio
+import time
+
+from conftest import run
+from cogs import polls
+
+
+def run_scheduler(schedule, on_due, duration):
+    """Runs a scheduler for `duration` seconds, after `schedule(scheduler)`."""
+    async def main():
+        scheduler = polls.PollScheduler(on_due)
+        task = asyncio.ensure_future(scheduler.run())
+        await schedule(scheduler)
+        await asyncio.sleep(duration)
+        task.cancel()
+        return scheduler
+
+    return run(main())
+
+
+def test_polls_end_in_order_of_end_date():
+    ended = []
+
+    async def on_due(poll_id):
+        ended.append(poll_id)
+
+    async def schedule(scheduler):
+        now = time.time()
+        scheduler.schedule(1, now + 0.15)
+        scheduler.schedule(2, now + 0.05)
+        scheduler.schedule(3, now + 0.1)
+
+    scheduler = run_scheduler(schedule, on_due, 0.3)
+    assert ended == [2, 3, 1]
+    assert len(scheduler) == 0
+
+
+def test_rescheduled_and_cancelled_polls():
+    ended = []
+
+    async def on_due(poll_id):
+        ended.append((poll_id, time.time()))
+
+    async def schedule(scheduler):
+        now = time.time()
+        scheduler.schedule(1, now + 0.05)
+        scheduler.schedule(2, now + 0.05)
+        scheduler.schedule(3, now + 10)
+        # Ends later than first scheduled, then earlier
+        scheduler.schedule(1, now + 0.2)
+        scheduler.schedule(3, now + 0.1)
+        scheduler.cancel(2)
+
+    started = time.time()
+    scheduler = run_scheduler(schedule, on_due, 0.35)
+    assert [poll_id for poll_id, _ in ended] == [3, 1]
+    assert ended[1][1] - started >= 0.2
+    assert len(scheduler) == 0
+
+
+def test_failed_polls_are_retried(monkeypatch):
+    monkeypatch.setattr(polls, "MAX_RETRY_DELAY", 0.05)
+    attempts = []
+
+    async def on_due(poll_id):
+        attempts.append(poll_id)
+        if len(attempts) < 3:
+            raise OSError("database is down")
+
+    async def schedule(scheduler):
+        scheduler.schedule(1, time.time())
+
+    scheduler = run_scheduler(schedule, on_due, 0.3)
+    assert attempts == [1, 1, 1]
+    assert len(scheduler) == 0
+
+
+def test_refreshes_are_coalesced():
+    refreshed = []
+
+    async def refresh(poll_id):
+        refreshed.append((poll_id, time.monotonic()))
+
+    async def main():
+        refresher = polls.PollRefresher(refresh, 0.1)
+        refresher.mark_dirty(1)
+        refresher.mark_dirty(1)
+        await asyncio.sleep(0.02)
+        # Within the interval, so both wait for one later refresh
+        refresher.mark_dirty(1)
+        refresher.mark_dirty(1)
+        await asyncio.sleep(0.2)
+        return refresher
+
+    refresher = run(main())
+    assert [poll_id for poll_id, _ in refreshed] == [1, 1]
+    assert refreshed[1][1] - refreshed[0][1] >= 0.09
+    assert (refresher.requested, refresher.coalesced) == (4, 2)
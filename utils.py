@@ -7,6 +7,9 @@ Utility commands to be used throughout the cogs
 import os
 import asyncio
 import datetime
+import difflib
+from collections import OrderedDict
+from time import monotonic
 
 from pytz import timezone
 
@@ -14,18 +17,102 @@ from pytz import timezone
 ENVIRONMENT = os.getenv("ENVIRONMENT")
 
 
+class LRUCache:
+    """
+    Bounded in-memory mapping that evicts the least recently used entry.
+
+    Entries can optionally expire `ttl` seconds after they were set.
+    Hits, misses and evictions are counted for monitoring.
+    """
+
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        try:
+            value, expires = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        if expires is not None and expires <= monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        expires = None if self.ttl is None else monotonic() + self.ttl
+        self._data[key] = (value, expires)
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {
+            'size': len(self._data),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+def text_diff(old, new):
+    """
+    Returns the changes from `old` to `new` as a list of
+    [start, end, replacement] edits to `old`, which is far smaller
+    than either text when only a few characters were changed.
+    """
+    matcher = difflib.SequenceMatcher(None, old, new, autojunk=False)
+    return [[start, end, new[new_start:new_end]]
+            for tag, start, end, new_start, new_end in matcher.get_opcodes()
+            if tag != "equal"]
+
+
+def apply_text_diff(old, diff):
+    """Rebuilds the new text from `old` and the output of `text_diff`."""
+    parts = []
+    position = 0
+    for start, end, replacement in diff:
+        parts.append(old[position:start])
+        parts.append(replacement)
+        position = end
+    parts.append(old[position:])
+    return "".join(parts)
+
+
 async def get_confirmation(channel, user, bot, message):
     confirm_message = await channel.send(message)
     await confirm_message.add_reaction(u"👍")
     await confirm_message.add_reaction(u"👎")
 
-    def check(check_reaction, check_user):
-        return (check_user == user) \
-            and check_reaction.message.id == confirm_message.id and \
-            ((str(check_reaction.emoji) == u"👍") or (str(check_reaction.emoji) == u"👎"))
-
     try:
-        reaction, user = await bot.wait_for('reaction_add', timeout=30.0, check=check)
+        reaction, user = await bot.event_dispatcher.wait_for_reaction(
+            confirm_message.id, user.id, emojis=(u"👍", u"👎"), timeout=30.0)
     except asyncio.TimeoutError:
         await confirm_message.delete()
         return False, "Timeout"
@@ -48,6 +135,20 @@ async def get_uk_time(utc_time: datetime.datetime = None) -> datetime.datetime:
     return utc_time.astimezone(tz)
 
 
+async def add_role(member, role_id):
+    role = member.guild.get_role(role_id)
+
+    if role:
+        await member.add_roles(role)
+
+
+async def remove_role(member, role_id):
+    role = member.guild.get_role(role_id)
+
+    if role:
+        await member.remove_roles(role)
+
+
 async def is_admin(user):
     for role in user.roles:
         if role.name.lower() == "admin":